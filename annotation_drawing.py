@@ -0,0 +1,66 @@
+from functools import lru_cache
+
+import cv2
+import numpy as np
+from PIL import Image, ImageDraw, ImageFont
+
+# Fonts tried in order, arial on Windows and DejaVu on most Linux distributions
+FONT_NAMES = ["arial.ttf", "DejaVuSans.ttf"]
+
+BOX_COLOR = (0, 0, 170)  # BGR
+TEXT_COLOR = (0, 0, 0)
+
+
+@lru_cache(maxsize=None)
+def load_font(size):
+    for font_name in FONT_NAMES:
+        try:
+            return ImageFont.truetype(font_name, size)
+        except OSError:
+            continue
+    return ImageFont.load_default()
+
+
+@lru_cache(maxsize=1024)
+def text_sprite(text, font_size, background=BOX_COLOR, color=TEXT_COLOR):
+    """
+    Renders a label once with PIL (cv2 can't draw accents) and keeps it as a BGR array,
+    so drawing it again is a plain copy into the frame.
+    """
+    font = load_font(font_size)
+    left, top, right, bottom = font.getbbox(text)
+    padding = max(font_size // 8, 2)
+    width, height = right - left + 2 * padding, bottom - top + 2 * padding
+
+    # PIL draws in RGB, colors are given in BGR like the rest of cv2
+    sprite = Image.new("RGB", (width, height), background[::-1])
+    ImageDraw.Draw(sprite).text((padding - left, padding - top),
+                                text, font=font, fill=color[::-1])
+    sprite = cv2.cvtColor(np.asarray(sprite), cv2.COLOR_RGB2BGR)
+    sprite.flags.writeable = False
+    return sprite
+
+
+def draw_text(frame, text, x, y, font_size=30, background=BOX_COLOR, color=TEXT_COLOR):
+    """
+    Draws text in place with its bottom left corner at (x, y), clipped to the frame.
+    """
+    sprite = text_sprite(text, font_size, background, color)
+    height, width = sprite.shape[:2]
+    frame_height, frame_width = frame.shape[:2]
+
+    top = max(y - height, 0)
+    left = min(max(x, 0), frame_width)
+    bottom = min(top + height, frame_height)
+    right = min(left + width, frame_width)
+    frame[top:bottom, left:right] = sprite[:bottom - top, :right - left]
+
+
+def draw_box(frame, x1, y1, x2, y2, text=None, font_size=30, color=BOX_COLOR, thickness=4):
+    """
+    Draws a bounding box and its label in place on a BGR frame.
+    """
+    x1, y1, x2, y2 = int(x1), int(y1), int(x2), int(y2)
+    cv2.rectangle(frame, (x1, y1), (x2, y2), color, thickness)
+    if text:
+        draw_text(frame, text, x1, y1, font_size, background=color)
@@ -0,0 +1,378 @@
+import argparse
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import cv2
+import numpy as np
+import psutil
+
+# Read by main.py, create_dataset.py, create_annotated_video.py and train_model.py when it exists.
+# The environment variable points to another profile, an empty value disables it
+PROFILE_ENV = "THROUGHPUT_PROFILE"
+DEFAULT_PROFILE_PATH = "throughput_profile.json"
+
+
+def machine_description():
+    import torch
+
+    return {"host": socket.gethostname(), "cpus": os.cpu_count(),
+            "gpu": torch.cuda.get_device_name(0) if torch.cuda.is_available() else None}
+
+
+def load_profile(path=None):
+    """
+    Returns the throughput profile saved by this script, or None if there is none or if it was
+    calibrated on another machine.
+    """
+    path = os.environ.get(PROFILE_ENV, DEFAULT_PROFILE_PATH) if path is None else path
+    if not path or not os.path.exists(path):
+        return None
+
+    with open(path, "r", encoding="utf-8") as file:
+        profile = json.load(file)
+    if profile["machine"]["host"] != socket.gethostname():
+        print(f"{path} was calibrated on {profile['machine']['host']}, ignored on this machine")
+        return None
+    return profile
+
+
+def set_profile_defaults(parser, section, names, profile=None):
+    """
+    Uses the values of a section of the profile as defaults of the parser arguments `names`,
+    arguments given on the command line still win. Returns the profile.
+    """
+    profile = profile or load_profile()
+    if profile is None or section not in profile:
+        return profile
+
+    values = {name: profile[section][name]
+              for name in names if name in profile[section]}
+    parser.set_defaults(**values)
+    print(f"Throughput profile ({section}): " +
+          ", ".join(f"{name}={value}" for name, value in values.items()))
+    return profile
+
+
+def apply_thread_settings(section, profile=None):
+    """
+    Sets the torch intra-op and OpenCV thread counts of a section of the profile.
+    """
+    profile = profile or load_profile()
+    if profile is None or section not in profile:
+        return
+
+    settings = profile[section]
+    if "torch_threads" in settings:
+        import torch
+
+        torch.set_num_threads(settings["torch_threads"])
+    if "cv2_threads" in settings:
+        cv2.setNumThreads(settings["cv2_threads"])
+
+
+def make_sample(video_path, number_frames, sample_path):
+    """
+    Writes the first frames of the video to a short sample used for every measurement.
+    """
+    cap = cv2.VideoCapture(video_path)
+    frame_size = (int(cap.get(3)), int(cap.get(4)))
+    fourcc = cv2.VideoWriter_fourcc(*"mp4v")
+    out = cv2.VideoWriter(sample_path, fourcc, cap.get(
+        cv2.CAP_PROP_FPS) or 25.0, frame_size)
+
+    written = 0
+    while written < number_frames:
+        ret, frame = cap.read()
+        if not ret:
+            break
+        out.write(frame)
+        written += 1
+
+    cap.release()
+    out.release()
+    return written
+
+
+def thread_candidates(maximum):
+    return sorted({value for value in [1, 2, 4, maximum // 2, maximum] if 1 <= value <= maximum})
+
+
+def measure_inference(model, sample_path, torch_threads, cv2_threads, device):
+    """
+    Decodes the sample and runs the model frame by frame like main.py. Returns frames per second,
+    95th percentile latency per frame in ms and peak memory in MB (GPU if used, RSS otherwise).
+    """
+    import torch
+
+    torch.set_num_threads(torch_threads)
+    cv2.setNumThreads(cv2_threads)
+    use_gpu = torch.cuda.is_available()
+    if use_gpu:
+        torch.cuda.reset_peak_memory_stats()
+
+    cap = cv2.VideoCapture(sample_path)
+    latencies = []
+    start_time = time.time()
+    while True:
+        frame_start = time.time()
+        ret, frame = cap.read()
+        if not ret:
+            break
+        model(frame, agnostic_nms=True, verbose=False, device=device)
+        latencies.append(time.time() - frame_start)
+    elapsed_time = time.time() - start_time
+    cap.release()
+
+    if use_gpu:
+        memory = torch.cuda.max_memory_allocated() / 1e6
+    else:
+        memory = psutil.Process(os.getpid()).memory_info().rss / 1e6
+    return {"fps": len(latencies) / max(elapsed_time, 1e-9),
+            "latency_ms": 1000 * float(np.percentile(latencies, 95)) if latencies else 0.0,
+            "memory_mb": memory}
+
+
+def process_tree_rss(process):
+    try:
+        processes = [process] + process.children(recursive=True)
+        return sum(child.memory_info().rss for child in processes) / 1e6
+    except psutil.NoSuchProcess:
+        return 0.0
+
+
+def measure_dataset(sample_path, number_frames, species, batch, writers, jobs, threads):
+    """
+    Runs `jobs` create_annotated_video.py processes on the sample at the same time, like
+    create_dataset.py -jobs. Returns frames per second over all jobs and peak memory (RSS) in MB.
+    """
+    folder = tempfile.mkdtemp(prefix="autotune_")
+    # The processes being calibrated must not read a previous profile
+    environment = dict(os.environ, **{PROFILE_ENV: ""})
+    commands = [[sys.executable, "create_annotated_video.py", "-i", sample_path, "-o", folder, "-s", species,
+                 "-n", str(job), "-batch", str(batch), "-writers", str(writers), "-threads", str(threads)]
+                for job in range(jobs)]
+
+    start_time = time.time()
+    processes = [subprocess.Popen(command, env=environment, stdout=subprocess.DEVNULL)
+                 for command in commands]
+    watched = [psutil.Process(process.pid) for process in processes]
+    peak_memory = 0.0
+    while any(process.poll() is None for process in processes):
+        peak_memory = max(peak_memory, sum(process_tree_rss(process) for process in watched))
+        time.sleep(0.2)
+    elapsed_time = time.time() - start_time
+    shutil.rmtree(folder, ignore_errors=True)
+
+    if any(process.returncode != 0 for process in processes):
+        return None
+    return {"fps": jobs * number_frames / max(elapsed_time, 1e-9), "memory_mb": peak_memory}
+
+
+def best_within_budget(measurements, max_latency=None, max_memory=None):
+    allowed = [measurement for measurement in measurements
+               if (max_latency is None or measurement.get("latency_ms", 0.0) <= max_latency)
+               and (max_memory is None or measurement["memory_mb"] <= max_memory)]
+    if not allowed:
+        return None
+    return max(allowed, key=lambda measurement: measurement["fps"])
+
+
+def tune_inference(model_path, sample_path, max_latency, max_memory, device):
+    """
+    Coordinate search: torch threads first (OpenCV default), then OpenCV threads.
+    """
+    from ultralytics import YOLO
+
+    model = YOLO(model_path)
+    # Warm up, the first call builds the predictor
+    measure_inference(model, sample_path, os.cpu_count(), -1, device)
+
+    measurements = []
+    for torch_threads in thread_candidates(os.cpu_count()):
+        measurement = {"torch_threads": torch_threads, "cv2_threads": -1,
+                       **measure_inference(model, sample_path, torch_threads, -1, device)}
+        print(f"inference {measurement}")
+        measurements.append(measurement)
+    best = best_within_budget(measurements, max_latency, max_memory)
+    if best is None:
+        return None, measurements
+
+    for cv2_threads in thread_candidates(os.cpu_count()):
+        measurement = {"torch_threads": best["torch_threads"], "cv2_threads": cv2_threads,
+                       **measure_inference(model, sample_path, best["torch_threads"], cv2_threads, device)}
+        print(f"inference {measurement}")
+        measurements.append(measurement)
+    best = best_within_budget(measurements, max_latency, max_memory)
+
+    return {"torch_threads": best["torch_threads"], "cv2_threads": best["cv2_threads"]}, measurements
+
+
+def tune_dataset(sample_path, number_frames, batches, writer_counts, job_counts, max_memory):
+    """
+    Batch size and writer threads of one create_annotated_video.py process, then the number of
+    processes run at the same time, each with its share of the CPU threads.
+    """
+    # utils.py is generated by preprocess_and_copy_downloaded_data.py
+    from utils import SPECIES_LIST
+
+    species = SPECIES_LIST[0]
+    threads = os.cpu_count()
+    measurements = []
+    for batch in batches:
+        for writers in writer_counts:
+            measurement = measure_dataset(
+                sample_path, number_frames, species, batch, writers, 1, threads)
+            if measurement is None:
+                print(f"dataset batch={batch} writers={writers} failed")
+                continue
+            measurement = {"batch": batch, "writers": writers,
+                           "jobs": 1, "threads": threads, **measurement}
+            print(f"dataset {measurement}")
+            measurements.append(measurement)
+    best = best_within_budget(measurements, max_memory=max_memory)
+    if best is None:
+        return None, measurements
+
+    for jobs in job_counts:
+        if jobs == 1:
+            continue
+        threads = max(os.cpu_count() // jobs, 1)
+        measurement = measure_dataset(sample_path, number_frames, species,
+                                      best["batch"], best["writers"], jobs, threads)
+        if measurement is None:
+            print(f"dataset jobs={jobs} failed")
+            continue
+        measurement = {"batch": best["batch"], "writers": best["writers"],
+                       "jobs": jobs, "threads": threads, **measurement}
+        print(f"dataset {measurement}")
+        measurements.append(measurement)
+    best = best_within_budget(measurements, max_memory=max_memory)
+
+    return {name: best[name] for name in ["batch", "writers", "jobs", "threads"]}, measurements
+
+
+def tune_train(model_path, imgsz, fraction):
+    """
+    Largest training batch fitting in `fraction` of the GPU memory, from ultralytics autobatch.
+    """
+    import torch
+    from copy import deepcopy
+    from ultralytics import YOLO
+    from ultralytics.utils.autobatch import autobatch
+
+    if not torch.cuda.is_available():
+        print("No GPU detected, the training batch size is not tuned")
+        return None
+
+    model = deepcopy(YOLO(model_path).model).cuda().train()
+    return {"batch": int(autobatch(model, imgsz=imgsz, fraction=fraction))}
+
+
+def main():
+    """
+    Calibrates the batch sizes and thread counts on this machine and saves them to a profile picked
+    up automatically by main.py (threads), create_dataset.py / create_annotated_video.py (batch,
+    writer threads, parallel videos) and train_model.py (batch).
+
+    Args:
+        -i (str): Video used for the calibration (default: input_files/video.mp4).
+        -frames (int): Number of frames of the video used per measurement (default: 300).
+        -m (str): Model of main.py (default: best_weights/best.pt).
+        -train-model (str): Model trained by train_model.py (default: yolov8m.pt).
+        -imgsz (int): Training image size (default: 640).
+        -stages (str): Stages to calibrate, among inference, dataset and train (default: all).
+        -max-latency (float): Latency budget per frame of main.py, in ms (default: None).
+        -max-memory (float): Memory budget, in MB (GPU memory for main.py if a GPU is used, RSS otherwise) (default: None).
+        -train-fraction (float): Share of the GPU memory used by the training batch (default: 0.6).
+        -batches (int): Batch sizes tried for the dataset creation (default: 1 4 8 16).
+        -writers (int): Writer thread counts tried for the dataset creation (default: 0 2 4).
+        -jobs (int): Numbers of videos processed at the same time tried (default: 1 2 4).
+        -o (str): Profile file (default: throughput_profile.json).
+    """
+    parser = argparse.ArgumentParser(
+        description="Calibrate batch sizes and thread counts for this machine")
+    parser.add_argument("-i", type=str, default="input_files/video.mp4",
+                        help="Video used for the calibration")
+    parser.add_argument("-frames", type=int, default=300,
+                        help="Number of frames of the video used per measurement")
+    parser.add_argument("-m", type=str, default="best_weights/best.pt",
+                        help="Model of main.py")
+    parser.add_argument("-train-model", type=str, default="yolov8m.pt",
+                        help="Model trained by train_model.py")
+    parser.add_argument("-imgsz", type=int, default=640,
+                        help="Training image size")
+    parser.add_argument("-stages", type=str, nargs="+", default=["inference", "dataset", "train"],
+                        choices=["inference", "dataset", "train"], help="Stages to calibrate")
+    parser.add_argument("-max-latency", type=float, default=None,
+                        help="Latency budget per frame of main.py, in ms")
+    parser.add_argument("-max-memory", type=float, default=None,
+                        help="Memory budget, in MB")
+    parser.add_argument("-train-fraction", type=float, default=0.6,
+                        help="Share of the GPU memory used by the training batch")
+    parser.add_argument("-batches", type=int, nargs="+", default=[1, 4, 8, 16],
+                        help="Batch sizes tried for the dataset creation")
+    parser.add_argument("-writers", type=int, nargs="+", default=[0, 2, 4],
+                        help="Writer thread counts tried for the dataset creation")
+    parser.add_argument("-jobs", type=int, nargs="+", default=[1, 2, 4],
+                        help="Numbers of videos processed at the same time tried")
+    parser.add_argument("-o", type=str, default=DEFAULT_PROFILE_PATH,
+                        help="Profile file")
+    args = parser.parse_args()
+
+    # Stages not calibrated again keep their previous values
+    profile = {}
+    if os.path.exists(args.o):
+        with open(args.o, "r", encoding="utf-8") as file:
+            profile = json.load(file)
+    profile["machine"] = machine_description()
+    profile.setdefault("measurements", {})
+
+    folder = tempfile.mkdtemp(prefix="autotune_sample_")
+    sample_path = os.path.join(folder, "sample.mp4")
+    number_frames = make_sample(args.i, args.frames, sample_path)
+    print(f"Calibrating on {number_frames} frames of {args.i}")
+
+    try:
+        if "inference" in args.stages:
+            device = 0 if profile["machine"]["gpu"] is not None else "cpu"
+            settings, measurements = tune_inference(
+                args.m, sample_path, args.max_latency, args.max_memory, device)
+            profile["measurements"]["inference"] = measurements
+            if settings is None:
+                print("No inference setting fits in the budget")
+            else:
+                profile["inference"] = settings
+
+        if "dataset" in args.stages:
+            settings, measurements = tune_dataset(sample_path, number_frames, args.batches, args.writers,
+                                                  args.jobs, args.max_memory)
+            profile["measurements"]["dataset"] = measurements
+            if settings is None:
+                print("No dataset setting fits in the budget")
+            else:
+                profile["dataset"] = settings
+
+        if "train" in args.stages:
+            settings = tune_train(args.train_model, args.imgsz, args.train_fraction)
+            if settings is not None:
+                profile["train"] = settings
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+
+    with open(args.o, "w", encoding="utf-8") as file:
+        json.dump(profile, file, indent=2)
+
+    for section in ["inference", "dataset", "train"]:
+        if section in profile:
+            print(f"{section}: {profile[section]}")
+    print(f"Profile saved to {args.o}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+import argparse
+import os
+import time
+
+import cv2
+import numpy as np
+import psutil
+
+from annotation_drawing import draw_box
+from frame_pool import FramePool
+
+
+def run(video_path, mode, loops, sample_every, model=None):
+    """
+    Decodes the video `loops` times, drawing a box on every frame like main.py, and samples the
+    resident memory of the process. Returns the samples as (frame, RSS in MB) and the frames per second.
+
+    mode "alloc" reads a new array per frame and copies it before drawing (the previous loop of
+    main.py), mode "pool" decodes into a FramePool and draws in place.
+    """
+    process = psutil.Process(os.getpid())
+    samples = []
+    frames = 0
+    pool = None
+    start_time = time.time()
+
+    for _ in range(loops):
+        cap = cv2.VideoCapture(video_path)
+        if pool is None:
+            pool = FramePool.for_capture(cap, size=2)
+
+        while True:
+            if mode == "pool":
+                ret, frame = pool.read(cap)
+            else:
+                ret, frame = cap.read()
+            if not ret:
+                break
+
+            if model is not None:
+                model(frame, agnostic_nms=True, verbose=False)
+
+            annotated_frame = frame.copy() if mode == "alloc" else frame
+            height, width = annotated_frame.shape[:2]
+            draw_box(annotated_frame, width // 4, height // 4,
+                     3 * width // 4, 3 * height // 4, "bird 0.90")
+
+            if mode == "pool":
+                pool.release(frame)
+
+            if frames % sample_every == 0:
+                samples.append((frames, process.memory_info().rss / 1e6))
+            frames += 1
+
+        cap.release()
+
+    elapsed_time = time.time() - start_time
+    if pool is not None and pool.copies:
+        print(f"{pool.copies} frames were copied into the pool, the backend ignored the buffer")
+    return samples, frames / max(elapsed_time, 1e-9)
+
+
+def summarize(mode, samples, fps):
+    frames, rss = np.array(samples).T
+    # Growth measured after the warm up (first quarter of the run)
+    steady = frames >= frames[-1] / 4
+    slope = np.polyfit(frames[steady], rss[steady], 1)[
+        0] * 1000 if np.count_nonzero(steady) > 1 else 0.0
+    print(f"{mode:>5}: {fps:7.1f} fps, RSS start {rss[0]:.1f} MB, max {rss.max():.1f} MB, "
+          f"end {rss[-1]:.1f} MB, steady growth {slope:+.3f} MB/1000 frames")
+
+
+def main():
+    """
+    Measures the memory and speed of the frame loop with and without the preallocated frame pool
+    over a long video (the input video decoded several times).
+
+    Args:
+        -i (str): Video to decode (default: input_files/video.mp4).
+        -loops (int): Number of times the video is decoded (default: 20).
+        -modes (str): Loops to measure, among alloc and pool (default: alloc pool).
+        -sample (int): Frames between two RSS samples (default: 50).
+        -m (str): Also run this model on every frame (default: None, decoding and drawing only).
+        -o (str): CSV file where the samples are written (default: None).
+    """
+    parser = argparse.ArgumentParser(
+        description="Compare the memory of the frame loop with and without the frame pool")
+    parser.add_argument("-i", type=str, default="input_files/video.mp4",
+                        help="Video to decode")
+    parser.add_argument("-loops", type=int, default=20,
+                        help="Number of times the video is decoded")
+    parser.add_argument("-modes", type=str, nargs="+", default=["alloc", "pool"],
+                        choices=["alloc", "pool"], help="Loops to measure")
+    parser.add_argument("-sample", type=int, default=50,
+                        help="Frames between two RSS samples")
+    parser.add_argument("-m", type=str, default=None,
+                        help="Also run this model on every frame")
+    parser.add_argument("-o", type=str, default=None,
+                        help="CSV file where the samples are written")
+    args = parser.parse_args()
+
+    model = None
+    if args.m is not None:
+        from ultralytics import YOLO
+        model = YOLO(args.m)
+
+    rows = []
+    for mode in args.modes:
+        samples, fps = run(args.i, mode, args.loops, args.sample, model)
+        if not samples:
+            print(f"No frame could be read from {args.i}")
+            return
+        summarize(mode, samples, fps)
+        rows.extend((mode, frame, rss) for frame, rss in samples)
+
+    if args.o is not None:
+        with open(args.o, "w", encoding="utf-8") as file:
+            file.write("mode,frame,rss_mb\n")
+            for mode, frame, rss in rows:
+                file.write(f"{mode},{frame},{rss:.2f}\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,194 @@
+import argparse
+import os
+import time
+
+import cv2
+import torchvision
+from ultralytics import YOLO
+
+from species_vote import most_common_value
+
+
+class CascadeDetector:
+    """
+    Runs the detector at a low input size first and only re-runs it at full size on the frames
+    where the low resolution result can't be trusted:
+        - the best box is within `margin` of the confidence threshold,
+        - or boxes of different species have scores within `ambiguity` of the best one.
+
+    The low resolution pass runs without agnostic NMS, so that a bird hesitating between two species
+    keeps one box per species and is escalated. The boxes kept at low resolution are then
+    suppressed across classes, like the single pass.
+
+    Frames whose best box is clearly above the threshold keep the low resolution result, frames
+    whose best box is clearly below it are considered empty.
+    """
+
+    def __init__(self, model, low_imgsz=320, low_conf=0.7, high_imgsz=640, high_conf=0.7,
+                 margin=0.15, ambiguity=0.1, iou=0.7):
+        self.model = model
+        self.low_imgsz = low_imgsz
+        self.low_conf = low_conf
+        self.high_imgsz = high_imgsz
+        self.high_conf = high_conf
+        self.margin = margin
+        self.ambiguity = ambiguity
+        self.iou = iou
+
+        self.frames = 0
+        self.escalated = 0
+
+    def __call__(self, frame):
+        """
+        Returns the result kept for the frame and whether the frame was escalated to full size.
+        """
+        self.frames += 1
+
+        # Boxes just below the threshold are needed to know if the frame is close to it
+        result = self.model(frame, imgsz=self.low_imgsz, agnostic_nms=False, iou=self.iou,
+                            conf=max(self.low_conf - self.margin, 0.01), verbose=False)[0]
+
+        if self.needs_escalation(result):
+            self.escalated += 1
+            return self.model(frame, imgsz=self.high_imgsz, agnostic_nms=True, iou=self.iou,
+                              conf=self.high_conf, verbose=False)[0], True
+
+        result = result[result.boxes.conf >= self.low_conf]
+        # One box per bird, as with agnostic NMS
+        keep = torchvision.ops.nms(result.boxes.xyxy, result.boxes.conf, self.iou)
+        return result[keep], False
+
+    def needs_escalation(self, result):
+        scores = result.boxes.conf
+        if scores.numel() == 0:
+            return False
+
+        best = float(scores.max())
+        if abs(best - self.low_conf) < self.margin:
+            return True
+
+        # Another species scoring almost as well as the best box, on the same bird (boxes of each
+        # species survive the class aware NMS) or on another one
+        close = result.boxes.cls[scores >= best - self.ambiguity]
+        return close.unique().numel() > 1
+
+    def escalation_rate(self):
+        return self.escalated / self.frames if self.frames else 0.0
+
+
+def add_cascade_arguments(parser):
+    parser.add_argument("--low-imgsz", type=int, default=320,
+                        help="Input size of the first stage of the cascade")
+    parser.add_argument("--low-conf", type=float, default=0.7,
+                        help="Confidence threshold of the first stage of the cascade")
+    parser.add_argument("--high-imgsz", type=int, default=640,
+                        help="Input size of the full resolution stage of the cascade")
+    parser.add_argument("--high-conf", type=float, default=0.7,
+                        help="Confidence threshold of the full resolution stage of the cascade")
+    parser.add_argument("--escalate-margin", type=float, default=0.15,
+                        help="Frames whose best box is this close to the threshold are re-run at full resolution")
+    parser.add_argument("--ambiguity-margin", type=float, default=0.1,
+                        help="Frames where two species score this close are re-run at full resolution")
+
+
+def create_cascade(model, args):
+    return CascadeDetector(model, args.low_imgsz, args.low_conf, args.high_imgsz, args.high_conf,
+                           args.escalate_margin, args.ambiguity_margin)
+
+
+def labels_of(result, names):
+    if result.boxes.cls.numel() == 0:
+        return [None]
+    return [names[int(c)] for c in result.boxes.cls]
+
+
+def run_video(video_path, detect, names):
+    cap = cv2.VideoCapture(video_path)
+    predicted_labels = []
+    frames = 0
+    elapsed_time = 0.0
+
+    while True:
+        ret, frame = cap.read()
+        if not ret:
+            break
+
+        start_time = time.perf_counter()
+        result = detect(frame)
+        elapsed_time += time.perf_counter() - start_time
+
+        predicted_labels.extend(labels_of(result, names))
+        frames += 1
+
+    cap.release()
+    return most_common_value(predicted_labels), frames, elapsed_time
+
+
+def main():
+    """
+    Compares the cascade with the single pass of main.py on videos: time per frame, share of
+    frames escalated to full resolution and video level species.
+
+    Args:
+        -i (str): Video file or folder of videos (default: input_files/video.mp4).
+        -m (str): Model to use (default: best_weights/best.pt).
+        --tolerance (float): Accepted drop of video level agreement with the single pass (default: 0.02).
+        Stage arguments are the same as main.py -cascade.
+    """
+    parser = argparse.ArgumentParser(
+        description="Compare the resolution cascade with the single pass")
+    parser.add_argument("-i", type=str, default="input_files/video.mp4",
+                        help="Video file or folder of videos")
+    parser.add_argument("-m", type=str, default="best_weights/best.pt",
+                        help="Model to use")
+    parser.add_argument("--tolerance", type=float, default=0.02,
+                        help="Accepted share of videos whose species differs from the single pass")
+    add_cascade_arguments(parser)
+    args = parser.parse_args()
+
+    if os.path.isdir(args.i):
+        videos = sorted(os.path.join(root, filename)
+                        for root, _, files in os.walk(args.i)
+                        for filename in files if filename.endswith(".mp4"))
+    else:
+        videos = [args.i]
+    if not videos:
+        print(f"No .mp4 video found in {args.i}")
+        return
+
+    model = YOLO(args.m)
+    cascade = create_cascade(model, args)
+
+    def single_pass(frame):
+        return model(frame, imgsz=args.high_imgsz, agnostic_nms=True, conf=args.high_conf, verbose=False)[0]
+
+    def cascade_pass(frame):
+        return cascade(frame)[0]
+
+    agreements = 0
+    frames = 0
+    single_time = 0.0
+    cascade_time = 0.0
+    for video_path in videos:
+        single_species, video_frames, elapsed_time = run_video(
+            video_path, single_pass, model.names)
+        single_time += elapsed_time
+        cascade_species, _, elapsed_time = run_video(
+            video_path, cascade_pass, model.names)
+        cascade_time += elapsed_time
+        frames += video_frames
+
+        agreements += single_species == cascade_species
+        print(f"{video_path}: single pass {single_species}, cascade {cascade_species}")
+
+    frames = max(frames, 1)
+    disagreement = 1 - agreements / len(videos)
+    print(f"Single pass: {1000 * single_time / frames:.1f} ms/frame")
+    print(f"Cascade: {1000 * cascade_time / frames:.1f} ms/frame, "
+          f"{cascade.escalated}/{cascade.frames} frames escalated ({100 * cascade.escalation_rate():.1f}%)")
+    print(f"Videos whose species differs from the single pass: {100 * disagreement:.1f}% "
+          f"({'within' if disagreement <= args.tolerance else 'above'} the {100 * args.tolerance:.1f}% tolerance)")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,10 @@
 import os
 import shutil
-import json
 
+from species_store import open_store
 
-def copy_videos(source_folder, destination_folder, species_dict):
+
+def copy_videos(source_folder, destination_folder, store):
     for root, _, files in os.walk(source_folder):
         for filename in files:
             if filename.endswith(".mp4"):
@@ -11,8 +12,9 @@ def copy_videos(source_folder, destination_folder, species_dict):
                 mp4_file_name = parent_folder_name + ".mp4"
                 source_path = os.path.join(root, filename)
 
-                # Check if the video is in species_dict before copying
-                if parent_folder_name in species_dict and species_dict[parent_folder_name]["test"] == "True":
+                # Check if the video is in the store before copying
+                entry = store.get(parent_folder_name)
+                if entry is not None and entry["test"] == "True":
                     destination_path = os.path.join(
                         destination_folder, mp4_file_name)
                     # Copy the file to the specified folder
@@ -24,9 +26,8 @@ def main():
     source_folder = "videos"
     destination_folder = "test_videos"
 
-    # Read species_dict from a JSON file
-    with open("filtered_species_dict.json", "r") as json_file:
-        species_dict = json.load(json_file)
+    # Open the store of the selected videos
+    store = open_store()
 
     # Delete the entire folder and its contents if it exists
     if os.path.exists(destination_folder):
@@ -35,7 +36,8 @@ def main():
 
     os.makedirs(destination_folder, exist_ok=True)
 
-    copy_videos(source_folder, destination_folder, species_dict)
+    copy_videos(source_folder, destination_folder, store)
+    store.close()
 
 
 if __name__ == "__main__":
@@ -3,10 +3,18 @@ import argparse
 import supervision as sv
 import os
 import random
+import torch
 
+from concurrent.futures import ThreadPoolExecutor
 from ultralytics import YOLO
+from autotune import set_profile_defaults
+from frame_cache import FrameCacheWriter
+from frame_pool import FramePool
 from utils import SPECIES_LIST
 
+# Minimum confidence of the bird box with a budget (-k) when -min-conf isn't given, the threshold of main.py
+BUDGET_MIN_CONF = 0.7
+
 
 def create_images_labels_directories(images_train_dir, images_val_dir, images_test_dir, labels_train_dir, labels_val_dir, labels_test_dir):
 
@@ -39,6 +47,79 @@ def save_label(label_path, bird_annotation):
         label_file.write(bird_annotation)
 
 
+def save_frame(image_path, label_path, frame, bird_annotation):
+    save_image(image_path, frame)
+    save_label(label_path, bird_annotation)
+
+
+def sequential_frames(cap, pool):
+    """
+    Every frame of the video with its index.
+    """
+    frame_index = 0
+    while True:
+        ret, frame = pool.read(cap)
+        if not ret:
+            return
+        yield frame_index, frame
+        frame_index += 1
+
+
+def probe_passes(number_frames, k):
+    """
+    Frame indices to probe, pass after pass: k frames evenly spread over the video first, then
+    the frames halfway between the ones already probed, until every frame was probed.
+    """
+    probed = set()
+    number_positions = k
+    while len(probed) < number_frames:
+        step = number_frames / number_positions
+        positions = sorted({min(int((index + 0.5) * step), number_frames - 1)
+                            for index in range(number_positions)} - probed)
+        probed.update(positions)
+        yield positions
+        number_positions *= 2
+
+
+def count_frames(video_path):
+    # Used when the container doesn't give the number of frames, grab doesn't convert the frames
+    cap = cv2.VideoCapture(video_path)
+    number_frames = 0
+    while cap.grab():
+        number_frames += 1
+    cap.release()
+    return number_frames
+
+
+def budget_frames(video_path, cap, pool, k, max_skip=30):
+    """
+    Frames spread over the whole video in coarse to fine passes (see probe_passes), so that
+    stopping after any number of frames still covers the whole clip.
+    """
+    number_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    if number_frames <= 0:
+        number_frames = count_frames(video_path)
+
+    for positions in probe_passes(number_frames, k):
+        # Close frames are reached by decoding forward, far ones by seeking
+        cap.set(cv2.CAP_PROP_POS_FRAMES, positions[0])
+        current = positions[0]
+        for position in positions:
+            if position - current > max_skip:
+                cap.set(cv2.CAP_PROP_POS_FRAMES, position)
+            else:
+                while current < position and cap.grab():
+                    current += 1
+            current = position
+
+            ret, frame = pool.read(cap)
+            if not ret:
+                # The frame count of the container can be too large
+                continue
+            current += 1
+            yield position, frame
+
+
 def main():
     """
     Creates a part of the dataset with images and labels by using pretrained model and merging every animals into birds and giving which bird species it is.
@@ -50,6 +131,18 @@ def main():
         -n (int): Number of the video (default=0).
         -p (float): Probability of being in the train folder (default=0.8).
         -t (bool): If specified, the data will be in the test set.
+        -seed (int): Seed of the train/validation draw, combined with -n so that a video always goes to
+            the same split (default: None, random).
+        --cache-imgsz (int): Also write the frames letterboxed to this size into the frame cache (default: None).
+        --no-jpeg (bool): Only write the frame cache, not the full size images. Requires --cache-imgsz.
+        -batch (int): Number of frames run through the model at once (default: 1).
+        -writers (int): Threads writing the images, 0 writes them between two batches (default: 0).
+        -threads (int): Torch intra-op threads (default: None, torch default).
+        The defaults of -batch, -writers and -threads come from the profile of autotune.py if there is one.
+        -k (int): Stop once this number of frames is saved, frames being probed spread over the whole video
+            (default: None, every frame).
+        -min-conf (float): Minimum confidence of the bird box for a frame to be saved (default: 0.7 with -k,
+            otherwise None, any).
     """
 
     # Parse command line arguments
@@ -66,9 +159,36 @@ def main():
                         help="Probability of being in the train folder. 1-p probability of being in validation folder")
     parser.add_argument("-t", action="store_true", default=False,
                         help="If specified, the data will be in the test set.")
+    parser.add_argument("-seed", type=int, default=None,
+                        help="Seed of the train/validation draw, combined with -n so that a video always goes to the same split")
+    parser.add_argument("--cache-imgsz", type=int, default=None,
+                        help="Also write the frames letterboxed to this size into the frame cache")
+    parser.add_argument("--no-jpeg", action="store_true", default=False,
+                        help="Only write the frame cache, not the full size images. Requires --cache-imgsz")
+    parser.add_argument("-batch", type=int, default=1,
+                        help="Number of frames run through the model at once")
+    parser.add_argument("-writers", type=int, default=0,
+                        help="Threads writing the images, 0 writes them between two batches")
+    parser.add_argument("-threads", type=int, default=None,
+                        help="Torch intra-op threads")
+    parser.add_argument("-k", type=int, default=None,
+                        help="Stop once this number of frames is saved, the frames probed being spread over the whole video")
+    parser.add_argument("-min-conf", type=float, default=None,
+                        help="Minimum confidence of the bird box for a frame to be saved, 0.7 by default with -k")
+    set_profile_defaults(parser, "dataset", ["batch", "writers", "threads"])
 
     args = parser.parse_args()
 
+    # The budget is spent on confidently labelled frames only
+    if args.k is not None and args.min_conf is None:
+        args.min_conf = BUDGET_MIN_CONF
+
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+
+    if args.no_jpeg and args.cache_imgsz is None:
+        parser.error("--no-jpeg requires --cache-imgsz")
+
     # Create VideoCapture objects for input and output videos
     cap = cv2.VideoCapture(args.i)
 
@@ -100,55 +220,72 @@ def main():
 
     # Split every frame on the video into train, validation, or test folder
     if (args.t):
+        split = "test"
         image_dir = images_test_dir
         label_dir = labels_test_dir
     else:
-        probability = random.random()
+        # Seeded per video, a video processed again (e.g. by another worker) goes to the same split
+        generator = random.Random(
+            f"{args.seed}:{args.n}") if args.seed is not None else random
+        probability = generator.random()
         if probability < args.p:
+            split = "train"
             image_dir = images_train_dir
             label_dir = labels_train_dir
         else:
+            split = "val"
             image_dir = images_val_dir
             label_dir = labels_val_dir
 
+    # Shard of the frame cache for this video, merged with the others by create_dataset
+    cache_writer = None
+    if args.cache_imgsz is not None:
+        cache_writer = FrameCacheWriter(
+            args.o, args.cache_imgsz, split, f"{args.n:08}")
+
     create_images_labels_directories(
         images_train_dir, images_val_dir, images_test_dir, labels_train_dir, labels_val_dir, labels_test_dir)
 
-    frame_count = 0
-
-    while True:
-        ret, frame = cap.read()
-
-        if not ret:
-            break
-
-        # # Since we have many frames in one video, instead of learning on similar images, we take one frame every 3 frames.
-        # if frame_count % 3 != 0:
-        #     frame_count += 1
-        #     continue
-
-        result = model(frame, agnostic_nms=True, verbose=False, device=0)[0]
-        detections = sv.Detections.from_ultralytics(result)
-        labels = [
-            f"{model.model.names[class_id]}"
-            for _, _, _, class_id, _
-            in detections
-        ]
-
-        # We only want to detect one bird in the image as there could be multiple but the species given is only one.
-        # This could possibly select the wrong bird's species if there are 2 and the first label is the wrong bird's species.
-        already_found_bird = False
-        for label in labels:
-            if (label != "bird" or already_found_bird):
-                break
-
-            already_found_bird = True
+    species_id = SPECIES_LIST.index(args.s)
+
+    # Frames are decoded into preallocated buffers, held until their batch is run and their image
+    # written. When every buffer is in use, decoding waits for the writers
+    pool = FramePool((image_width, image_height),
+                     size=args.batch + 2 * args.writers + 1)
+    writer = ThreadPoolExecutor(
+        max_workers=args.writers) if args.writers > 0 else None
+    writes = []
+
+    def annotate_batch(batch, budget=None):
+        """
+        Saves the frames of the batch with a bird, at most `budget` of them. Returns the number saved.
+        """
+        saved = 0
+        # One forward pass for the whole batch
+        results = model([frame for _, frame in batch],
+                        agnostic_nms=True, verbose=False, device=0)
+
+        for (frame_index, frame), result in zip(batch, results):
+            detections = sv.Detections.from_ultralytics(result)
+            labels = [
+                f"{model.model.names[class_id]}"
+                for _, _, _, class_id, _
+                in detections
+            ]
+
+            # We only want to detect one bird in the image as there could be multiple but the species given is only one.
+            # This could possibly select the wrong bird's species if there are 2 and the first label is the wrong bird's species.
+            if not labels or labels[0] != "bird" or (budget is not None and saved == budget):
+                pool.release(frame)
+                continue
+
+            if args.min_conf is not None and detections.confidence[0] < args.min_conf:
+                pool.release(frame)
+                continue
 
             x1, y1, x2, y2 = detections[0].xyxy[0][:4]
 
-            class_id = SPECIES_LIST.index(args.s)
-
-            frame_id = f"{frame_count:04}"
+            frame_id = f"{frame_index:04}"
 
             # Combine the timestamp and frame_id to create a 12-character identifier
             unique_id = f"{args.n:08}{frame_id}"
@@ -157,14 +294,58 @@ def main():
             image_path = os.path.join(image_dir, f"{unique_id}.jpg")
             label_path = os.path.join(label_dir, f"{unique_id}.txt")
 
+            bird_annotation = create_bird_annotation(
+                species_id, x1, y1, x2, y2, image_width, image_height)
+
+            if cache_writer is not None:
+                cache_writer.add(unique_id, frame, [
+                                 float(value) for value in bird_annotation.split()])
+
             # Save the image and label with the unique identifier
-            save_image(image_path, frame)
-            save_label(label_path, create_bird_annotation(
-                class_id, x1, y1, x2, y2, image_width, image_height))
+            if args.no_jpeg:
+                pool.release(frame)
+            elif writer is None:
+                save_frame(image_path, label_path, frame, bird_annotation)
+                pool.release(frame)
+            else:
+                future = writer.submit(
+                    save_frame, image_path, label_path, frame, bird_annotation)
+                future.add_done_callback(
+                    lambda _, frame=frame: pool.release(frame))
+                writes.append(future)
+            saved += 1
+
+        return saved
+
+    # With a budget, decoding and inference stop as soon as k frames are saved
+    if args.k is not None:
+        frames = budget_frames(args.i, cap, pool, args.k)
+    else:
+        frames = sequential_frames(cap, pool)
+
+    saved = 0
+    batch = []
+    for frame_index, frame in frames:
+        batch.append((frame_index, frame))
+        if len(batch) == args.batch:
+            saved += annotate_batch(batch,
+                                    None if args.k is None else args.k - saved)
+            batch = []
+            if args.k is not None and saved >= args.k:
+                break
 
-        frame_count += 1
+    if batch:
+        saved += annotate_batch(batch,
+                                None if args.k is None else args.k - saved)
 
     cap.release()
+    if writer is not None:
+        writer.shutdown(wait=True)
+        # Raises the errors of the writer threads
+        for future in writes:
+            future.result()
+    if cache_writer is not None:
+        cache_writer.close()
 
 
 if __name__ == "__main__":
@@ -1,8 +1,156 @@
 import argparse
 import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from tqdm import tqdm
 import shutil
-import json
+
+from autotune import set_profile_defaults
+from species_store import DEFAULT_JSON_PATH, DEFAULT_STORE_PATH, open_store
+from work_queue import WorkQueue, commit_staged, run_worker
+
+
+def video_local_path(video_path):
+    # We don't need the name of the folder where videos are stored,
+    # we need to join the strings since it'll give a list,
+    # we also need to change the extension since the db file is with h264
+    return "/".join(video_path.split("/")[1:]).replace(".mp4", ".h264")
+
+
+def annotate_video(video_path, number_video, entry, output_folder, args):
+    """
+    Runs create_annotated_video.py on one video, returns the return code of the command.
+    """
+    # Define the arguments to pass
+    script_command = [
+        "python",  # Command to run Python
+        "create_annotated_video.py",  # Name of your script
+        "-i", video_path,  # Video path
+        "-o", output_folder,  # Output folder
+        # Actual species to annotate
+        "-s", f'"{entry["species"]}"',
+        "-n", str(number_video),  # Number of the video
+        "-p", str(args.p),  # Probability of being in the train set
+    ]
+
+    # Conditionally add the -t argument if it's True
+    if entry["test"] == "True":
+        script_command.extend(["-t"])
+
+    if args.seed is not None:
+        script_command.extend(["-seed", str(args.seed)])
+    for name in ["batch", "writers", "threads", "k"]:
+        if getattr(args, name) is not None:
+            script_command.extend([f"-{name}", str(getattr(args, name))])
+    if args.min_conf is not None:
+        script_command.extend(["-min-conf", str(args.min_conf)])
+    if args.cache_imgsz is not None:
+        script_command.extend(
+            ["--cache-imgsz", str(args.cache_imgsz)])
+    if args.no_jpeg:
+        script_command.extend(["--no-jpeg"])
+
+    # Execute the combined command using os.system
+    full_command = " ".join(script_command)
+    return os.system(full_command)
+
+
+def create_sequentially(list_videos_path, store, args):
+    # The store is only read from this thread
+    videos = []
+    for number_video, video_path in enumerate(list_videos_path):
+        local_path = video_local_path(video_path)
+        entry = store.get(local_path)
+        if entry is None:
+            print(f"{local_path} is not in the store. Skipping...")
+            continue
+        videos.append((number_video, video_path, entry))
+
+    interrupted = threading.Event()
+
+    def process(video):
+        if interrupted.is_set():
+            return
+        number_video, video_path, entry = video
+        return_code = annotate_video(
+            video_path, number_video, entry, args.o, args)
+
+        if return_code != 0:
+            print(
+                f"Error encountered while processing {video_path}. Skipping...")
+
+        if return_code == 2:
+            interrupted.set()
+
+    # Several videos at the same time with -jobs, each in its own process
+    with ThreadPoolExecutor(max_workers=args.jobs) as executor:
+        try:
+            for _ in tqdm(executor.map(process, videos), total=len(videos)):
+                pass
+        except KeyboardInterrupt:
+            interrupted.set()
+
+    if interrupted.is_set():
+        print("Process interrupted. Exiting...")
+
+
+def create_distributed(list_videos_path, store, args):
+    """
+    Processes the videos claimed through the work queue shared by every worker. The outputs of a
+    video are written to a staging folder and moved into the dataset once the video is finished,
+    so the dataset never contains part of a video, even if the worker crashes.
+    """
+    queue = WorkQueue(args.queue or os.path.join(args.o, ".queue"),
+                      args.worker_id, args.lease_ttl)
+    tasks = {f"{number_video:08}": video_path
+             for number_video, video_path in enumerate(list_videos_path)}
+
+    def process(task, video_path, lease):
+        local_path = video_local_path(video_path)
+        entry = store.get(local_path)
+        if entry is None:
+            print(f"{local_path} is not in the store. Skipping...")
+            return "skipped"
+
+        staging_folder = os.path.join(
+            args.o, ".staging", f"{queue.worker_id}-{task}")
+        shutil.rmtree(staging_folder, ignore_errors=True)
+        return_code = annotate_video(
+            video_path, int(task), entry, staging_folder, args)
+
+        if return_code == 2:
+            shutil.rmtree(staging_folder, ignore_errors=True)
+            raise KeyboardInterrupt
+        if return_code != 0:
+            print(
+                f"Error encountered while processing {video_path}. Skipping...")
+            shutil.rmtree(staging_folder, ignore_errors=True)
+            return "failed"
+
+        # Taken over by another worker while this one was too slow to renew the lease
+        if not queue.owns(lease):
+            shutil.rmtree(staging_folder, ignore_errors=True)
+            return None
+
+        commit_staged(staging_folder, args.o)
+        return "done"
+
+    print(f"Worker {queue.worker_id} joining the queue in {queue.folder}")
+    with queue:
+        try:
+            processed = run_worker(queue, tasks, process)
+        except KeyboardInterrupt:
+            print("Process interrupted. Exiting...")
+            return
+        print(f"Every video is done, {processed} processed by this worker")
+
+        # The frame cache is merged once, by the first worker claiming it
+        if args.cache_imgsz is not None:
+            lease = queue.claim("consolidate")
+            if lease is not None:
+                from frame_cache import consolidate
+                consolidate(args.o, args.cache_imgsz)
+                queue.complete(lease)
 
 
 def main():
@@ -16,8 +164,26 @@ def main():
     Args:
         -i (str): Input folder where preprocessed videos are located.
         -o (str): Output folder where annotated frames will be stored.
-        --db-file(str): Database to read from the species.
+        --store (str): Store of the selected videos, created by preprocess_and_copy_downloaded_data.
+        --json-file (str): Json dictionary imported into the store if the store doesn't exist yet.
         -p (float): Probability of a video to be in the train set (1 - p probability for validation).
+        --cache-imgsz (int): Also build the frame cache of frames letterboxed to this size (default: None).
+        --no-jpeg (bool): Only build the frame cache, without writing the full size images.
+        -seed (int): Seed of the train/validation split of each video (default: None, random; 0 when distributed).
+        --distributed (bool): Join the work queue shared by the workers building the same dataset, possibly on
+            other hosts. The output folder must be on a filesystem shared by every worker and isn't deleted.
+        --worker-id (str): Name of this worker (default: <hostname>-<pid>).
+        --lease-ttl (float): Seconds without heartbeat after which the video of a worker is given to another (default: 300).
+        --queue (str): Folder of the work queue (default: <output folder>/.queue).
+        -jobs (int): Number of videos annotated at the same time (default: 1).
+        -batch (int): Frames run through the model at once by create_annotated_video.py.
+        -writers (int): Threads writing the images in create_annotated_video.py.
+        -threads (int): Torch intra-op threads of each create_annotated_video.py process.
+        The defaults of -jobs, -batch, -writers and -threads come from the profile of autotune.py if there is one.
+        -k (int): Frames saved per video at most, spread over the video; the video stops being decoded once
+            they are saved (default: None, every frame).
+        -min-conf (float): Minimum confidence of the bird box for a frame to be saved (default: 0.7 with -k,
+            otherwise None, any).
 
     Returns:
         None
@@ -28,74 +194,82 @@ def main():
                         default="preprocessed_videos", help="Input folder where preprocessed videos are contained")
     parser.add_argument("-o", type=str,
                         default="created_dataset", help="Output folder where frames will be stored")
+    parser.add_argument("--store", type=str,
+                        default=DEFAULT_STORE_PATH, help="Store to read the species from, created by preprocess_and_copy_downloaded_data")
     parser.add_argument("--json-file", type=str,
-                        default="filtered_species_dict.json", help="Json to read from the species, created by preprocess_and_copy_downloaded_data")
+                        default=DEFAULT_JSON_PATH, help="Json to read from the species if the store doesn't exist yet")
     parser.add_argument("-p",  type=float, default=0.8,
                         help="Probability of being in the train folder. 1-p probability of being in validation folder")
+    parser.add_argument("--cache-imgsz", type=int, default=None,
+                        help="Also build the frame cache of frames letterboxed to this size, used by train_model.py -frame-cache")
+    parser.add_argument("--no-jpeg", action="store_true", default=False,
+                        help="Only build the frame cache, without writing the full size images. Requires --cache-imgsz")
+    parser.add_argument("-seed", type=int, default=None,
+                        help="Seed of the train/validation split of each video")
+    parser.add_argument("--distributed", action="store_true", default=False,
+                        help="Share the videos with the other workers building the same dataset through a work queue in the output folder")
+    parser.add_argument("--worker-id", type=str, default=None,
+                        help="Name of this worker, defaults to <hostname>-<pid>")
+    parser.add_argument("--lease-ttl", type=float, default=300.0,
+                        help="Seconds without heartbeat after which the video of a worker is given to another")
+    parser.add_argument("--queue", type=str, default=None,
+                        help="Folder of the work queue, defaults to <output folder>/.queue")
+    parser.add_argument("-jobs", type=int, default=1,
+                        help="Number of videos annotated at the same time")
+    parser.add_argument("-batch", type=int, default=None,
+                        help="Frames run through the model at once by create_annotated_video.py")
+    parser.add_argument("-writers", type=int, default=None,
+                        help="Threads writing the images in create_annotated_video.py")
+    parser.add_argument("-threads", type=int, default=None,
+                        help="Torch intra-op threads of each create_annotated_video.py process")
+    parser.add_argument("-k", type=int, default=None,
+                        help="Frames saved per video at most, the video stops being decoded once they are saved")
+    parser.add_argument("-min-conf", type=float, default=None,
+                        help="Minimum confidence of the bird box for a frame to be saved, 0.7 by default with -k")
+    set_profile_defaults(parser, "dataset", [
+                         "jobs", "batch", "writers", "threads"])
 
     args = parser.parse_args()
 
-    list_videos_path = [os.path.join(root, filename)
-                        for root, _, files in os.walk(args.i)
-                        for filename in files if filename.endswith(".mp4")]
+    if args.no_jpeg and args.cache_imgsz is None:
+        parser.error("--no-jpeg requires --cache-imgsz")
+
+    # Sorted so that every worker numbers the videos the same way
+    list_videos_path = sorted(os.path.join(root, filename)
+                              for root, _, files in os.walk(args.i)
+                              for filename in files if filename.endswith(".mp4"))
 
-    print("Reading the json dictionary file ...")
+    # A video taken over by another worker must go to the same split
+    if args.distributed and args.seed is None:
+        args.seed = 0
 
-    # Initialize an empty dictionary
-    species_dict = {}
+    print("Opening the species store ...")
 
-    # Read data from the JSON file and store it in the dictionary
-    with open(args.json_file, 'r', encoding="utf-8") as file:
-        species_dict = json.load(file)
+    # Videos are looked up one by one instead of loading the whole selection. Distributed workers
+    # only read the store, the hosts may share it over a network filesystem
+    store = open_store(args.store, args.json_file, read_only=args.distributed)
 
     print(f"{len(list_videos_path)} in total")
 
-    # Delete the entire folder and its contents if it exists
-    if os.path.exists(args.o):
+    # Delete the entire folder and its contents if it exists. Other workers are writing to it in the distributed mode
+    if os.path.exists(args.o) and not args.distributed:
         shutil.rmtree(args.o)
         print(f"Deleted existing {args.o} folder")
 
     print("Creating dataset ...")
 
-    # Iterate over list_videos_path
-    for number_video, video_path in tqdm(enumerate(list_videos_path), total=len(list_videos_path)):
-        try:
-            # We don't need the name of the folder where videos are stored,
-            # we need to join the strings since it'll give a list,
-            # we also need to change the extension since the db file is with h264
-            local_path = "/".join(video_path.split("/")
-                                  [1:]).replace(".mp4", ".h264")
-
-            # Define the arguments to pass
-            script_command = [
-                "python",  # Command to run Python
-                "create_annotated_video.py",  # Name of your script
-                "-i", video_path,  # Video path
-                "-o", args.o,  # Output folder
-                # Actual species to annotate
-                "-s", f'"{species_dict[local_path]["species"]}"',
-                "-n", str(number_video),  # Number of the video
-                "-p", str(args.p),  # Probability of being in the train set
-            ]
-
-            # Conditionally add the -t argument if it's True
-            if species_dict[local_path]["test"] == "True":
-                script_command.extend(["-t"])
-
-            # Execute the combined command using os.system
-            full_command = " ".join(script_command)
-            return_code = os.system(full_command)
-
-            if return_code != 0:
-                print(
-                    f"Error encountered while processing {video_path}. Skipping...")
-
-            if return_code == 2:
-                raise KeyboardInterrupt
+    if args.distributed:
+        create_distributed(list_videos_path, store, args)
+    else:
+        create_sequentially(list_videos_path, store, args)
 
-        except KeyboardInterrupt:
-            print("Process interrupted. Exiting...")
-            break
+        # Merge the frame cache shards written for every video
+        if args.cache_imgsz is not None:
+            # frame_cache imports ultralytics, only needed with a frame cache
+            from frame_cache import consolidate
+            consolidate(args.o, args.cache_imgsz)
+
+    store.close()
 
     print(f"Created dataset at {args.o}")
 
@@ -1,30 +1,45 @@
-import csv
 import argparse
 import matplotlib.pyplot as plt
+import numpy as np
 import os
 
+from db_aggregation import aggregate
+from db_cache import load_db
+
 # Would be better to average the species count for each species
 
 
-def find_feeder_with_most_species(species_per_feeder):
+def find_feeder_with_most_species(matrices):
     # Initialize variables to keep track of the feeder and species counts
     selected_feeder = None
     min_species_count = float('inf')
 
-    for feeder, data in species_per_feeder.items():
-        species_count = data['species_count']
+    species_counts = matrices.feeder_totals()
+    species_numbers = matrices.species_per_feeder()
 
+    for feeder, species_count in enumerate(species_counts):
         # Initialize selected_feeder with the first feeder encountered
         if selected_feeder is None:
             selected_feeder = feeder
             min_species_count = species_count
         else:
             # Check if this feeder has more species and fewer counts than the current minimum
-            if len(data['species_names']) > len(species_per_feeder[selected_feeder]['species_names']) and species_count < min_species_count:
+            if species_numbers[feeder] > species_numbers[selected_feeder] and species_count < min_species_count:
                 selected_feeder = feeder
                 min_species_count = species_count
 
-    return selected_feeder
+    if selected_feeder is None:
+        return None
+    return matrices.feeder_names[selected_feeder]
+
+
+def write_matrix(path, matrix, row_names, column_names, corner):
+    with open(path, "w", encoding="utf-8") as file:
+        file.write(corner + "\t" + "\t".join(str(name)
+                   for name in column_names) + "\n")
+        for name, row in zip(row_names, matrix):
+            file.write(f"{name}\t" + "\t".join(str(count)
+                       for count in row) + "\n")
 
 
 def main():
@@ -46,99 +61,75 @@ def main():
     output_folder = args.output_folder
     os.makedirs(output_folder, exist_ok=True)
 
-   # Create a dictionary to store species per feeder
-    species_per_feeder = {}
-
-    # Read the data from the file
-    with open(input_file, mode="r", newline="", encoding="utf-8") as file:
-        reader = csv.DictReader(file, delimiter="\t")
-        for row in reader:
-            species = row["species"]
-            # Assuming "feeder" is the column name in your CSV
-            feeder = row["feeder"]
-
-            if feeder not in species_per_feeder:
-                species_per_feeder[feeder] = {
-                    "species_count": 0, "species_names": [], "species_counts": {}}
-
-            if species != 'NA':
-                species_per_feeder[feeder]["species_count"] += 1
+    # Read the data from the columnar cache of the file and count it in one pass
+    db = load_db(input_file)
+    matrices = aggregate(db)
 
-                if species not in species_per_feeder[feeder]["species_names"]:
-                    species_per_feeder[feeder]["species_names"].append(species)
-
-                if species not in species_per_feeder[feeder]["species_counts"]:
-                    species_per_feeder[feeder]["species_counts"][species] = 1
-                else:
-                    species_per_feeder[feeder]["species_counts"][species] += 1
-
-    # Calculate basic statistics
-    total_feeders = len(species_per_feeder)
-    unique_species = set(species for data in species_per_feeder.values()
-                         for species in data["species_names"])
+    species_totals = matrices.species_totals()
+    seen_species = np.flatnonzero(species_totals)
 
     # Print basic statistics
     print("Basic Statistics:")
-    print(f"Total Feeder: {total_feeders}")
-    print(f"Unique Species: {len(unique_species)}")
+    print(f"Total Feeder: {len(matrices.feeder_names)}")
+    print(f"Unique Species: {len(seen_species)}")
 
-    # Count occurrences of each species by feeder
-    species_counts_by_feeder = {}
-    for feeder, data in species_per_feeder.items():
-        species_counts_by_feeder[feeder] = data["species_count"]
+    for feeder, feeder_name in enumerate(matrices.feeder_names):
+        counts = matrices.feeder_species[feeder]
+        feeder_species = np.flatnonzero(counts)
 
-    for feeder, data in species_per_feeder.items():
-        print(f"Feeder: {feeder}")
-        print(f"Total of Species Counted: {data['species_count']}")
-        print(f"Species Names: {', '.join(data['species_names'])}\n")
+        print(f"Feeder: {feeder_name}")
+        print(f"Total of Species Counted: {counts.sum()}")
+        print(
+            f"Species Names: {', '.join(matrices.species_names[feeder_species])}\n")
 
         # Print counts of each species for the current feeder
         print("Species Counts:")
-        for species, count in data["species_counts"].items():
-            print(f"{species}: {count}")
+        for species in feeder_species:
+            print(f"{matrices.species_names[species]}: {counts[species]}")
 
         print()
 
     # Print species occurrences by feeder
     print("\nSpecies Occurrences by Feeder:")
-    for feeder, data in species_per_feeder.items():
-        print(f"Feeder: {feeder}")
-        for species, count in data["species_counts"].items():
-            print(f"{species}: {count} times")
+    for feeder, feeder_name in enumerate(matrices.feeder_names):
+        counts = matrices.feeder_species[feeder]
+        print(f"Feeder: {feeder_name}")
+        for species in np.flatnonzero(counts):
+            print(f"{matrices.species_names[species]}: {counts[species]} times")
         print()
 
+    # Print occurrences by year
+    print("\nOccurrences by Year:")
+    for year, count in zip(matrices.years, matrices.species_year.sum(axis=0)):
+        print(f"{year}: {count}")
+
     # Call the function to find the feeder
-    selected_feeder = find_feeder_with_most_species(species_per_feeder)
+    selected_feeder = find_feeder_with_most_species(matrices)
     print(f"Feeder with the most species and lowest counts: {selected_feeder}")
 
-    # Create a bar chart for species occurrences
-    plt.figure(figsize=(10, 6))
-    species_counts_by_species = {}
-    for data in species_per_feeder.values():
-        for species, count in data["species_counts"].items():
-            if species in species_counts_by_species:
-                species_counts_by_species[species] += count
-            else:
-                species_counts_by_species[species] = count
-
     # Open a text file for writing
     with open(os.path.join(output_folder, "species_occurrences.txt"), "w") as file:
         # Write header
         file.write("Species\tOccurrences\n")
 
         # Write species and occurrences to the file
-        for species, count in species_counts_by_species.items():
-            file.write(f"{species}\t{count}\n")
+        for species in seen_species:
+            file.write(
+                f"{matrices.species_names[species]}\t{species_totals[species]}\n")
+
+    # Save the per year matrices next to it
+    write_matrix(os.path.join(output_folder, "species_occurrences_per_year.txt"),
+                 matrices.species_year[seen_species], matrices.species_names[seen_species], matrices.years, "Species")
+    write_matrix(os.path.join(output_folder, "feeder_occurrences_per_year.txt"),
+                 matrices.feeder_year, matrices.feeder_names, matrices.years, "Feeder")
 
     # Filter species with occurrences <= 200
-    filtered_species_counts = {
-        species: count
-        for species, count in species_counts_by_species.items()
-        if count > 200
-    }
-
-    # Create the bar chart
-    plt.bar(filtered_species_counts.keys(), filtered_species_counts.values())
+    filtered_species = np.flatnonzero(species_totals > 200)
+
+    # Create a bar chart for species occurrences
+    plt.figure(figsize=(10, 6))
+    plt.bar(matrices.species_names[filtered_species],
+            species_totals[filtered_species])
     plt.xlabel("Species")
     plt.ylabel("Occurrences")
     plt.title("Species Occurrences (Occurrences > 200)")
@@ -149,6 +140,25 @@ def main():
     chart_filename = os.path.join(output_folder, "species_occurrences.png")
     plt.savefig(chart_filename)
 
+    # Same species, split by year
+    plt.figure(figsize=(10, 6))
+    bottom = np.zeros(len(filtered_species))
+    for column, year in enumerate(matrices.years):
+        counts = matrices.species_year[filtered_species, column]
+        plt.bar(matrices.species_names[filtered_species],
+                counts, bottom=bottom, label=str(year))
+        bottom += counts
+    plt.xlabel("Species")
+    plt.ylabel("Occurrences")
+    plt.title("Species Occurrences per Year (Occurrences > 200)")
+    plt.xticks(rotation=45, ha="right")
+    plt.legend()
+    plt.tight_layout()
+
+    chart_filename = os.path.join(
+        output_folder, "species_occurrences_per_year.png")
+    plt.savefig(chart_filename)
+
     plt.show()
 
 
@@ -0,0 +1,70 @@
+import numpy as np
+
+# Rows read at once, keeps memory bounded whatever the size of the database
+DEFAULT_CHUNK_SIZE = 1 << 22
+
+
+class CountMatrices:
+    """
+    Occurrence counts of the database grouped two by two.
+
+    feeder_species[f, s], species_year[s, y] and feeder_year[f, y] are indexed by the codes
+    of the database cache for feeders and species and by the position in `years` for years.
+    """
+
+    def __init__(self, cube, species_names, feeder_names, years):
+        self.feeder_species = cube.sum(axis=2)
+        self.species_year = cube.sum(axis=0)
+        self.feeder_year = cube.sum(axis=1)
+        self.species_names = species_names
+        self.feeder_names = feeder_names
+        self.years = years
+
+    def species_totals(self):
+        return self.feeder_species.sum(axis=0)
+
+    def feeder_totals(self):
+        return self.feeder_species.sum(axis=1)
+
+    def species_per_feeder(self):
+        # Number of distinct species seen at each feeder
+        return np.count_nonzero(self.feeder_species, axis=1)
+
+
+def aggregate(db, excluded_species=("NA",), chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Counts the rows of the database per feeder, species and year in a single pass over
+    the columns. Rows whose species is in `excluded_species` are not counted but their
+    feeder and year are still listed.
+    """
+    n_species = len(db.species_names)
+    n_feeders = len(db.feeder_names)
+
+    if len(db) == 0:
+        years = np.zeros(0, dtype=np.int16)
+        cube = np.zeros((n_feeders, n_species, 0), dtype=np.int64)
+        return CountMatrices(cube, db.species_names, db.feeder_names, years)
+
+    first_year = int(db.year.min())
+    n_years = int(db.year.max()) - first_year + 1
+    counted = ~np.isin(db.species_names, excluded_species)
+
+    # Every row falls into one cell of the feeder x species x year cube
+    cube = np.zeros(n_feeders * n_species * n_years, dtype=np.int64)
+    seen_years = np.zeros(n_years, dtype=bool)
+    for start in range(0, len(db), chunk_size):
+        species = db.species[start:start + chunk_size]
+        feeder = db.feeder[start:start + chunk_size]
+        year = db.year[start:start + chunk_size] - first_year
+        seen_years[year] = True
+
+        cells = (feeder.astype(np.int64) * n_species + species) * \
+            n_years + year
+        cube += np.bincount(cells, weights=counted[species],
+                            minlength=len(cube)).astype(np.int64)
+
+    # Years without any row in the database are dropped
+    cube = cube.reshape(n_feeders, n_species, n_years)[:, :, seen_years]
+    years = np.arange(first_year, first_year + n_years)[seen_years]
+
+    return CountMatrices(cube, db.species_names, db.feeder_names, years)
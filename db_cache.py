@@ -0,0 +1,230 @@
+import argparse
+import csv
+import hashlib
+import json
+import os
+import shutil
+
+import numpy as np
+
+CACHE_VERSION = 1
+
+# Columns of the database file kept in the cache
+DICTIONARY_COLUMNS = ["species", "feeder"]
+STRING_COLUMNS = ["date", "local_path"]
+
+
+class DbCache:
+    """
+    Columnar view of the database file.
+
+    species and feeder are dictionary encoded: `species` holds an int32 code per row and
+    `species_names[code]` gives back the original string. Codes follow the order of first
+    appearance in the file. Every array is memory mapped from the cache folder.
+    """
+
+    def __init__(self, columns, meta):
+        self.species = columns["species"]
+        self.species_names = columns["species_names"]
+        self.feeder = columns["feeder"]
+        self.feeder_names = columns["feeder_names"]
+        self.year = columns["year"]
+        self.date = columns["date"]
+        self.local_path = columns["local_path"]
+        self.meta = meta
+
+    def __len__(self):
+        return len(self.species)
+
+    def select(self, rows):
+        """
+        View of the rows kept by `rows` (boolean mask or indices), codes and names are unchanged.
+        """
+        columns = {name: getattr(self, name)[rows] for name in
+                   ["species", "feeder", "year", "date", "local_path"]}
+        columns["species_names"] = self.species_names
+        columns["feeder_names"] = self.feeder_names
+        return DbCache(columns, self.meta)
+
+
+def default_cache_folder(tsv_file):
+    return tsv_file + ".cache"
+
+
+def file_hash(path, chunk_size=1 << 20):
+    sha1 = hashlib.sha1()
+    with open(path, "rb") as file:
+        while True:
+            chunk = file.read(chunk_size)
+            if not chunk:
+                break
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def read_meta(cache_folder):
+    meta_path = os.path.join(cache_folder, "meta.json")
+    if not os.path.exists(meta_path):
+        return None
+
+    with open(meta_path, "r", encoding="utf-8") as file:
+        return json.load(file)
+
+
+def write_meta(cache_folder, meta):
+    # Write next to the final file then rename so a reader never sees a partial meta.json
+    tmp_path = os.path.join(cache_folder, "meta.json.tmp")
+    with open(tmp_path, "w", encoding="utf-8") as file:
+        json.dump(meta, file, indent=2)
+    os.replace(tmp_path, os.path.join(cache_folder, "meta.json"))
+
+
+def is_cache_valid(tsv_file, cache_folder):
+    meta = read_meta(cache_folder)
+    if meta is None or meta.get("version") != CACHE_VERSION:
+        return False
+
+    stat = os.stat(tsv_file)
+    if meta["size"] == stat.st_size and meta["mtime_ns"] == stat.st_mtime_ns:
+        return True
+
+    # The file was touched (copied, synced, ...) but may still hold the same content
+    if meta["size"] != stat.st_size or meta["sha1"] != file_hash(tsv_file):
+        return False
+
+    meta["mtime_ns"] = stat.st_mtime_ns
+    write_meta(cache_folder, meta)
+    return True
+
+
+def encode(value, categories):
+    # Dictionary encoding in order of first appearance
+    code = categories.get(value)
+    if code is None:
+        code = len(categories)
+        categories[value] = code
+    return code
+
+
+def build_cache(tsv_file, cache_folder=None):
+    if cache_folder is None:
+        cache_folder = default_cache_folder(tsv_file)
+
+    stat = os.stat(tsv_file)
+    categories = {column: {} for column in DICTIONARY_COLUMNS}
+    codes = {column: [] for column in DICTIONARY_COLUMNS}
+    strings = {column: [] for column in STRING_COLUMNS}
+    years = []
+
+    with open(tsv_file, mode="r", newline="", encoding="utf-8") as file:
+        reader = csv.DictReader(file, delimiter="\t")
+        for row in reader:
+            for column in DICTIONARY_COLUMNS:
+                codes[column].append(
+                    encode(row[column], categories[column]))
+            for column in STRING_COLUMNS:
+                strings[column].append(row[column])
+            years.append(int(row["date"].split("-")[0]))
+
+    # Build in a temporary folder and swap it in once complete
+    tmp_folder = f"{cache_folder}.tmp-{os.getpid()}"
+    if os.path.exists(tmp_folder):
+        shutil.rmtree(tmp_folder)
+    os.makedirs(tmp_folder)
+
+    for column in DICTIONARY_COLUMNS:
+        np.save(os.path.join(tmp_folder, f"{column}.npy"),
+                np.asarray(codes[column], dtype=np.int32))
+        np.save(os.path.join(tmp_folder, f"{column}_names.npy"),
+                np.asarray(list(categories[column]), dtype=str))
+    for column in STRING_COLUMNS:
+        np.save(os.path.join(tmp_folder, f"{column}.npy"),
+                np.asarray(strings[column], dtype=str))
+    np.save(os.path.join(tmp_folder, "year.npy"),
+            np.asarray(years, dtype=np.int16))
+
+    write_meta(tmp_folder, {
+        "version": CACHE_VERSION,
+        "source": os.path.abspath(tsv_file),
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+        "sha1": file_hash(tsv_file),
+        "rows": len(years),
+    })
+
+    if os.path.exists(cache_folder):
+        shutil.rmtree(cache_folder)
+    os.replace(tmp_folder, cache_folder)
+
+    return cache_folder
+
+
+def load_db(tsv_file, cache_folder=None, rebuild=False):
+    """
+    Loads the database file through its columnar cache, (re)building the cache when it
+    is missing or when the database file changed since it was built.
+    """
+    if cache_folder is None:
+        cache_folder = default_cache_folder(tsv_file)
+
+    if rebuild or not is_cache_valid(tsv_file, cache_folder):
+        print(f"Building database cache for {tsv_file} ...")
+        build_cache(tsv_file, cache_folder)
+
+    columns = {}
+    for column in DICTIONARY_COLUMNS:
+        columns[column] = np.load(os.path.join(
+            cache_folder, f"{column}.npy"), mmap_mode="r")
+        columns[f"{column}_names"] = np.load(
+            os.path.join(cache_folder, f"{column}_names.npy"))
+    for column in STRING_COLUMNS + ["year"]:
+        columns[column] = np.load(os.path.join(
+            cache_folder, f"{column}.npy"), mmap_mode="r")
+
+    return DbCache(columns, read_meta(cache_folder))
+
+
+def recode(codes, names, transform):
+    """
+    Applies `transform` to the dictionary of a dictionary encoded column and merges the
+    entries that become equal. Returns the new codes and the new dictionary.
+    """
+    transformed = np.asarray([transform(name) for name in names], dtype=str)
+    new_names, first_index, mapping = np.unique(
+        transformed, return_index=True, return_inverse=True)
+
+    # Keep the order of first appearance instead of the alphabetical one
+    order = np.argsort(first_index, kind="stable")
+    rank = np.empty_like(order)
+    rank[order] = np.arange(len(order))
+
+    return rank[mapping.ravel()][codes], new_names[order]
+
+
+def main():
+    """
+    Builds the columnar cache of the database file used by database_statistics.py and
+    preprocess_and_copy_downloaded_data.py. Both scripts build it on their own when needed,
+    this is only useful to prepare it ahead of time.
+
+    Args:
+        --db-file (str): Database file to convert (default: db_file.tsv).
+        --cache-folder (str): Folder of the cache (default: <db-file>.cache).
+        --force (bool): Rebuild even if the cache is up to date.
+    """
+    parser = argparse.ArgumentParser(
+        description="Build the columnar cache of the database file")
+    parser.add_argument("--db-file", type=str,
+                        default="db_file.tsv", help="Database file to convert")
+    parser.add_argument("--cache-folder", type=str, default=None,
+                        help="Folder of the cache. Defaults to <db-file>.cache")
+    parser.add_argument("--force", action="store_true", default=False,
+                        help="Rebuild even if the cache is up to date")
+    args = parser.parse_args()
+
+    db = load_db(args.db_file, args.cache_folder, rebuild=args.force)
+    print(f"{len(db)} rows, {len(db.species_names)} species, {len(db.feeder_names)} feeders")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,240 @@
+import json
+import os
+import time
+
+import cv2
+import numpy as np
+import torch
+import torch.nn.functional as F
+from ultralytics import YOLO
+from ultralytics.models.yolo.detect import DetectionTrainer
+from ultralytics.utils import LOGGER
+from ultralytics.utils.loss import v8DetectionLoss
+from ultralytics.utils.torch_utils import de_parallel
+
+from species_vote import most_common_value
+from species_store import open_store
+
+
+class DistillationLoss(v8DetectionLoss):
+    """
+    Detection loss of the student plus a distillation term matching the outputs of the teacher head.
+
+    Both heads output, for every position of every level, the box distributions (4 * reg_max
+    channels) followed by the class logits (nc channels). Class scores are matched with a binary
+    cross entropy on the softened teacher scores and box distributions with a KL divergence.
+    Positions are weighted by the confidence of the teacher so that the background doesn't dominate.
+    """
+
+    def __init__(self, model, teacher, weight=1.0, temperature=2.0):
+        super().__init__(model)
+        self.teacher = teacher
+        self.weight = weight
+        self.temperature = temperature
+
+    def __call__(self, preds, batch):
+        loss, loss_items = super().__call__(preds, batch)
+
+        feats = preds[1] if isinstance(preds, tuple) else preds
+        with torch.no_grad():
+            teacher_feats = self.teacher(batch["img"])[1]
+
+        distillation = sum(self.level_loss(student.float(), teacher.float())
+                           for student, teacher in zip(feats, teacher_feats))
+
+        # The detection loss is scaled by the batch size, keep the same scale
+        return loss + self.weight * distillation * batch["img"].shape[0], loss_items
+
+    def level_loss(self, student, teacher):
+        T = self.temperature
+        batch_size, _, height, width = student.shape
+        box_channels = self.reg_max * 4
+
+        student_box, student_cls = student.split((box_channels, self.nc), 1)
+        teacher_box, teacher_cls = teacher.split((box_channels, self.nc), 1)
+
+        # Weight of each position: best class score of the teacher
+        weights = teacher_cls.sigmoid().amax(1).flatten()
+        weights = weights / weights.sum().clamp(min=1e-6)
+
+        cls_loss = F.binary_cross_entropy_with_logits(
+            student_cls / T, (teacher_cls / T).sigmoid(), reduction="none").sum(1).flatten()
+
+        student_box = student_box.view(
+            batch_size, 4, self.reg_max, height, width)
+        teacher_box = teacher_box.view(
+            batch_size, 4, self.reg_max, height, width)
+        box_loss = F.kl_div(F.log_softmax(student_box / T, dim=2), F.softmax(
+            teacher_box / T, dim=2), reduction="none").sum((1, 2)).flatten()
+
+        return (weights * (cls_loss + box_loss)).sum() * T * T
+
+
+def load_teacher(teacher_path, device):
+    teacher = YOLO(teacher_path).model.float().to(device)
+    teacher.eval()
+    for parameter in teacher.parameters():
+        parameter.requires_grad = False
+    return teacher
+
+
+def class_names(model):
+    # Dictionary class id -> name, ultralytics stores either a dictionary or a list
+    names = getattr(model, "names", None) or {}
+    return dict(names) if isinstance(names, dict) else dict(enumerate(names))
+
+
+def make_distillation_trainer(teacher_path, weight=1.0, temperature=2.0, base=DetectionTrainer):
+    """
+    Returns a trainer class, derived from `base`, whose student is trained with DistillationLoss.
+    ultralytics only accepts its own arguments, so the teacher is given through the class.
+    """
+
+    class DistillationTrainer(base):
+
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            self.add_callback("on_train_start", self.attach_teacher)
+
+        @staticmethod
+        def attach_teacher(trainer):
+            student = de_parallel(trainer.model)
+            teacher = load_teacher(teacher_path, trainer.device)
+
+            # Number of classes of the Detect heads
+            teacher_nc, student_nc = teacher.model[-1].nc, student.model[-1].nc
+            if teacher_nc != student_nc:
+                raise ValueError(
+                    f"The teacher predicts {teacher_nc} classes but the student {student_nc}, they must be trained on the same dataset")
+
+            # Same number of classes isn't enough: class ids follow the order of the species of the
+            # dataset, a teacher trained with another order would distil the logits of other species
+            teacher_names, student_names = class_names(teacher), class_names(student)
+            if teacher_names != student_names:
+                mismatches = [(class_id, teacher_names.get(class_id), student_names.get(class_id))
+                              for class_id in sorted(set(teacher_names) | set(student_names))
+                              if teacher_names.get(class_id) != student_names.get(class_id)]
+                raise ValueError(
+                    f"The classes of the teacher and the student differ (class id, teacher, student): {mismatches[:5]}, "
+                    "they must be trained on the same dataset")
+
+            # The model creates its criterion only if it has none
+            student.criterion = DistillationLoss(
+                student, teacher, weight, temperature)
+            LOGGER.info(
+                f"Distilling {teacher_path} into the student (weight {weight}, temperature {temperature})")
+
+    return DistillationTrainer
+
+
+def read_sample_frames(video_path, number_frames):
+    cap = cv2.VideoCapture(video_path)
+    frames = []
+    while len(frames) < number_frames:
+        ret, frame = cap.read()
+        if not ret:
+            break
+        frames.append(frame)
+    cap.release()
+    return frames
+
+
+def cpu_latency(model, frames, imgsz, warmup=5):
+    for frame in frames[:warmup]:
+        model(frame, imgsz=imgsz, device="cpu", verbose=False)
+
+    latencies = []
+    for frame in frames:
+        start_time = time.perf_counter()
+        model(frame, imgsz=imgsz, device="cpu", verbose=False)
+        latencies.append(time.perf_counter() - start_time)
+
+    return float(np.median(latencies)) * 1000
+
+
+def video_species_accuracy(model, test_videos, imgsz, frame_stride):
+    correct = 0
+    for video_path, species in test_videos:
+        cap = cv2.VideoCapture(video_path)
+        predicted_labels = []
+        frame_count = 0
+        while True:
+            ret, frame = cap.read()
+            if not ret:
+                break
+            if frame_count % frame_stride == 0:
+                # Same decision rule as main.py
+                result = model(frame, imgsz=imgsz, agnostic_nms=True,
+                               conf=0.7, verbose=False)[0]
+                if result.boxes.cls.numel() == 0:
+                    predicted_labels.append(None)
+                else:
+                    for c in result.boxes.cls:
+                        predicted_labels.append(model.names[int(c)])
+            frame_count += 1
+        cap.release()
+
+        if most_common_value(predicted_labels) == species:
+            correct += 1
+
+    return correct / len(test_videos) if test_videos else None
+
+
+def list_test_videos(videos_folder, store_path, max_videos):
+    test_videos = []
+    # Without the store the video accuracy is n/a, the rest of the report is still written
+    try:
+        store = open_store(store_path)
+    except FileNotFoundError as e:
+        print(f"{e}. The video accuracy can't be measured")
+        return test_videos
+
+    with store:
+        for local_path in store.paths(split="test"):
+            # The store keeps the .h264 name of the database, the files are .mp4
+            video_path = os.path.join(
+                videos_folder, local_path.replace(".h264", ".mp4"))
+            if os.path.exists(video_path):
+                test_videos.append(
+                    (video_path, store.get(local_path)["species"]))
+            if len(test_videos) >= max_videos:
+                break
+    return test_videos
+
+
+def compare_models(models, data, imgsz, videos_folder, store_path, output_file,
+                   latency_frames=50, max_videos=50, frame_stride=5):
+    """
+    Measures CPU latency per frame, mAP and video level species accuracy of each model and
+    writes the comparison to output_file as JSON.
+    """
+    test_videos = list_test_videos(videos_folder, store_path, max_videos)
+    sample_video = test_videos[0][0] if test_videos else "input_files/video.mp4"
+    frames = read_sample_frames(sample_video, latency_frames)
+
+    report = {}
+    for role, model_path in models.items():
+        model = YOLO(model_path)
+        latency = cpu_latency(model, frames, imgsz)
+        metrics = model.val(data=data, imgsz=imgsz, split="test",
+                            plots=False, verbose=False)
+        report[role] = {
+            "model": model_path,
+            "cpu_latency_ms": latency,
+            "cpu_fps": 1000 / latency,
+            "map50": float(metrics.box.map50),
+            "map50_95": float(metrics.box.map),
+            "video_accuracy": video_species_accuracy(model, test_videos, imgsz, frame_stride),
+        }
+
+    with open(output_file, "w", encoding="utf-8") as file:
+        json.dump(report, file, indent=2)
+
+    print(f"{'':10}{'CPU ms/frame':>14}{'CPU FPS':>10}{'mAP50':>8}{'mAP50-95':>10}{'Video acc.':>12}")
+    for role, entry in report.items():
+        video_accuracy = "n/a" if entry["video_accuracy"] is None else f"{entry['video_accuracy']:.3f}"
+        print(f"{role:10}{entry['cpu_latency_ms']:14.1f}{entry['cpu_fps']:10.1f}{entry['map50']:8.3f}"
+              f"{entry['map50_95']:10.3f}{video_accuracy:>12}")
+    print(f"{len(test_videos)} test videos used for the video accuracy. Report saved to {output_file}")
+
+    return report
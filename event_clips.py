@@ -0,0 +1,202 @@
+import json
+import os
+import queue
+import shutil
+import subprocess
+import threading
+from collections import Counter, deque
+
+import cv2
+
+
+class ClipEncoder:
+    """
+    Encodes one clip, either with cv2.VideoWriter (mp4v) or by piping raw frames to ffmpeg.
+    """
+
+    def __init__(self, path, fps, frame_size, use_ffmpeg=False, preset="veryfast"):
+        self.process = None
+        self.writer = None
+        width, height = frame_size
+
+        if use_ffmpeg:
+            self.process = subprocess.Popen(
+                ["ffmpeg", "-loglevel", "error", "-y",
+                 "-f", "rawvideo", "-pix_fmt", "bgr24", "-s", f"{width}x{height}", "-r", str(fps),
+                 "-i", "-", "-c:v", "libx264", "-preset", preset, "-pix_fmt", "yuv420p", path],
+                stdin=subprocess.PIPE)
+        else:
+            fourcc = cv2.VideoWriter_fourcc(*"mp4v")
+            self.writer = cv2.VideoWriter(path, fourcc, fps, frame_size)
+            if not self.writer.isOpened():
+                raise OSError(f"Could not open {path} for writing")
+
+    def write(self, frame):
+        if self.process is not None:
+            self.process.stdin.write(frame.tobytes())
+        else:
+            self.writer.write(frame)
+
+    def close(self):
+        if self.process is not None:
+            try:
+                self.process.stdin.close()
+            finally:
+                self.process.wait()
+        else:
+            self.writer.release()
+
+
+class EventClipWriter:
+    """
+    Writes only clips around detections instead of the whole video.
+
+    The last `pre_roll` frames are kept in a bounded ring buffer. When a frame has a detection a clip
+    starts with those frames, and it ends once `post_roll` frames in a row have no detection. Frames
+    are encoded by a background thread so encoding doesn't slow down inference, and an index of the
+    events (timestamps, species) is written as a JSON sidecar.
+
+    Frames are kept by reference. With `release`, each frame is given back (e.g. to a FramePool)
+    once it is encoded or dropped from the pre-roll, at most `max_frames_held()` at a time.
+    """
+
+    def __init__(self, output_folder, fps, frame_size, pre_roll=2.0, post_roll=2.0,
+                 use_ffmpeg=False, preset="veryfast", max_queue=64, release=None):
+        self.output_folder = output_folder
+        self.fps = fps
+        self.frame_size = frame_size
+        self.use_ffmpeg = use_ffmpeg
+        self.preset = preset
+        self.max_queue = max_queue
+        self.release = release
+        if use_ffmpeg and shutil.which("ffmpeg") is None:
+            raise FileNotFoundError("ffmpeg was not found in the PATH")
+
+        self.pre_roll_frames = int(round(pre_roll * fps))
+        self.post_roll_frames = int(round(post_roll * fps))
+
+        self.ring_buffer = deque()
+        self.frame_index = 0
+        self.event = None
+        self.frames_without_detection = 0
+        self.events = []
+        # First error of the encoding thread, raised by the next add() or close()
+        self.error = None
+
+        os.makedirs(output_folder, exist_ok=True)
+
+        # Bounded so that a slow encoder slows down decoding instead of filling the memory
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.thread = threading.Thread(target=self._encode_loop, daemon=True)
+        self.thread.start()
+
+    def add(self, frame, labels):
+        """
+        Adds the next frame of the video with the species detected on it (empty if none).
+        """
+        if self.error is not None:
+            self._release(frame)
+            raise self.error
+
+        timestamp = self.frame_index / self.fps
+
+        if labels:
+            if self.event is None:
+                self._start_event(timestamp)
+            self.event["species"].update(labels)
+            self.frames_without_detection = 0
+        elif self.event is not None:
+            self.frames_without_detection += 1
+
+        if self.event is not None:
+            self.queue.put(("frame", frame))
+            self.event["end"] = timestamp
+            self.event["frames"] += 1
+            if self.frames_without_detection > 0 and self.frames_without_detection >= self.post_roll_frames:
+                self._end_event()
+        elif self.pre_roll_frames > 0:
+            if len(self.ring_buffer) == self.pre_roll_frames:
+                self._release(self.ring_buffer.popleft())
+            self.ring_buffer.append(frame)
+        else:
+            self._release(frame)
+
+        self.frame_index += 1
+
+    def close(self, sidecar_path=None):
+        if self.event is not None:
+            self._end_event()
+        self.queue.put(("stop", None))
+        self.thread.join()
+        while self.ring_buffer:
+            self._release(self.ring_buffer.popleft())
+        if self.error is not None:
+            raise self.error
+
+        if sidecar_path is None:
+            sidecar_path = os.path.join(self.output_folder, "events.json")
+        with open(sidecar_path, "w", encoding="utf-8") as file:
+            json.dump({"fps": self.fps, "frames": self.frame_index, "events": self.events},
+                      file, indent=2, ensure_ascii=False)
+
+        return sidecar_path
+
+    def max_frames_held(self):
+        # Pre-roll, encoding queue and the frame being encoded
+        return self.pre_roll_frames + self.max_queue + 1
+
+    def _release(self, frame):
+        if self.release is not None:
+            self.release(frame)
+
+    def _start_event(self, timestamp):
+        clip_name = f"event_{len(self.events):04}.mp4"
+        start = timestamp - len(self.ring_buffer) / self.fps
+        self.event = {"clip": clip_name, "start": start, "end": timestamp,
+                      "frames": len(self.ring_buffer), "species": Counter()}
+
+        self.queue.put(("open", os.path.join(self.output_folder, clip_name)))
+        while self.ring_buffer:
+            self.queue.put(("frame", self.ring_buffer.popleft()))
+
+    def _end_event(self):
+        self.queue.put(("close", None))
+        event = self.event
+        # Species sorted by number of detections
+        event["species"] = dict(event["species"].most_common())
+        event["start"] = round(event["start"], 3)
+        event["end"] = round(event["end"], 3)
+        self.events.append(event)
+        self.event = None
+        self.frames_without_detection = 0
+
+    def _encode_loop(self):
+        # After an error the queue is still drained and the frames released, so that the main
+        # thread never blocks on the full queue
+        encoder = None
+        while True:
+            command, value = self.queue.get()
+            try:
+                if command == "open" and self.error is None:
+                    encoder = ClipEncoder(
+                        value, self.fps, self.frame_size, self.use_ffmpeg, self.preset)
+                elif command == "frame":
+                    try:
+                        if encoder is not None and self.error is None:
+                            encoder.write(value)
+                    finally:
+                        self._release(value)
+                elif command == "close" and encoder is not None:
+                    closing, encoder = encoder, None
+                    closing.close()
+            except Exception as error:
+                if self.error is None:
+                    self.error = error
+                if encoder is not None:
+                    closing, encoder = encoder, None
+                    try:
+                        closing.close()
+                    except Exception:
+                        pass
+            if command == "stop":
+                break
@@ -0,0 +1,392 @@
+import argparse
+import glob
+import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+from numpy.lib.format import open_memmap
+from ultralytics.data.dataset import YOLODataset
+from ultralytics.models.yolo.detect import DetectionTrainer
+from ultralytics.utils import LOGGER, colorstr
+from ultralytics.utils.torch_utils import de_parallel
+
+SPLITS = ["train", "val", "test"]
+
+# Same grey as the padding used by ultralytics
+PAD_VALUE = 114
+
+
+def cache_folder(dataset_folder, imgsz):
+    return os.path.join(dataset_folder, "frame_cache", str(imgsz))
+
+
+def cache_paths(dataset_folder, imgsz, split):
+    """
+    Images, ids, labels (class, center x, center y, width, height) and image index of each label.
+    The image index is kept apart as integers, a float32 column loses them above 2^24 images.
+    """
+    folder = cache_folder(dataset_folder, imgsz)
+    return (os.path.join(folder, f"{split}_images.npy"),
+            os.path.join(folder, f"{split}_ids.npy"),
+            os.path.join(folder, f"{split}_labels.npy"),
+            os.path.join(folder, f"{split}_label_images.npy"))
+
+
+def has_cache(dataset_folder, imgsz, split):
+    return all(os.path.exists(path) for path in cache_paths(dataset_folder, imgsz, split))
+
+
+def letterbox(frame, imgsz, out=None):
+    """
+    Resizes a frame so that its longest side is imgsz and pads it to an imgsz x imgsz square.
+    Returns the padded frame, the resize ratio and the (left, top) padding.
+    """
+    height, width = frame.shape[:2]
+    ratio = min(imgsz / height, imgsz / width)
+    new_width, new_height = round(width * ratio), round(height * ratio)
+    left, top = (imgsz - new_width) // 2, (imgsz - new_height) // 2
+
+    if out is None:
+        out = np.empty((imgsz, imgsz, 3), dtype=np.uint8)
+    out.fill(PAD_VALUE)
+
+    interpolation = cv2.INTER_AREA if ratio < 1 else cv2.INTER_LINEAR
+    out[top:top + new_height, left:left + new_width] = cv2.resize(
+        frame, (new_width, new_height), interpolation=interpolation)
+
+    return out, ratio, (left, top)
+
+
+def letterbox_labels(labels, shape, ratio, padding, imgsz):
+    """
+    Moves YOLO labels (class, center x, center y, width, height normalized by the original
+    frame) into the normalized coordinates of the letterboxed frame.
+    """
+    height, width = shape[:2]
+    labels = np.array(labels, dtype=np.float32).reshape(-1, 5)
+    labels[:, 1] = (labels[:, 1] * width * ratio + padding[0]) / imgsz
+    labels[:, 2] = (labels[:, 2] * height * ratio + padding[1]) / imgsz
+    labels[:, 3] = labels[:, 3] * width * ratio / imgsz
+    labels[:, 4] = labels[:, 4] * height * ratio / imgsz
+    return labels
+
+
+def read_label_file(label_path):
+    if not os.path.exists(label_path) or os.path.getsize(label_path) == 0:
+        return np.zeros((0, 5), dtype=np.float32)
+    return np.loadtxt(label_path, dtype=np.float32, ndmin=2)[:, :5]
+
+
+class FrameCacheWriter:
+    """
+    Appends letterboxed frames of one video to a shard of the cache. Shards are merged
+    into the memory mapped arrays by `consolidate` once every video is processed.
+    """
+
+    def __init__(self, dataset_folder, imgsz, split, shard_name):
+        self.imgsz = imgsz
+        folder = os.path.join(cache_folder(
+            dataset_folder, imgsz), "shards", split)
+        os.makedirs(folder, exist_ok=True)
+
+        self.frames_path = os.path.join(folder, f"{shard_name}.frames")
+        self.index_path = os.path.join(folder, f"{shard_name}.npz")
+        self.frames_file = open(self.frames_path, "wb")
+        self.buffer = np.empty((imgsz, imgsz, 3), dtype=np.uint8)
+        self.ids = []
+        self.labels = []
+        self.label_images = []
+
+    def add(self, image_id, frame, labels):
+        letterboxed, ratio, padding = letterbox(
+            frame, self.imgsz, out=self.buffer)
+        letterboxed.tofile(self.frames_file)
+
+        labels = letterbox_labels(
+            labels, frame.shape, ratio, padding, self.imgsz)
+        self.labels.append(labels)
+        self.label_images.append(
+            np.full(len(labels), len(self.ids), dtype=np.int64))
+        self.ids.append(image_id)
+
+    def close(self):
+        self.frames_file.close()
+        labels = np.concatenate(self.labels) if self.labels else np.zeros(
+            (0, 5), dtype=np.float32)
+        label_images = np.concatenate(self.label_images) if self.label_images else np.zeros(
+            0, dtype=np.int64)
+        np.savez(self.index_path, ids=np.asarray(
+            self.ids, dtype=str), labels=labels, label_images=label_images)
+
+
+def consolidate(dataset_folder, imgsz):
+    """
+    Merges the shards written during dataset creation (and the existing cache, if any)
+    into one memory mapped array per split.
+    """
+    folder = cache_folder(dataset_folder, imgsz)
+    frame_shape = (imgsz, imgsz, 3)
+
+    for split in SPLITS:
+        index_paths = sorted(
+            glob.glob(os.path.join(folder, "shards", split, "*.npz")))
+        if not index_paths:
+            continue
+
+        parts = []
+        if has_cache(dataset_folder, imgsz, split):
+            images_path, ids_path, labels_path, label_images_path = cache_paths(
+                dataset_folder, imgsz, split)
+            parts.append((np.load(images_path, mmap_mode="r"),
+                          np.load(ids_path), np.load(labels_path), np.load(label_images_path)))
+
+        for index_path in index_paths:
+            index = np.load(index_path)
+            frames_path = index_path[:-len(".npz")] + ".frames"
+            if len(index["ids"]) == 0:
+                continue
+            frames = np.memmap(frames_path, dtype=np.uint8, mode="r",
+                               shape=(len(index["ids"]),) + frame_shape)
+            parts.append((frames, index["ids"], index["labels"], index["label_images"]))
+
+        write_cache(dataset_folder, imgsz, split, parts)
+        shutil.rmtree(os.path.join(folder, "shards", split))
+        print(f"Frame cache {split}: {sum(len(part[1]) for part in parts)} frames")
+
+    shutil.rmtree(os.path.join(folder, "shards"), ignore_errors=True)
+
+
+def write_cache(dataset_folder, imgsz, split, parts):
+    images_path, ids_path, labels_path, label_images_path = cache_paths(
+        dataset_folder, imgsz, split)
+    total = sum(len(ids) for _, ids, _, _ in parts)
+
+    # The previous cache may be one of the parts, so write aside and swap at the end
+    tmp_images_path = images_path + ".tmp"
+    images = open_memmap(tmp_images_path, mode="w+", dtype=np.uint8,
+                         shape=(total, imgsz, imgsz, 3))
+    all_ids = []
+    all_labels = []
+    all_label_images = []
+    offset = 0
+    for frames, ids, labels, label_images in parts:
+        images[offset:offset + len(ids)] = frames
+        all_labels.append(labels)
+        all_label_images.append(label_images + offset)
+        all_ids.append(ids)
+        offset += len(ids)
+    images.flush()
+    del images
+
+    np.save(ids_path, np.concatenate(all_ids) if all_ids else np.zeros(0, dtype=str))
+    np.save(labels_path, np.concatenate(all_labels)
+            if all_labels else np.zeros((0, 5), dtype=np.float32))
+    np.save(label_images_path, np.concatenate(all_label_images)
+            if all_label_images else np.zeros(0, dtype=np.int64))
+    os.replace(tmp_images_path, images_path)
+
+
+def build_from_dataset(dataset_folder, imgsz, workers=8):
+    """
+    Builds the cache from the JPEG images and label files of an existing dataset.
+    """
+    for split in SPLITS:
+        images_folder = os.path.join(dataset_folder, "images", split)
+        labels_folder = os.path.join(dataset_folder, "labels", split)
+        if not os.path.isdir(images_folder):
+            continue
+
+        image_files = sorted(filename for filename in os.listdir(
+            images_folder) if filename.endswith(".jpg"))
+        ids = np.asarray([os.path.splitext(filename)[0]
+                         for filename in image_files], dtype=str)
+
+        images_path, ids_path, labels_path, label_images_path = cache_paths(
+            dataset_folder, imgsz, split)
+        os.makedirs(os.path.dirname(images_path), exist_ok=True)
+        images = open_memmap(images_path + ".tmp", mode="w+", dtype=np.uint8,
+                             shape=(len(image_files), imgsz, imgsz, 3))
+
+        def process(index):
+            frame = cv2.imread(os.path.join(
+                images_folder, image_files[index]))
+            _, ratio, padding = letterbox(frame, imgsz, out=images[index])
+            labels = letterbox_labels(read_label_file(os.path.join(
+                labels_folder, ids[index] + ".txt")), frame.shape, ratio, padding, imgsz)
+            return labels
+
+        # cv2 releases the GIL while decoding so threads are enough
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            labels = list(executor.map(process, range(len(image_files))))
+
+        images.flush()
+        del images
+        np.save(ids_path, ids)
+        np.save(labels_path, np.concatenate(labels)
+                if labels else np.zeros((0, 5), dtype=np.float32))
+        np.save(label_images_path, np.repeat(np.arange(len(labels), dtype=np.int64),
+                                             [len(image_labels) for image_labels in labels]))
+        os.replace(images_path + ".tmp", images_path)
+        print(f"Frame cache {split}: {len(image_files)} frames")
+
+
+class FrameCacheDataset(YOLODataset):
+    """
+    YOLODataset reading frames already letterboxed to imgsz from the frame cache instead
+    of decoding and resizing the JPEG files on every epoch. With `image_ids`, only these images
+    of the cache are used.
+    """
+
+    def __init__(self, *args, dataset_folder=None, split=None, image_ids=None, **kwargs):
+        self.dataset_folder = dataset_folder
+        self.split = split
+        self.image_ids = image_ids
+        self._images = None
+        super().__init__(*args, **kwargs)
+
+    @property
+    def cached_images(self):
+        # Opened lazily so that every dataloader worker maps the file on its own
+        if self._images is None:
+            images_path, _, _, _ = cache_paths(
+                self.dataset_folder, self.imgsz, self.split)
+            self._images = np.load(images_path, mmap_mode="r")
+        return self._images
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_images"] = None
+        return state
+
+    def get_img_files(self, img_path):
+        _, ids_path, _, _ = cache_paths(
+            self.dataset_folder, self.imgsz, self.split)
+        ids = np.load(ids_path)
+        # Rows of the cache used by the dataset, in its order
+        rows = np.arange(len(ids)) if self.image_ids is None else np.flatnonzero(
+            np.isin(ids, list(self.image_ids)))
+        if self.fraction < 1:
+            rows = rows[:round(len(rows) * self.fraction)]
+        self.rows = rows
+        # Rows are found from the file name, rect mode reorders im_files and labels after this
+        self.id_rows = {str(image_id): int(row) for image_id, row in zip(ids[rows], rows)}
+        # Same file names as the JPEG files, they don't need to exist
+        images_folder = os.path.join(self.dataset_folder, "images", self.split)
+        return [os.path.join(images_folder, f"{image_id}.jpg") for image_id in ids[rows]]
+
+    def get_labels(self):
+        _, _, labels_path, label_images_path = cache_paths(
+            self.dataset_folder, self.imgsz, self.split)
+        labels = np.load(labels_path)
+        label_images = np.load(label_images_path)
+        order = np.argsort(label_images, kind="stable")
+        labels, label_images = labels[order], label_images[order]
+        starts = np.searchsorted(label_images, self.rows)
+        ends = np.searchsorted(label_images, self.rows + 1)
+
+        return [dict(
+            im_file=im_file,
+            shape=(self.imgsz, self.imgsz),
+            cls=labels[start:end, 0:1].copy(),
+            bboxes=labels[start:end, 1:5].copy(),
+            segments=[],
+            keypoints=None,
+            normalized=True,
+            bbox_format="xywh") for im_file, start, end in zip(self.im_files, starts, ends)]
+
+    def load_image(self, i, rect_mode=True):
+        # Copy out of the memory map, augmentations modify the image in place
+        image_id = os.path.splitext(os.path.basename(self.im_files[i]))[0]
+        im = np.array(self.cached_images[self.id_rows[image_id]])
+
+        # Mosaic picks its other images from the buffer
+        if self.augment:
+            self.buffer.append(i)
+            if len(self.buffer) >= self.max_buffer_length:
+                self.buffer.pop(0)
+
+        return im, im.shape[:2], im.shape[:2]
+
+
+class FrameCacheTrainer(DetectionTrainer):
+    """
+    DetectionTrainer using the frame cache of the dataset when it exists for the training imgsz.
+    """
+
+    def build_dataset(self, img_path, mode="train", batch=None):
+        # img_path is <dataset>/images/<split>, or a list of images of that folder (tune_model.py)
+        image_ids = None
+        images_folder = img_path
+        if str(img_path).endswith(".txt"):
+            with open(img_path, "r", encoding="utf-8") as file:
+                image_files = [line.strip() for line in file if line.strip()]
+            image_ids = {os.path.splitext(os.path.basename(path))[0] for path in image_files}
+            images_folder = os.path.dirname(image_files[0]) if image_files else img_path
+        split = os.path.basename(os.path.normpath(images_folder))
+        dataset_folder = os.path.dirname(
+            os.path.dirname(os.path.normpath(images_folder)))
+
+        if not has_cache(dataset_folder, self.args.imgsz, split):
+            LOGGER.warning(
+                f"No frame cache for {split} at imgsz {self.args.imgsz}, reading the images")
+            return super().build_dataset(img_path, mode, batch)
+
+        stride = max(int(de_parallel(self.model).stride.max()
+                     if self.model else 0), 32)
+        return FrameCacheDataset(
+            img_path=img_path,
+            imgsz=self.args.imgsz,
+            batch_size=batch,
+            augment=mode == "train",
+            hyp=self.args,
+            rect=self.args.rect or mode == "val",
+            cache=None,
+            single_cls=self.args.single_cls or False,
+            stride=stride,
+            pad=0.0 if mode == "train" else 0.5,
+            prefix=colorstr(f"{mode} (frame cache): "),
+            classes=self.args.classes,
+            data=self.data,
+            fraction=self.args.fraction if mode == "train" else 1.0,
+            dataset_folder=dataset_folder,
+            split=split,
+            image_ids=image_ids)
+
+
+def main():
+    """
+    Builds the cache of frames letterboxed to imgsz used by train_model.py -frame-cache.
+
+    Without --consolidate the cache is built from the images and labels of the dataset. With
+    --consolidate the shards written by create_annotated_video.py --cache-imgsz are merged instead.
+
+    Args:
+        -d (str): Dataset folder (default: created_dataset).
+        -imgsz (int): Size of the cached frames, must match the training imgsz (default: 640).
+        -workers (int): Threads decoding the images (default: 8).
+        --consolidate (bool): Merge the shards written during dataset creation.
+    """
+    parser = argparse.ArgumentParser(
+        description="Build the cache of letterboxed frames used for training")
+    parser.add_argument("-d", type=str, default="created_dataset",
+                        help="Dataset folder")
+    parser.add_argument("-imgsz", type=int, default=640,
+                        help="Size of the cached frames, must match the training imgsz")
+    parser.add_argument("-workers", type=int, default=8,
+                        help="Threads decoding the images")
+    parser.add_argument("--consolidate", action="store_true", default=False,
+                        help="Merge the shards written during dataset creation")
+    args = parser.parse_args()
+
+    if args.consolidate:
+        consolidate(args.d, args.imgsz)
+    else:
+        build_from_dataset(args.d, args.imgsz, args.workers)
+
+    print(f"Frame cache written to {cache_folder(args.d, args.imgsz)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+import threading
+
+import numpy as np
+
+
+class FramePool:
+    """
+    Preallocated frame buffers that decoding fills in place.
+
+    A frame is acquired by `read`, passed by reference to inference, drawing and writing, and
+    given back with `release` once nothing uses it anymore (possibly from another thread, like
+    the encoder of the event clips). When every buffer is in use `acquire` waits for a release,
+    so the memory used by frames stays bounded and no large array is allocated per frame.
+    """
+
+    def __init__(self, frame_size, size=4):
+        width, height = frame_size
+        self.buffers = [np.empty((height, width, 3), dtype=np.uint8)
+                        for _ in range(size)]
+        self.free = list(self.buffers)
+        self.in_use = set()
+        self.condition = threading.Condition()
+
+        # Frames the decoder returned in a new array instead of the given buffer
+        self.copies = 0
+
+    @classmethod
+    def for_capture(cls, cap, size=4):
+        return cls((int(cap.get(3)), int(cap.get(4))), size)  # cap.get(3) returns width
+
+    def acquire(self, timeout=None):
+        with self.condition:
+            if not self.condition.wait_for(lambda: self.free, timeout):
+                raise TimeoutError("No frame buffer was released in time")
+            buffer = self.free.pop()
+            self.in_use.add(id(buffer))
+            return buffer
+
+    def release(self, buffer):
+        with self.condition:
+            if id(buffer) not in self.in_use:
+                raise ValueError("This frame doesn't belong to the pool or was already released")
+            self.in_use.remove(id(buffer))
+            self.free.append(buffer)
+            self.condition.notify()
+
+    def read(self, cap):
+        """
+        Decodes the next frame of the capture into a buffer of the pool. Returns (ret, frame) like
+        cap.read(), the frame has to be released by the caller.
+        """
+        buffer = self.acquire()
+        ret, frame = cap.read(image=buffer)
+        if not ret:
+            self.release(buffer)
+            return False, None
+
+        if frame is not buffer:
+            # Some backends ignore the given buffer (or the video changed size), keep the pool
+            # consistent with one copy
+            if frame.shape != buffer.shape:
+                self.release(buffer)
+                raise ValueError(
+                    f"Frame of shape {frame.shape} decoded into a pool of {buffer.shape} frames")
+            np.copyto(buffer, frame)
+            self.copies += 1
+        return True, buffer
+
+    def available(self):
+        with self.condition:
+            return len(self.free)
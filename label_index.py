@@ -0,0 +1,313 @@
+import argparse
+import hashlib
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+SPLITS = ["train", "val", "test"]
+INDEX_VERSION = 2
+
+# Files parsed by one task of the process pool
+CHUNK_SIZE = 2000
+
+
+class LabelIndex:
+    """
+    Every image and box of the created dataset in flat NumPy arrays.
+
+    Images: image_ids[i], image_split[i] (position in SPLITS), has_image[i], has_label[i] and
+    box_count[i]. Boxes: box_image[j] (index of the image), box_class[j] and boxes[j] (center x,
+    center y, width, height, normalized). Label files that couldn't be parsed have malformed[i] set.
+    """
+
+    def __init__(self, arrays):
+        self.image_ids = arrays["image_ids"]
+        self.image_split = arrays["image_split"]
+        self.has_image = arrays["has_image"]
+        self.has_label = arrays["has_label"]
+        self.malformed = arrays["malformed"]
+        self.box_count = arrays["box_count"]
+        self.box_image = arrays["box_image"]
+        self.box_class = arrays["box_class"]
+        self.boxes = arrays["boxes"]
+
+    def split_code(self, split):
+        return SPLITS.index(split)
+
+    def images_of_split(self, split):
+        return np.flatnonzero(self.image_split == self.split_code(split))
+
+    def images_with_classes(self, classes, split=None):
+        """
+        Indices of the images containing at least one box of the given classes.
+        """
+        images = np.unique(self.box_image[np.isin(self.box_class, classes)])
+        if split is not None:
+            images = images[self.image_split[images] == self.split_code(split)]
+        return images
+
+    def image_file(self, index):
+        return f"{self.image_ids[index]}.jpg"
+
+    def label_file(self, index):
+        return f"{self.image_ids[index]}.txt"
+
+
+def parse_label_files(paths):
+    """
+    Parses label files in bulk: returns the number of boxes of each file, the boxes as a (n, 5)
+    array (class, center x, center y, width, height) and which files are malformed.
+    """
+    counts = np.zeros(len(paths), dtype=np.int32)
+    malformed = np.zeros(len(paths), dtype=bool)
+    texts = []
+
+    for position, path in enumerate(paths):
+        with open(path, "r", encoding="utf-8") as file:
+            lines = [line for line in file.read().splitlines() if line.strip()]
+
+        if any(len(line.split()) != 5 for line in lines):
+            malformed[position] = True
+            continue
+
+        # One conversion per file instead of one per line, a value that isn't a number only
+        # marks its own file as malformed
+        try:
+            file_values = np.array(" ".join(lines).split(), dtype=np.float32)
+        except ValueError:
+            malformed[position] = True
+            continue
+
+        counts[position] = len(lines)
+        texts.append(file_values)
+
+    values = np.concatenate(texts).reshape(-1, 5) if texts else np.zeros((0, 5), dtype=np.float32)
+    return counts, values, malformed
+
+
+def folder_signature(folder):
+    if not os.path.isdir(folder):
+        return None
+    stat = os.stat(folder)
+    return [stat.st_mtime_ns, len(os.listdir(folder))]
+
+
+def files_signature(folder):
+    """
+    Digest of the name, size and modification time of every file of the folder, which changes
+    when a file is edited in place (unlike the folder itself).
+    """
+    if not os.path.isdir(folder):
+        return None
+    digest = hashlib.blake2b(digest_size=16)
+    for entry in sorted(os.scandir(folder), key=lambda entry: entry.name):
+        stat = entry.stat()
+        digest.update(f"{entry.name}\0{stat.st_size}\0{stat.st_mtime_ns}\n".encode())
+    return digest.hexdigest()
+
+
+def dataset_signature(dataset_folder):
+    # Adding or removing images changes the modification time of their folder, label files are
+    # also checked one by one since only their content is indexed
+    return {split: [folder_signature(os.path.join(dataset_folder, "images", split)),
+                    files_signature(os.path.join(dataset_folder, "labels", split))] for split in SPLITS}
+
+
+def list_stems(folder, extension):
+    if not os.path.isdir(folder):
+        return set()
+    return {entry.name[:-len(extension)] for entry in os.scandir(folder)
+            if entry.name.endswith(extension)}
+
+
+def build_index(dataset_folder, workers=None):
+    image_ids, image_split, has_image, has_label, label_paths = [], [], [], [], []
+
+    for split_code, split in enumerate(SPLITS):
+        image_stems = list_stems(os.path.join(
+            dataset_folder, "images", split), ".jpg")
+        label_stems = list_stems(os.path.join(
+            dataset_folder, "labels", split), ".txt")
+
+        for stem in sorted(image_stems | label_stems):
+            image_ids.append(stem)
+            image_split.append(split_code)
+            has_image.append(stem in image_stems)
+            has_label.append(stem in label_stems)
+            if stem in label_stems:
+                label_paths.append(os.path.join(
+                    dataset_folder, "labels", split, f"{stem}.txt"))
+
+    labelled = np.flatnonzero(has_label)
+    chunks = [label_paths[start:start + CHUNK_SIZE]
+              for start in range(0, len(label_paths), CHUNK_SIZE)]
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        parsed = list(executor.map(parse_label_files, chunks))
+
+    box_count = np.zeros(len(image_ids), dtype=np.int32)
+    malformed = np.zeros(len(image_ids), dtype=bool)
+    if parsed:
+        box_count[labelled] = np.concatenate([counts for counts, _, _ in parsed])
+        malformed[labelled] = np.concatenate(
+            [chunk_malformed for _, _, chunk_malformed in parsed])
+        values = np.concatenate([chunk_values for _, chunk_values, _ in parsed])
+    else:
+        values = np.zeros((0, 5), dtype=np.float32)
+
+    return LabelIndex({
+        "image_ids": np.asarray(image_ids, dtype=str),
+        "image_split": np.asarray(image_split, dtype=np.int8),
+        "has_image": np.asarray(has_image, dtype=bool),
+        "has_label": np.asarray(has_label, dtype=bool),
+        "malformed": malformed,
+        "box_count": box_count,
+        "box_image": np.repeat(np.arange(len(image_ids), dtype=np.int32), box_count),
+        "box_class": values[:, 0].astype(np.int32),
+        "boxes": values[:, 1:5],
+    })
+
+
+def index_path(dataset_folder):
+    return os.path.join(dataset_folder, "label_index.npz")
+
+
+def save_index(index, dataset_folder):
+    meta = {"version": INDEX_VERSION,
+            "signature": dataset_signature(dataset_folder)}
+    tmp_path = index_path(dataset_folder) + ".tmp.npz"
+    np.savez(tmp_path, meta=json.dumps(meta), **vars(index))
+    os.replace(tmp_path, index_path(dataset_folder))
+
+
+def load_label_index(dataset_folder, rebuild=False, workers=None):
+    """
+    Loads the label index of the dataset, (re)building it when it doesn't exist or when files
+    were added to or removed from the dataset or label files changed since it was built.
+    """
+    path = index_path(dataset_folder)
+    if not rebuild and os.path.exists(path):
+        arrays = dict(np.load(path))
+        meta = json.loads(str(arrays.pop("meta")))
+        if meta["version"] == INDEX_VERSION and meta["signature"] == dataset_signature(dataset_folder):
+            return LabelIndex(arrays)
+
+    print(f"Building the label index of {dataset_folder} ...")
+    index = build_index(dataset_folder, workers)
+    save_index(index, dataset_folder)
+    return index
+
+
+def percentiles(values, quantiles=(0, 5, 25, 50, 75, 95, 100)):
+    if len(values) == 0:
+        return "no boxes"
+    return ", ".join(f"p{q}={value:.3f}" for q, value in zip(quantiles, np.percentile(values, quantiles)))
+
+
+def health_report(index, class_names=None):
+    lines = []
+    number_classes = len(class_names) if class_names is not None else int(
+        index.box_class.max(initial=-1)) + 1
+    box_split = index.image_split[index.box_image]
+
+    # Class balance: one bincount per split
+    lines.append("Class balance:")
+    header = "Class".ljust(28) + "".join(split.rjust(10) for split in SPLITS)
+    lines.append(header)
+    balance = np.stack([np.bincount(index.box_class[(box_split == code) & (index.box_class >= 0)],
+                                    minlength=number_classes)[:number_classes] for code in range(len(SPLITS))], axis=1)
+    for class_id, row in enumerate(balance):
+        name = class_names[class_id] if class_names is not None else str(class_id)
+        lines.append(f"{class_id:>3} {name[:24]:24}" +
+                     "".join(f"{count:10}" for count in row))
+
+    lines.append("")
+    lines.append("Images and boxes per split:")
+    for code, split in enumerate(SPLITS):
+        in_split = index.image_split == code
+        lines.append(f"{split}: {np.count_nonzero(in_split & index.has_image)} images, "
+                     f"{np.count_nonzero(in_split & index.has_label)} label files, {np.count_nonzero(box_split == code)} boxes")
+
+    # Box geometry
+    widths, heights = index.boxes[:, 2], index.boxes[:, 3]
+    lines.append("")
+    lines.append(f"Box width: {percentiles(widths)}")
+    lines.append(f"Box height: {percentiles(heights)}")
+    lines.append(f"Box area: {percentiles(widths * heights)}")
+    with np.errstate(divide="ignore", invalid="ignore"):
+        lines.append(
+            f"Box aspect (w/h): {percentiles((widths / heights)[heights > 0])}")
+
+    # Problems
+    x1 = index.boxes[:, 0] - widths / 2
+    y1 = index.boxes[:, 1] - heights / 2
+    x2 = index.boxes[:, 0] + widths / 2
+    y2 = index.boxes[:, 1] + heights / 2
+    tolerance = 1e-6
+    out_of_range = ((x1 < -tolerance) | (y1 < -tolerance) | (x2 > 1 + tolerance) | (y2 > 1 + tolerance)
+                    | (widths <= 0) | (heights <= 0))
+    bad_class = (index.box_class < 0) | (index.box_class >= number_classes)
+
+    problems = {
+        "Images without label file": np.flatnonzero(index.has_image & ~index.has_label),
+        "Label files without image": np.flatnonzero(~index.has_image & index.has_label),
+        "Empty label files": np.flatnonzero(index.has_label & ~index.malformed & (index.box_count == 0)),
+        "Malformed label files": np.flatnonzero(index.malformed),
+        "Images with out of range boxes": np.unique(index.box_image[out_of_range]),
+        "Images with unknown classes": np.unique(index.box_image[bad_class]),
+    }
+
+    lines.append("")
+    lines.append("Problems:")
+    for name, images in problems.items():
+        examples = ", ".join(
+            f"{SPLITS[index.image_split[image]]}/{index.image_ids[image]}" for image in images[:5])
+        lines.append(f"{name}: {len(images)}" +
+                     (f" (e.g. {examples})" if len(images) else ""))
+
+    return "\n".join(lines) + "\n"
+
+
+def main():
+    """
+    Builds the label index of the created dataset and prints its health report: class balance per split,
+    box size and aspect distributions, missing or empty pairs and out of range coordinates.
+
+    Args:
+        -d (str): Dataset folder (default: created_dataset).
+        -o (str): File where the report is also written (default: None).
+        -workers (int): Processes parsing the label files (default: number of CPUs).
+        --rebuild (bool): Rebuild the index even if it is up to date.
+    """
+    parser = argparse.ArgumentParser(
+        description="Index the labels of the created dataset and report its health")
+    parser.add_argument("-d", type=str, default="created_dataset",
+                        help="Dataset folder")
+    parser.add_argument("-o", type=str, default=None,
+                        help="File where the report is also written")
+    parser.add_argument("-workers", type=int, default=None,
+                        help="Processes parsing the label files")
+    parser.add_argument("--rebuild", action="store_true", default=False,
+                        help="Rebuild the index even if it is up to date")
+    args = parser.parse_args()
+
+    index = load_label_index(args.d, args.rebuild, args.workers)
+
+    # utils.py is generated by preprocess_and_copy_downloaded_data.py, class ids are shown without it
+    try:
+        from utils import SPECIES_LIST
+    except ImportError:
+        SPECIES_LIST = None
+
+    report = health_report(index, SPECIES_LIST)
+    print(report)
+
+    if args.o is not None:
+        with open(args.o, "w", encoding="utf-8") as file:
+            file.write(report)
+
+
+if __name__ == "__main__":
+    main()
@@ -2,23 +2,16 @@ import cv2
 import argparse
 import torch
 import time
+import os
 
 from ultralytics import YOLO
-from collections import Counter
-
-
-def most_common_value(arr):
-    counter = Counter(arr)
-    most_common = counter.most_common(2)
-
-    if most_common:
-        # Check if the most common value is None, then return the second most common
-        if most_common[0][0] is None and len(most_common) > 1:
-            return most_common[1][0]
-        else:
-            return most_common[0][0]
-    else:
-        return None
+from autotune import apply_thread_settings
+from cascade import add_cascade_arguments, create_cascade
+from annotation_drawing import draw_box
+from event_clips import EventClipWriter
+from frame_pool import FramePool
+from species_classifier import TwoStagePipeline
+from species_vote import most_common_value
 
 
 def main():
@@ -34,6 +27,16 @@ def main():
         --not-show (bool, optional): Show the annotation in real-time (default: False).
         -save (bool): Save to a video file
         -fps (float, optional): Desired frames per second (FPS) for the output video (default: 25.0).
+        -cascade (bool): Run frames at a low input size first and only re-run at full size the frames
+            close to the threshold or with ambiguous species (see cascade.py for the stage arguments).
+        -classifier (str): Species classifier trained by species_classifier.py. Enables the two-stage mode: birds
+            are detected by -detector without species and every distinct bird is classified on its crop.
+        -detector (str): Class agnostic bird detector of the two-stage mode (default: yolov8m.pt).
+        -events (bool): Only save clips around detections, with a JSON index of the events, in
+            output_files/<output name>_events.
+        --pre-roll (float): Seconds kept before the first detection of a clip (default: 2.0).
+        --post-roll (float): Seconds without detection ending a clip (default: 2.0).
+        --ffmpeg (bool): Encode the clips with ffmpeg (libx264) instead of cv2.
     """
 
     # Parse command line arguments
@@ -50,8 +53,35 @@ def main():
                         help="Show the annotation in not")
     parser.add_argument("-fps", type=float, default=25.0,
                         help="Desired fps for the output video")
+    parser.add_argument("-cascade", action="store_true", default=False,
+                        help="Run at low resolution first, re-run at full resolution only the uncertain frames")
+    add_cascade_arguments(parser)
+    parser.add_argument("-classifier", type=str, default=None,
+                        help="Species classifier of the two-stage mode, trained by species_classifier.py")
+    parser.add_argument("-detector", type=str, default="yolov8m.pt",
+                        help="Class agnostic bird detector of the two-stage mode")
+    parser.add_argument("--classifier-imgsz", type=int, default=96,
+                        help="Input size of the species classifier")
+    parser.add_argument("--classifier-batch", type=int, default=32,
+                        help="Number of crops gathered across frames before running the species classifier")
+    parser.add_argument("-events", action="store_true", default=False,
+                        help="Only save clips around detections, with a JSON index of the events")
+    parser.add_argument("--pre-roll", type=float, default=2.0,
+                        help="Seconds kept before the first detection of a clip")
+    parser.add_argument("--post-roll", type=float, default=2.0,
+                        help="Seconds without detection ending a clip")
+    parser.add_argument("--ffmpeg", action="store_true", default=False,
+                        help="Encode the clips with an external ffmpeg process instead of cv2")
+    parser.add_argument("--ffmpeg-preset", type=str, default="veryfast",
+                        help="x264 preset used by ffmpeg")
     args = parser.parse_args()
 
+    if args.cascade and args.classifier is not None:
+        parser.error("-cascade and -classifier can't be used together")
+
+    # Thread counts calibrated by autotune.py for this machine, if any
+    apply_thread_settings("inference")
+
     global_start_time = time.time()
 
     # Check if CUDA (GPU support) is available
@@ -68,15 +98,39 @@ def main():
 
     # Create VideoCapture objects for input and output videos
     cap = cv2.VideoCapture(args.i)
+    frame_size = (int(cap.get(3)), int(cap.get(4)))  # cap.get(3) returns width
 
     if (args.save):
         fourcc = cv2.VideoWriter_fourcc(*"mp4v")
-        out = cv2.VideoWriter(args.o, fourcc, args.fps, (int(
-            cap.get(3)), int(cap.get(4))))  # cap.get(3) returns width
+        out = cv2.VideoWriter(args.o, fourcc, args.fps, frame_size)
+
+    # Encoded in the background, only around detections. Timestamps follow the input video
+    event_writer = None
+    if args.events:
+        video_fps = cap.get(cv2.CAP_PROP_FPS) or args.fps
+        event_writer = EventClipWriter(os.path.splitext(args.o)[0] + "_events", video_fps,
+                                       frame_size, args.pre_roll, args.post_roll,
+                                       args.ffmpeg, args.ffmpeg_preset)
+
+    # Frames are decoded into preallocated buffers and drawn on in place. The clip writer keeps
+    # frames for the pre-roll and the encoder, it gives them back to the pool once encoded
+    pool_size = 2 + (event_writer.max_frames_held() if event_writer is not None else 0)
+    pool = FramePool(frame_size, pool_size)
+    if event_writer is not None:
+        event_writer.release = pool.release
+
+    # In the two-stage mode the species doesn't come from the detector
+    pipeline = None
+    if args.classifier is not None:
+        pipeline = TwoStagePipeline(args.detector, args.classifier, classifier_imgsz=args.classifier_imgsz,
+                                    batch_size=args.classifier_batch)
+    else:
+        model = YOLO(args.m)
+        names = model.names
 
-    model = YOLO(args.m)
-    names = model.names
+    cascade = create_cascade(model, args) if args.cascade else None
     predicted_labels = []
+    predicted_tracks = []
 
     prev_end_time = 0
     start_time = 0
@@ -84,32 +138,54 @@ def main():
     while True:
         start_time = time.time()
 
-        ret, frame = cap.read()
+        ret, frame = pool.read(cap)
 
         if not ret:
             break
 
-        result = model(frame, agnostic_nms=True, conf=0.7)[0]
-        # Visualize the results on the frame
-        annotated_frame = result.plot(
-            pil=True, line_width=5, font_size=40)
-
-        if result.boxes.cls.numel() == 0:
-            predicted_labels.append(None)
+        if pipeline is not None:
+            boxes = pipeline(frame)
+            annotated_frame = frame
+
+            # Species known so far, crops still waiting for their batch are shown as bird
+            frame_labels = []
+            for x1, y1, x2, y2, track_id in boxes:
+                label = pipeline.classifier.label(track_id)
+                text = "bird" if label is None else f"{label[0]} {label[1]:.2f}"
+                frame_labels.append("bird" if label is None else label[0])
+                draw_box(annotated_frame, x1, y1, x2, y2,
+                         text, font_size=40, thickness=5)
+
+            # Tracks are turned into species once every crop is classified
+            if not boxes:
+                predicted_tracks.append(None)
+            else:
+                predicted_tracks.extend(box[4] for box in boxes)
         else:
-            for c in result.boxes.cls:
-                predicted_labels.append(names[int(c)])
+            if cascade is not None:
+                result, _ = cascade(frame)
+            else:
+                result = model(frame, agnostic_nms=True, conf=0.7)[0]
+            # Visualize the results directly on the decoded frame
+            annotated_frame = frame
+            frame_labels = [names[int(c)] for c in result.boxes.cls]
+            for (x1, y1, x2, y2), label, confidence in zip(result.boxes.xyxy.tolist(), frame_labels,
+                                                           result.boxes.conf.tolist()):
+                draw_box(annotated_frame, x1, y1, x2, y2,
+                         f"{label} {confidence:.2f}", font_size=40, thickness=5)
+
+            if not frame_labels:
+                predicted_labels.append(None)
+            else:
+                predicted_labels.extend(frame_labels)
 
         # Can't compute it for first frame
-        if (prev_end_time > 0 and not (args.not_show) and not ((args.save))):
+        if (prev_end_time > 0 and not (args.not_show) and not (args.save) and not (args.events)):
             # Calculate the FPS of frame - 1
             fps = 1.0 / elapsed_time
 
             # Add FPS text to the top-left corner of the frame
             fps_text = f"FPS: {fps:.2f}"
-            # Add FPS text to the top-left corner of the frame
-            annotated_frame = annotated_frame.copy()
-
             cv2.putText(annotated_frame, fps_text, (10, 30),
                         cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 0, 0), 2, cv2.LINE_AA)
 
@@ -124,17 +200,37 @@ def main():
             # Write the frame with bounding boxes to the output video
             out.write(annotated_frame)
 
+        if event_writer is not None:
+            event_writer.add(annotated_frame, frame_labels)
+        else:
+            pool.release(frame)
+
         prev_end_time = time.time()
         elapsed_time = prev_end_time - start_time
 
     cap.release()
     if (args.save):
         out.release()
+    if event_writer is not None:
+        sidecar_path = event_writer.close()
+        print(
+            f"{len(event_writer.events)} event clips saved, index at {sidecar_path}")
     cv2.destroyAllWindows()
 
     global_elapsed_time = time.time() - global_start_time
     print(f"The whole process took {global_elapsed_time} seconds to execute")
 
+    if pipeline is not None:
+        pipeline.classifier.flush()
+        predicted_labels = [None if track_id is None else pipeline.classifier.species(track_id)
+                            for track_id in predicted_tracks]
+        print(
+            f"Species classifier: {pipeline.classifier.classified_crops} crops classified in {pipeline.classifier.forward_passes} batches")
+
+    if cascade is not None:
+        print(
+            f"Frames re-run at full resolution: {cascade.escalated}/{cascade.frames} ({100 * cascade.escalation_rate():.1f}%)")
+
     print(
         f"The most likely bird to be present is : {most_common_value(predicted_labels) if most_common_value(predicted_labels) is not None else 'We cannot conclude which species are present in this video.'}")
 
@@ -1,11 +1,14 @@
 import os
 import shutil
 import argparse
-import csv
 import numpy as np
-import json
 from collections import defaultdict
 
+from db_cache import load_db, recode
+from species_store import DEFAULT_JSON_PATH, DEFAULT_STORE_PATH, SpeciesStore
+from stratified_sampling import stratified_sample
+from video_dedup import DEFAULT_HASH_CACHE_PATH, HashCache, find_duplicates, write_report
+
 
 def create_destination_folder(destination_folder):
     # Delete the entire folder and its contents if it exists
@@ -53,17 +56,15 @@ def overwrite_classes_utils(utils_file_path, species_selected):
         print(f"Error while updating utils file: {str(e)}")
 
 
-def count_species_occurrences(input_file, occurences_threshold):
-    species_counts = defaultdict(int)
-
-    with open(input_file, mode="r", newline="", encoding="utf-8") as file:
-        reader = csv.DictReader(file, delimiter="\t")
-        all_rows = list(reader)
+def count_species_occurrences(db, occurences_threshold):
+    # To prevent some duplicated species
+    species, species_names = recode(db.species, db.species_names, str.lower)
+    occurrences = np.bincount(species, minlength=len(species_names))
 
-    for row in all_rows:
-        species = row["species"].lower()  # To prevent some duplicated species
-        if species != 'na' and species != "pas d'oiseau":
-            species_counts[species] += 1
+    species_counts = defaultdict(int)
+    for name, count in zip(species_names, occurrences):
+        if name != 'na' and name != "pas d'oiseau" and count > 0:
+            species_counts[str(name)] = int(count)
 
     # Identify species below the occurrences threshold
     species_to_modify = [species for species, count in species_counts.items(
@@ -78,97 +79,72 @@ def count_species_occurrences(input_file, occurences_threshold):
     return species_counts
 
 
-def get_unique_years(input_file):
-    unique_years = set()
+def remove_duplicate_videos(db, source_folder, hash_cache_path, workers, report_path="duplicate_videos.txt"):
+    """
+    Removes the rows of the videos whose content is identical to another video. The video kept
+    is the one appearing first in the database, so a clip synced twice can't end up both in the
+    train and in the test set.
+    """
+    # Only the downloaded videos can be compared, in the order of their first row
+    local_paths, first_rows = np.unique(db.local_path, return_index=True)
+    video_paths = {}
+    for local_path in local_paths[np.argsort(first_rows)]:
+        video_path = os.path.join(
+            source_folder, str(local_path).replace(".h264", ".mp4"))
+        video_paths[video_path] = str(local_path)
 
-    with open(input_file, mode="r", newline="", encoding="utf-8") as file:
-        reader = csv.DictReader(file, delimiter="\t")
-        for row in reader:
-            year = int(row["date"].split("-")[0])
-            unique_years.add(year)
+    with HashCache(hash_cache_path) as cache:
+        groups = find_duplicates(list(video_paths), cache, workers)
 
-    return sorted(list(unique_years))
+    removed, removed_bytes = write_report(groups, report_path, video_paths)
+    removed_paths = [video_paths[path] for group in groups for path in group[1:]]
+    keep = ~np.isin(db.local_path, np.asarray(removed_paths, dtype=db.local_path.dtype))
 
+    print(f"Removed {removed} duplicated videos ({removed_bytes / 1e9:.2f} GB, {len(db) - int(keep.sum())} rows) "
+          f"in {len(groups)} groups, see {report_path}")
+    return db.select(keep)
 
-def create_species_dict(input_file, species_counts, max_local_paths_per_species_per_year):
-    species_dict = {}
+
+def create_species_dict(db, species_counts, max_local_paths_per_species_per_year, store, seed=0, test_year=2021):
     max_count_species_test = 50
 
-    # Read all rows from the input file
-    with open(input_file, mode="r", newline="", encoding="utf-8") as file:
-        reader = csv.DictReader(file, delimiter="\t")
-        all_rows = list(reader)
-
-    # Create a dictionary to store all rows for each species
-    rows_per_species = defaultdict(list)
-    for row in all_rows:
-        species = row["species"].lower()
-        if species in species_counts:
-            rows_per_species[species].append(row)
-        else:
-            rows_per_species["autre"].append(row)
-
-    # Get unique years from the database
-    years = get_unique_years(input_file)
-
-    # Calculate evenly spaced indices for local paths for each species and each year
-    for species, rows in rows_per_species.items():
-        for year in years:
-            year_rows = [
-                row for row in rows if row["date"].split("-")[0] == str(year)]
-            total_species_occurrences_per_year = len(year_rows)
-
-            # Skip the year if there are no species for that year
-            if total_species_occurrences_per_year == 0:
-                continue
-
-            # Determine the appropriate max value based on the year
-            if year == 2021:
-                max_value = max_count_species_test
-            else:
-                max_value = max_local_paths_per_species_per_year
-
-            # Calculate evenly spaced indices based on the determined max value
-            evenly_spaced_indices = np.linspace(
-                0, total_species_occurrences_per_year - 1, max_value, dtype=int)
-            np.random.shuffle(evenly_spaced_indices)
-
-            for index in evenly_spaced_indices:
-                row = year_rows[index]
-                local_path = row["local_path"]
-
-                # Set "test" based on the year
-                if year == 2021:
-                    species_dict[local_path] = {
-                        "species": species, "test": "True"}
-                else:
-                    species_dict[local_path] = {
-                        "species": species, "test": "False"}
-
-    return species_dict
-
-
-def print_species_info(species_dict, occurences_threshold):
-    species_selected = list(set(entry["species"]
-                            for entry in species_dict.values()))
+    # Every species which wasn't kept goes to "autre"
+    species, species_names = recode(db.species, db.species_names, str.lower)
+    selected_names = [name if name in species_counts else "autre"
+                      for name in species_names]
+    species, species_names = recode(
+        species, np.asarray(selected_names, dtype=str), str)
+
+    # Up to the max value of videos for each species and each year, spread over the feeders,
+    # the test year having its own max value. The same seed always gives the same selection
+    rows, is_test = stratified_sample(species, db.year, db.feeder, max_local_paths_per_species_per_year,
+                                      test_year=test_year, test_quota=max_count_species_test, seed=seed)
+
+    for row, test in zip(rows, is_test):
+        store.insert(str(db.local_path[row]), str(species_names[species[row]]),
+                     bool(test), int(db.year[row]))
+
+    store.commit()
+
+
+def print_species_info(store, occurences_threshold):
+    species_selected = store.species()
+    train_counts = store.count_by_species(split="train")
+    test_counts = store.count_by_species(split="test")
 
     result_str = f"Species with at least {occurences_threshold} occurrences: {len(species_selected)}\n"
-    result_str += f"Total video : {len(species_dict.keys())}\n"
+    result_str += f"Total video : {len(store)}\n"
     result_str += "Species selected : \n"
     result_str += str(species_selected)
 
     # Print occurrences selected for each species
     for species in species_selected:
-        count_species_occurrences = sum(1 for entry in species_dict.values(
-        ) if entry["species"] == str(species) and entry["test"] == "False")
-        result_str += f"Species: {species}, Occurrences Selected: {count_species_occurrences}\n"
+        result_str += f"Species: {species}, Occurrences Selected: {train_counts.get(species, 0)}\n"
 
     # Print test species selected
     result_str += "Testing videos selected:\n"
     for species in species_selected:
-        count_species_occurrences = sum(1 for entry in species_dict.values(
-        ) if entry["species"] == str(species) and entry["test"] == "True")
-        result_str += f"Species: {species}, Occurrences selected: {count_species_occurrences}\n"
+        result_str += f"Species: {species}, Occurrences selected: {test_counts.get(species, 0)}\n"
 
     # Print to console
     print(result_str)
@@ -178,39 +154,46 @@ def print_species_info(species_dict, occurences_threshold):
         log_file.write(result_str)
 
 
-def read_species_data(input_file, yaml_file, utils_file):
+def read_species_data(input_file, yaml_file, utils_file, store_path, source_folder=None, hash_cache_path=None,
+                      dedup_workers=16, seed=0):
     occurences_threshold = 200
     max_local_paths_per_species_per_year = 50
-    species_counts = count_species_occurrences(
-        input_file, occurences_threshold)
+    db = load_db(input_file)
+
+    # Duplicates are removed before counting and selecting
+    if hash_cache_path is not None:
+        db = remove_duplicate_videos(
+            db, source_folder, hash_cache_path, dedup_workers)
+
+    species_counts = count_species_occurrences(db, occurences_threshold)
 
     print("Creating species dictionary with balanced species")
 
-    species_dict = create_species_dict(
-        input_file, species_counts, max_local_paths_per_species_per_year)
+    # Start from an empty store, the selection is streamed into it
+    store = SpeciesStore(store_path)
+    store.clear()
+    create_species_dict(
+        db, species_counts, max_local_paths_per_species_per_year, store, seed)
 
     print(
         f"Maximum amount of videos taken for each species per year: {max_local_paths_per_species_per_year}")
 
-    print_species_info(species_dict, occurences_threshold)
+    print_species_info(store, occurences_threshold)
 
-    species_selected = list(set(entry["species"]
-                            for entry in species_dict.values()))
+    species_selected = store.species()
 
     overwrite_classes_yaml(yaml_file, species_selected)
     overwrite_classes_utils(utils_file, species_selected)
 
-    species_dict_path = 'filtered_species_dict.json'
-
-    with open(species_dict_path, 'w', encoding="utf-8") as file:
-        json.dump(species_dict, file)
+    # Kept for the tools still reading the JSON dictionary
+    store.export_json(DEFAULT_JSON_PATH)
 
-    return species_dict
+    return store
 
 
-def copy_videos(source_folder, destination_folder, species_dict):
-    # Check if the video is in species_dict before copying
-    for video in species_dict.keys():
+def copy_videos(source_folder, destination_folder, store):
+    # Only the videos selected in the store are copied
+    for video in store.paths():
         # In the db_file it's written .h264 instead of .mp4 as the actual filename
         mp4_video_path = video.replace(".h264", ".mp4")
         destination_path = os.path.join(
@@ -224,11 +207,12 @@ def copy_videos(source_folder, destination_folder, species_dict):
         print(f"Copied: {full_mp4_video_path} -> {destination_path}")
 
 
-def reorganize_and_preprocess_videos(source_folder, destination_folder, input_file, yaml_file, utils_file):
+def reorganize_and_preprocess_videos(source_folder, destination_folder, input_file, yaml_file, utils_file, store_path,
+                                     hash_cache_path=None, dedup_workers=16, seed=0):
     create_destination_folder(destination_folder)
-    species_dict = read_species_data(
-        input_file, yaml_file, utils_file)
-    copy_videos(source_folder, destination_folder, species_dict)
+    with read_species_data(input_file, yaml_file, utils_file, store_path, source_folder, hash_cache_path,
+                           dedup_workers, seed) as store:
+        copy_videos(source_folder, destination_folder, store)
     print("Preprocessed and copied videos successfully!")
 
 
@@ -245,10 +229,21 @@ def main():
                         help="Path to the utils.py file which contains the list of species.")
     parser.add_argument("--db-file", type=str,
                         default="db_file.tsv", help="Database to read from the species")
+    parser.add_argument("--store", type=str, default=DEFAULT_STORE_PATH,
+                        help="Path to the store of the selected videos")
+    parser.add_argument("--dedup", action="store_true", default=False,
+                        help="Remove the videos with the same content as another one before the selection")
+    parser.add_argument("--hash-cache", type=str, default=DEFAULT_HASH_CACHE_PATH,
+                        help="Cache of the content hashes used by --dedup")
+    parser.add_argument("--dedup-workers", type=int, default=16,
+                        help="Threads hashing the videos for --dedup")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="Seed of the selection of the videos, the same seed gives the same selection")
     args = parser.parse_args()
 
     reorganize_and_preprocess_videos(
-        args.i, args.o, args.db_file, args.y, args.u)
+        args.i, args.o, args.db_file, args.y, args.u, args.store,
+        args.hash_cache if args.dedup else None, args.dedup_workers, args.seed)
 
 
 if __name__ == "__main__":
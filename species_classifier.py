@@ -0,0 +1,249 @@
+import argparse
+import os
+
+import cv2
+import numpy as np
+from ultralytics import YOLO
+
+# Classes of the pretrained COCO model merged into 'bird', same as create_annotated_video.py
+ANIMAL_CLASSES = list(range(14, 25))
+
+
+def appearance_hash(crop, hash_size=8):
+    """
+    Difference hash of a crop: crops of the same bird sitting still give the same hash,
+    so they are only classified once.
+    """
+    gray = cv2.cvtColor(crop, cv2.COLOR_BGR2GRAY)
+    small = cv2.resize(gray, (hash_size + 1, hash_size),
+                       interpolation=cv2.INTER_AREA)
+    bits = (small[:, 1:] > small[:, :-1]).flatten()
+    return int(np.packbits(bits).view(">u8")[0])
+
+
+def crop_box(frame, x1, y1, x2, y2, margin=0.1):
+    # Some context around the bird helps the classifier
+    height, width = frame.shape[:2]
+    margin_x, margin_y = (x2 - x1) * margin, (y2 - y1) * margin
+    x1, y1 = max(int(x1 - margin_x), 0), max(int(y1 - margin_y), 0)
+    x2, y2 = min(int(x2 + margin_x), width), min(int(y2 + margin_y), height)
+    return frame[y1:y2, x1:x2]
+
+
+class CropClassifier:
+    """
+    Species classifier run on batches of bird crops gathered across frames.
+
+    Crops are submitted with the track they belong to. A track is classified once per distinct
+    appearance (up to `max_per_track` appearances) and results are cached by appearance, so a
+    bird staying in front of the camera costs a single forward pass of the classifier.
+    """
+
+    def __init__(self, model_path, imgsz=96, batch_size=32, max_per_track=3):
+        self.model = YOLO(model_path)
+        self.names = self.model.names
+        self.imgsz = imgsz
+        self.batch_size = batch_size
+        self.max_per_track = max_per_track
+
+        self.cache = {}  # appearance hash -> (species, confidence)
+        self.track_results = {}  # track id -> list of (species, confidence)
+        self.pending = {}  # appearance hash -> (crop, track ids waiting for it)
+        self.pending_counts = {}  # track id -> appearances of the track waiting in the batch
+        self.forward_passes = 0
+        self.classified_crops = 0
+
+    def submit(self, track_id, crop):
+        if crop.size == 0:
+            return
+
+        results = self.track_results.setdefault(track_id, [])
+        # Appearances waiting in the batch count towards the cap too
+        if len(results) + self.pending_counts.get(track_id, 0) >= self.max_per_track:
+            return
+
+        key = appearance_hash(crop)
+        if key in self.cache:
+            if self.cache[key] not in results:
+                results.append(self.cache[key])
+            return
+
+        # The same appearance waiting in the batch is not added twice, even from another track
+        if key in self.pending:
+            if track_id not in self.pending[key][1]:
+                self.pending[key][1].append(track_id)
+                self.pending_counts[track_id] = self.pending_counts.get(track_id, 0) + 1
+            return
+        self.pending[key] = (crop.copy(), [track_id])
+        self.pending_counts[track_id] = self.pending_counts.get(track_id, 0) + 1
+
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.pending:
+            return
+
+        # One forward pass for the whole batch
+        keys = list(self.pending)
+        crops = [self.pending[key][0] for key in keys]
+        results = self.model(crops, imgsz=self.imgsz, verbose=False)
+        self.forward_passes += 1
+        self.classified_crops += len(crops)
+
+        for key, result in zip(keys, results):
+            prediction = (self.names[int(result.probs.top1)],
+                          float(result.probs.top1conf))
+            self.cache[key] = prediction
+            for track_id in self.pending[key][1]:
+                self.track_results[track_id].append(prediction)
+
+        self.pending = {}
+        self.pending_counts = {}
+
+    def label(self, track_id):
+        """
+        Most confident species among the appearances of a track, None while still pending.
+        """
+        results = self.track_results.get(track_id)
+        if not results:
+            return None
+        return max(results, key=lambda result: result[1])
+
+    def species(self, track_id):
+        label = self.label(track_id)
+        return None if label is None else label[0]
+
+
+class TwoStagePipeline:
+    """
+    Class agnostic bird detection and tracking followed by the batched crop classifier.
+    """
+
+    def __init__(self, detector_path, classifier_path, conf=0.5, classifier_imgsz=96, batch_size=32):
+        self.detector = YOLO(detector_path)
+        self.classifier = CropClassifier(
+            classifier_path, classifier_imgsz, batch_size)
+        self.conf = conf
+        self.untracked = 0
+
+    def __call__(self, frame):
+        """
+        Returns the boxes of the frame as (x1, y1, x2, y2, track id). Their species are given by
+        `self.classifier.label(track_id)` once classified.
+        """
+        # A pretrained COCO detector mislabels birds as other animals, every animal is a bird here
+        result = self.detector.track(frame, persist=True, classes=ANIMAL_CLASSES, agnostic_nms=True,
+                                     conf=self.conf, verbose=False)[0]
+
+        boxes = []
+        track_ids = result.boxes.id
+        for index, (x1, y1, x2, y2) in enumerate(result.boxes.xyxy.tolist()):
+            if track_ids is not None:
+                track_id = int(track_ids[index])
+            else:
+                # Not tracked yet, classified on its own
+                self.untracked += 1
+                track_id = -self.untracked
+            self.classifier.submit(track_id, crop_box(frame, x1, y1, x2, y2))
+            boxes.append((x1, y1, x2, y2, track_id))
+
+        return boxes
+
+
+def extract_crops(dataset_folder, crops_folder, species_list, margin=0.1):
+    """
+    Writes the bird crops of the created dataset as an image classification dataset:
+    <crops_folder>/<split>/<species>/<image id>.jpg
+    """
+    for split in ["train", "val", "test"]:
+        images_folder = os.path.join(dataset_folder, "images", split)
+        labels_folder = os.path.join(dataset_folder, "labels", split)
+        if not os.path.isdir(images_folder):
+            continue
+
+        number_crops = 0
+        for image_file in sorted(os.listdir(images_folder)):
+            label_file = os.path.join(
+                labels_folder, image_file.replace(".jpg", ".txt"))
+            if not os.path.exists(label_file):
+                continue
+
+            image = cv2.imread(os.path.join(images_folder, image_file))
+            height, width = image.shape[:2]
+            with open(label_file, "r", encoding="utf-8") as f:
+                lines = f.readlines()
+
+            for index, line in enumerate(lines):
+                parts = line.strip().split(" ")
+                class_id = int(parts[0])
+                center_x, center_y, box_width, box_height = map(
+                    float, parts[1:5])
+                crop = crop_box(image,
+                                (center_x - box_width / 2) * width, (center_y - box_height / 2) * height,
+                                (center_x + box_width / 2) * width, (center_y + box_height / 2) * height, margin)
+
+                species_folder = os.path.join(
+                    crops_folder, split, species_list[class_id])
+                os.makedirs(species_folder, exist_ok=True)
+                cv2.imwrite(os.path.join(species_folder,
+                            f"{image_file[:-4]}_{index}.jpg"), crop)
+                number_crops += 1
+
+        print(f"{number_crops} crops in {split}")
+
+
+def main():
+    """
+    Trains the species classifier of the two-stage pipeline (main.py -classifier) on crops of the
+    created dataset. The crops are extracted first if the crops folder doesn't exist.
+
+    Args:
+        -d (str): Dataset created by create_dataset.py (default: created_dataset).
+        -crops (str): Folder of the crop classification dataset (default: created_crops).
+        -model (str): Classification model to start from (default: yolov8n-cls.pt).
+        -imgsz (int): Input size of the classifier (default: 96).
+        -epochs (int): Number of training epochs (default: 20).
+        -batch (int): Batch size for training (default: 128).
+        -output (str): Directory for saving training runs and results (default: train_and_validation).
+        -name (str): Name for the folder containing the results of this train (default: species_classifier).
+    """
+    parser = argparse.ArgumentParser(
+        description="Train the species classifier of the two-stage pipeline on bird crops")
+    parser.add_argument("-d", type=str, default="created_dataset",
+                        help="Dataset created by create_dataset.py")
+    parser.add_argument("-crops", type=str, default="created_crops",
+                        help="Folder of the crop classification dataset")
+    parser.add_argument("-model", type=str, default="yolov8n-cls.pt",
+                        help="Classification model to start from")
+    parser.add_argument("-imgsz", type=int, default=96,
+                        help="Input size of the classifier")
+    parser.add_argument("-epochs", type=int, default=20,
+                        help="Number of training epochs")
+    parser.add_argument("-batch", type=int, default=128,
+                        help="Batch size for training")
+    parser.add_argument("-output", type=str, default="train_and_validation",
+                        help="Directory for saving training runs and results")
+    parser.add_argument("-name", type=str, default="species_classifier",
+                        help="Name for the folder containing the results of this train")
+    args = parser.parse_args()
+
+    if not os.path.exists(args.crops):
+        # Imported here, utils.py is generated by preprocess_and_copy_downloaded_data.py
+        from utils import SPECIES_LIST
+        extract_crops(args.d, args.crops, SPECIES_LIST)
+
+    model = YOLO(args.model)
+    model.train(
+        data=args.crops,
+        project=args.output,
+        imgsz=args.imgsz,
+        epochs=args.epochs,
+        batch=args.batch,
+        name=args.name,
+        device=0
+    )
+
+
+if __name__ == "__main__":
+    main()
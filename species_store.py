@@ -0,0 +1,203 @@
+import argparse
+import json
+import os
+import pathlib
+import sqlite3
+
+DEFAULT_STORE_PATH = "filtered_species.sqlite"
+DEFAULT_JSON_PATH = "filtered_species_dict.json"
+
+# Splits as decided by preprocess_and_copy_downloaded_data, validation is picked later per video
+SPLITS = ("train", "test")
+
+
+class SpeciesStore:
+    """
+    Indexed store of the selected videos: local_path -> species, split and year.
+
+    It replaces the flat filtered_species_dict.json, which is still exported for compatibility.
+    Inserts are buffered and committed every `batch_size` rows so preprocessing can stream
+    its selection into the store.
+
+    With `read_only`, the store is opened as an immutable file: nothing is written, not even the
+    WAL and shared memory files, which don't work between hosts sharing the file over a network
+    filesystem. The store must not change while it is open this way.
+    """
+
+    def __init__(self, path=DEFAULT_STORE_PATH, batch_size=10000, read_only=False):
+        self.path = path
+        self.batch_size = batch_size
+        self.read_only = read_only
+        self.pending = 0
+        if read_only:
+            uri = pathlib.Path(path).absolute().as_uri()
+            self.connection = sqlite3.connect(f"{uri}?mode=ro&immutable=1", uri=True)
+            return
+
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.executescript("""
+            CREATE TABLE IF NOT EXISTS videos (
+                local_path TEXT PRIMARY KEY,
+                species TEXT NOT NULL,
+                is_test INTEGER NOT NULL,
+                year INTEGER
+            );
+            CREATE INDEX IF NOT EXISTS videos_species ON videos (species, is_test);
+            CREATE INDEX IF NOT EXISTS videos_split ON videos (is_test);
+            CREATE INDEX IF NOT EXISTS videos_year ON videos (year);
+        """)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __len__(self):
+        return self.connection.execute("SELECT COUNT(*) FROM videos").fetchone()[0]
+
+    def __contains__(self, local_path):
+        return self.get(local_path) is not None
+
+    def close(self):
+        if not self.read_only:
+            self.commit()
+        self.connection.close()
+
+    def commit(self):
+        self.connection.commit()
+        self.pending = 0
+
+    def clear(self):
+        self.connection.execute("DELETE FROM videos")
+        self.commit()
+
+    def insert(self, local_path, species, test, year=None):
+        # Same behaviour as the dictionary: a path selected twice keeps the last entry
+        self.connection.execute(
+            "INSERT OR REPLACE INTO videos (local_path, species, is_test, year) VALUES (?, ?, ?, ?)",
+            (local_path, species, int(test), year))
+        self.pending += 1
+        if self.pending >= self.batch_size:
+            self.commit()
+
+    def get(self, local_path):
+        """
+        Returns the entry of a video in the format of filtered_species_dict.json, or None.
+        """
+        row = self.connection.execute(
+            "SELECT species, is_test FROM videos WHERE local_path = ?", (local_path,)).fetchone()
+        if row is None:
+            return None
+        return {"species": row[0], "test": str(bool(row[1]))}
+
+    def paths(self, species=None, split=None, year=None):
+        query, parameters = self._filter(species, split, year)
+        for (local_path,) in self.connection.execute(
+                "SELECT local_path FROM videos" + query + " ORDER BY rowid", parameters):
+            yield local_path
+
+    def species(self):
+        return [species for (species,) in self.connection.execute(
+            "SELECT DISTINCT species FROM videos ORDER BY species")]
+
+    def count_by_species(self, split=None, year=None):
+        query, parameters = self._filter(None, split, year)
+        return dict(self.connection.execute(
+            "SELECT species, COUNT(*) FROM videos" + query + " GROUP BY species", parameters))
+
+    def items(self):
+        for local_path, species, is_test in self.connection.execute(
+                "SELECT local_path, species, is_test FROM videos ORDER BY rowid"):
+            yield local_path, {"species": species, "test": str(bool(is_test))}
+
+    def export_json(self, json_path=DEFAULT_JSON_PATH):
+        with open(json_path, "w", encoding="utf-8") as file:
+            json.dump(dict(self.items()), file)
+
+    def import_json(self, json_path=DEFAULT_JSON_PATH):
+        with open(json_path, "r", encoding="utf-8") as file:
+            species_dict = json.load(file)
+
+        for local_path, entry in species_dict.items():
+            # Paths look like feeder/year/month/day/hour/file.h264
+            parts = local_path.split("/")
+            year = int(parts[1]) if len(parts) > 1 and parts[1].isdigit() else None
+            self.insert(local_path, entry["species"],
+                        entry["test"] == "True", year)
+        self.commit()
+
+    def _filter(self, species, split, year):
+        conditions = []
+        parameters = []
+        if species is not None:
+            conditions.append("species = ?")
+            parameters.append(species)
+        if split is not None:
+            if split not in SPLITS:
+                raise ValueError(f"Unknown split {split}, expected one of {SPLITS}")
+            conditions.append("is_test = ?")
+            parameters.append(int(split == "test"))
+        if year is not None:
+            conditions.append("year = ?")
+            parameters.append(int(year))
+
+        if not conditions:
+            return "", parameters
+        return " WHERE " + " AND ".join(conditions), parameters
+
+
+def open_store(store_path=DEFAULT_STORE_PATH, json_path=DEFAULT_JSON_PATH, read_only=False):
+    """
+    Opens the store, importing the JSON dictionary first if only the JSON exists
+    (selection made before the store was introduced). A read only store is never imported.
+    """
+    if read_only and not os.path.exists(store_path) and json_path is not None and os.path.exists(json_path):
+        raise FileNotFoundError(
+            f"{store_path} not found, import {json_path} first with python species_store.py --import-json")
+
+    if not os.path.exists(store_path) and json_path is not None and os.path.exists(json_path):
+        print(f"Importing {json_path} into {store_path} ...")
+        store = SpeciesStore(store_path)
+        store.import_json(json_path)
+        return store
+
+    if not os.path.exists(store_path):
+        raise FileNotFoundError(
+            f"{store_path} not found, run preprocess_and_copy_downloaded_data.py first")
+
+    return SpeciesStore(store_path, read_only=read_only)
+
+
+def main():
+    """
+    Converts between the species store and the JSON dictionary.
+
+    Args:
+        --store (str): Path to the SQLite store (default: filtered_species.sqlite).
+        --json-file (str): Path to the JSON dictionary (default: filtered_species_dict.json).
+        --import-json (bool): Fill the store from the JSON dictionary instead of exporting it.
+    """
+    parser = argparse.ArgumentParser(
+        description="Export the species store to JSON or import a JSON dictionary into it")
+    parser.add_argument("--store", type=str, default=DEFAULT_STORE_PATH,
+                        help="Path to the SQLite store")
+    parser.add_argument("--json-file", type=str, default=DEFAULT_JSON_PATH,
+                        help="Path to the JSON dictionary")
+    parser.add_argument("--import-json", action="store_true", default=False,
+                        help="Fill the store from the JSON dictionary instead of exporting it")
+    args = parser.parse_args()
+
+    with SpeciesStore(args.store) as store:
+        if args.import_json:
+            store.clear()
+            store.import_json(args.json_file)
+            print(f"Imported {len(store)} videos into {args.store}")
+        else:
+            store.export_json(args.json_file)
+            print(f"Exported {len(store)} videos to {args.json_file}")
+
+
+if __name__ == "__main__":
+    main()
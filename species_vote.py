@@ -0,0 +1,15 @@
+from collections import Counter
+
+
+def most_common_value(arr):
+    counter = Counter(arr)
+    most_common = counter.most_common(2)
+
+    if most_common:
+        # Check if the most common value is None, then return the second most common
+        if most_common[0][0] is None and len(most_common) > 1:
+            return most_common[1][0]
+        else:
+            return most_common[0][0]
+    else:
+        return None
@@ -0,0 +1,158 @@
+import argparse
+import time
+
+import numpy as np
+
+
+def group_starts(sorted_keys):
+    """
+    For every position of a sorted array, the position where its group of equal keys starts.
+    """
+    is_start = np.ones(len(sorted_keys), dtype=bool)
+    is_start[1:] = sorted_keys[1:] != sorted_keys[:-1]
+    starts = np.flatnonzero(is_start)
+    return starts[np.cumsum(is_start) - 1]
+
+
+def sort_by(major, minor, minor_bound):
+    """
+    Indices sorting by `major` then by `minor` (integers in [0, minor_bound)). Both keys are packed
+    into one int64 when they fit, a single sort being much faster than a lexsort.
+    """
+    if (int(major.max(initial=0)) + 1) * minor_bound < 2 ** 63:
+        return np.argsort(major * minor_bound + minor)
+    return np.lexsort((minor, major))
+
+
+def shuffle_within(keys, rng, min_random_bits=20):
+    """
+    Indices sorting the non negative integer `keys`, rows with the same key in a random order, and the
+    sorted keys. When the key, a random number and the row index fit in an int64 they are packed and
+    sorted by value, several times faster than an argsort. Rows whose random numbers collide are
+    left in row order, with at least `min_random_bits` random bits it is rare enough not to matter.
+    """
+    row_bits = max(len(keys) - 1, 1).bit_length()
+    key_bits = max(int(keys.max(initial=0)), 1).bit_length()
+    random_bits = 63 - row_bits - key_bits
+    if random_bits < min_random_bits:
+        order = sort_by(keys, rng.integers(0, 1 << 32, len(keys)), 1 << 32)
+        return order, keys[order]
+
+    packed = keys << (random_bits + row_bits)
+    packed |= rng.integers(0, 1 << random_bits, len(keys)) << row_bits
+    packed |= np.arange(len(keys))
+    packed.sort()
+    return packed & ((1 << row_bits) - 1), packed >> (random_bits + row_bits)
+
+
+def stratified_sample(species, year, feeder, quota, test_year=2021, test_quota=None, max_per_feeder=None,
+                      seed=0):
+    """
+    Draws at most `quota` rows per species and year, without replacement, spread as evenly as
+    possible over the feeders of that species and year. Rows of `test_year` (the hold-out year,
+    None for no hold-out) are drawn with `test_quota` instead. `max_per_feeder` also caps the rows
+    of a single species, year and feeder.
+
+    A single sort over the rows, the rest is counting, and the same seed always gives the same
+    selection. Returns the indices of the selected rows and whether each of them is in the test set.
+    """
+    species = np.asarray(species, dtype=np.int64)
+    feeder = np.asarray(feeder, dtype=np.int64)
+    year = np.asarray(year)
+    # Years span a few values, a lookup table avoids sorting them
+    first_year = year.min() if len(year) else 0
+    year_offset = (year - first_year).astype(np.int64)
+    present = np.bincount(year_offset) > 0
+    year_index = (np.cumsum(present) - 1)[year_offset]
+    years = np.flatnonzero(present) + first_year
+    number_years = len(years)
+    number_feeders = int(feeder.max(initial=-1)) + 1
+    rng = np.random.default_rng(seed)
+
+    # Random order inside each species, year and feeder: rank 0 is the first row drawn from a feeder.
+    # The feeder is in the low bits of the stratum, shifts are cheaper than divisions
+    feeder_bits = max(number_feeders - 1, 1).bit_length()
+    species_year = species * number_years + year_index
+    order, sorted_stratum = shuffle_within((species_year << feeder_bits) | feeder, rng)
+    rank = np.arange(len(order)) - group_starts(sorted_stratum)
+
+    # A row drawn after the quota of its feeder can't be selected, whatever the other feeders
+    test_quota = quota if test_quota is None else test_quota
+    limit = max(quota, test_quota) if max_per_feeder is None else min(
+        max(quota, test_quota), max_per_feeder)
+    is_candidate = rank < limit
+    if not is_candidate.all():
+        order = order[is_candidate]
+        rank = rank[is_candidate]
+        sorted_stratum = sorted_stratum[is_candidate]
+
+    # Feeders take turns inside a species and year: all the rows of rank 0 first, then of rank 1, ...
+    # Counting the rows of each species, year and rank tells which ranks fit entirely in the quota,
+    # only the rank where the quota runs out needs to be sorted
+    number_species_years = (int(species.max(initial=-1)) + 1) * number_years
+    slot = (sorted_stratum >> feeder_bits) * limit + rank
+    rank_counts = np.bincount(slot, minlength=number_species_years * limit).reshape(-1, limit)
+    is_test_year = np.zeros(number_years, dtype=bool) if test_year is None else years == test_year
+    species_year_quota = np.where(
+        is_test_year[np.arange(number_species_years) % max(number_years, 1)], test_quota, quota)
+    room = (species_year_quota[:, None] - (np.cumsum(rank_counts, axis=1) - rank_counts)).ravel()
+    rank_counts = rank_counts.ravel()
+    selected = (rank_counts <= room)[slot]
+
+    # The rank where the quota runs out is split between its feeders in a random order of feeders
+    partial = np.flatnonzero(((room > 0) & (rank_counts > room))[slot])
+    if len(partial):
+        feeder_turn = rng.permutation(number_feeders)[sorted_stratum[partial] & ((1 << feeder_bits) - 1)]
+        partial_order = sort_by(slot[partial], feeder_turn, number_feeders)
+        partial = partial[partial_order]
+        position = np.arange(len(partial)) - group_starts(slot[partial])
+        selected[partial[position < room[slot[partial]]]] = True
+
+    rows = order[selected]
+    return rows, is_test_year[year_index[rows]]
+
+
+def main():
+    """
+    Measures the time of the stratified sampling on random rows and checks that it is reproducible.
+
+    Args:
+        -rows (int): Number of rows (default: 5000000).
+        -species (int): Number of species (default: 100).
+        -feeders (int): Number of feeders (default: 500).
+        -quota (int): Rows per species and year (default: 50).
+        -seed (int): Seed of the sampling (default: 0).
+    """
+    parser = argparse.ArgumentParser(
+        description="Benchmark the stratified sampling of the videos")
+    parser.add_argument("-rows", type=int, default=5000000,
+                        help="Number of rows")
+    parser.add_argument("-species", type=int, default=100,
+                        help="Number of species")
+    parser.add_argument("-feeders", type=int, default=500,
+                        help="Number of feeders")
+    parser.add_argument("-quota", type=int, default=50,
+                        help="Rows per species and year")
+    parser.add_argument("-seed", type=int, default=0,
+                        help="Seed of the sampling")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(1)
+    species = rng.integers(0, args.species, args.rows)
+    year = rng.integers(2017, 2024, args.rows)
+    feeder = rng.integers(0, args.feeders, args.rows)
+
+    start_time = time.time()
+    rows, is_test = stratified_sample(
+        species, year, feeder, args.quota, seed=args.seed)
+    elapsed_time = time.time() - start_time
+
+    again, _ = stratified_sample(
+        species, year, feeder, args.quota, seed=args.seed)
+    print(f"{len(rows)} rows selected out of {args.rows} in {elapsed_time:.3f}s "
+          f"({int(is_test.sum())} in the test set), reproducible: {np.array_equal(rows, again)}, "
+          f"duplicates: {len(rows) - len(np.unique(rows))}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,11 @@
 import argparse
 import os
 from ultralytics import YOLO
+from ultralytics.models.yolo.detect import DetectionTrainer
+from autotune import set_profile_defaults
+from distillation import compare_models, make_distillation_trainer
+from frame_cache import FrameCacheTrainer, build_from_dataset, has_cache
+from species_store import DEFAULT_STORE_PATH
 
 
 def main():
@@ -16,8 +21,15 @@ def main():
         -project (str): Directory where training runs and results will be saved (default: 'output_training').
         -imgsz (int): Input image size (default: 640).
         -epochs (int): Number of training epochs (default: 15).
-        -batch (int): Batch size for training (default: 12).
+        -batch (int): Batch size for training (default: 12, or the one of the profile of autotune.py if there is one).
         -name (str): Name for the experiment and output files (default: 'yolov8_birds').
+        -frame-cache (bool): Read frames already letterboxed to imgsz from the frame cache of the dataset,
+            building it first if needed (default: False).
+        -teacher (str): Trained model to distill into -model, e.g. the trained yolov8m with -model yolov8n.pt (default: None).
+        -kd-weight (float): Weight of the distillation loss (default: 1.0).
+        -kd-temperature (float): Temperature softening the teacher outputs (default: 2.0).
+        -videos (str): Folder of the preprocessed videos, test videos are used for the video accuracy of the report
+            (default: 'preprocessed_videos').
     """
 
     # Argument parser for customizing training parameters
@@ -37,6 +49,21 @@ def main():
                         help="Batch size for training")
     parser.add_argument("-name", type=str, default="yolov8_train",
                         help="Name for the folder containing the results of this train")
+    parser.add_argument("-frame-cache", action="store_true", default=False,
+                        help="Read frames already letterboxed to imgsz from the frame cache of the dataset")
+    parser.add_argument("-dataset", type=str, default="created_dataset",
+                        help="Dataset folder, used to build the frame cache if it doesn't exist")
+    parser.add_argument("-teacher", type=str, default=None,
+                        help="Trained model to distill into the model, enables the distillation mode")
+    parser.add_argument("-kd-weight", type=float, default=1.0,
+                        help="Weight of the distillation loss")
+    parser.add_argument("-kd-temperature", type=float, default=2.0,
+                        help="Temperature softening the teacher outputs")
+    parser.add_argument("-videos", type=str, default="preprocessed_videos",
+                        help="Folder of the preprocessed videos, used for the video accuracy of the distillation report")
+    parser.add_argument("-store", type=str, default=DEFAULT_STORE_PATH,
+                        help="Store of the selected videos, used for the video accuracy of the distillation report")
+    set_profile_defaults(parser, "train", ["batch"])
     args = parser.parse_args()
 
     # Create the project directory if it doesn't exist
@@ -45,8 +72,21 @@ def main():
     # Initialize the YOLO model
     model = YOLO(args.model)
 
+    trainer = None
+    if args.frame_cache:
+        if not has_cache(args.dataset, args.imgsz, "train"):
+            print(f"Building the frame cache of {args.dataset} for imgsz {args.imgsz} ...")
+            build_from_dataset(args.dataset, args.imgsz)
+        trainer = FrameCacheTrainer
+
+    # The teacher is plugged in the loss of the trainer
+    if args.teacher is not None:
+        trainer = make_distillation_trainer(
+            args.teacher, args.kd_weight, args.kd_temperature, base=trainer or DetectionTrainer)
+
     # Start training
     model.train(
+        trainer=trainer,
         data=args.data,
         project=args.output,
         imgsz=args.imgsz,
@@ -56,6 +96,11 @@ def main():
         device=0
     )
 
+    # Compare the student with its teacher to pick the model meeting the FPS target
+    if args.teacher is not None:
+        compare_models({"teacher": args.teacher, "student": str(model.trainer.best)}, args.data, args.imgsz,
+                       args.videos, args.store, os.path.join(model.trainer.save_dir, "distillation_report.json"))
+
 
 if __name__ == "__main__":
     main()
@@ -1,21 +1,376 @@
 import argparse
+import json
+import math
+import multiprocessing
+import os
+import random
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
 
-from ultralytics import YOLO
+import numpy as np
+import yaml
+
+# Search space: name -> (low, high, log scale), same bounds as the ultralytics tuner
+SEARCH_SPACE = {
+    "lr0": (1e-5, 1e-1, True),
+    "lrf": (1e-4, 1e-1, True),
+    "momentum": (0.7, 0.98, False),
+    "weight_decay": (0.0, 0.001, False),
+    "warmup_epochs": (0.0, 5.0, False),
+    "box": (1.0, 20.0, False),
+    "cls": (0.2, 4.0, False),
+    "dfl": (0.4, 6.0, False),
+    "hsv_h": (0.0, 0.1, False),
+    "hsv_s": (0.0, 0.9, False),
+    "hsv_v": (0.0, 0.9, False),
+    "degrees": (0.0, 45.0, False),
+    "translate": (0.0, 0.9, False),
+    "scale": (0.0, 0.95, False),
+    "fliplr": (0.0, 1.0, False),
+    "mosaic": (0.0, 1.0, False),
+}
+
+
+def sample_hyperparameters(seed, trial_id):
+    # Only depends on the seed and the trial, so resumed runs get the same configurations
+    rng = random.Random(f"{seed}-{trial_id}")
+    hyperparameters = {}
+    for name, (low, high, log_scale) in SEARCH_SPACE.items():
+        if log_scale:
+            value = math.exp(rng.uniform(math.log(low), math.log(high)))
+        else:
+            value = rng.uniform(low, high)
+        hyperparameters[name] = round(value, 6)
+    return hyperparameters
+
+
+def rung_epochs(min_epochs, max_epochs, eta):
+    # Budget of each rung: min_epochs, min_epochs * eta, ... up to max_epochs
+    epochs = [min_epochs]
+    while epochs[-1] * eta <= max_epochs:
+        epochs.append(epochs[-1] * eta)
+    return epochs
+
+
+def list_images(images_folder, imgsz):
+    """
+    Images of a split of the dataset, from the frame cache when the dataset has no JPEG files
+    (created with --no-jpeg). Returns the image paths and whether they come from the frame cache.
+    """
+    images = []
+    if os.path.isdir(images_folder):
+        images = sorted(os.path.join(images_folder, filename)
+                        for filename in os.listdir(images_folder) if filename.endswith(".jpg"))
+    if images:
+        return images, False
+
+    # Imported here, frame_cache imports ultralytics
+    from frame_cache import cache_paths, has_cache
+
+    split = os.path.basename(os.path.normpath(images_folder))
+    dataset_folder = os.path.dirname(os.path.dirname(os.path.normpath(images_folder)))
+    if not has_cache(dataset_folder, imgsz, split):
+        return [], False
+
+    # Same file names as the JPEG files, they don't need to exist
+    _, ids_path, _, _ = cache_paths(dataset_folder, imgsz, split)
+    return [os.path.join(images_folder, f"{image_id}.jpg") for image_id in np.load(ids_path)], True
+
+
+def create_subset_data(data_file, output_folder, fraction, seed, imgsz):
+    """
+    Writes a data file pointing to lists of a random fraction of the train and val images,
+    so that each trial trains and validates on a subsample of the dataset. Returns the data file
+    and whether the images are only in the frame cache.
+    """
+    with open(data_file, "r", encoding="utf-8") as file:
+        data = yaml.safe_load(file)
+
+    rng = random.Random(seed)
+    subset_folder = os.path.join(output_folder, "subset")
+    os.makedirs(subset_folder, exist_ok=True)
+    from_frame_cache = False
+
+    for split in ["train", "val"]:
+        images_folder = os.path.join(data["path"], data[split])
+        images, cached = list_images(images_folder, imgsz)
+        if not images:
+            raise FileNotFoundError(
+                f"No images for the {split} split in {images_folder} nor in its frame cache for imgsz {imgsz}")
+        from_frame_cache = from_frame_cache or cached
+        images = rng.sample(images, max(1, round(len(images) * fraction)))
+
+        list_file = os.path.abspath(
+            os.path.join(subset_folder, f"{split}.txt"))
+        with open(list_file, "w", encoding="utf-8") as file:
+            file.write("\n".join(images) + "\n")
+        data[split] = list_file
+
+    data.pop("test", None)
+    subset_data_file = os.path.join(subset_folder, "subset.yaml")
+    with open(subset_data_file, "w", encoding="utf-8") as file:
+        yaml.safe_dump(data, file, allow_unicode=True)
+
+    return subset_data_file, from_frame_cache
+
+
+def check_config(config_file, config):
+    """
+    Saves the settings the results depend on, or checks that they are the same as the ones of
+    the run being resumed.
+    """
+    if os.path.exists(config_file):
+        with open(config_file, "r", encoding="utf-8") as file:
+            previous = json.load(file)
+        differences = {name: (previous.get(name), value) for name, value in config.items()
+                       if previous.get(name) != value}
+        if differences:
+            raise SystemExit(
+                f"The results in {os.path.dirname(config_file)} were obtained with other settings "
+                f"(setting: (previous, now)): {differences}. Use the same settings to resume, or another -output")
+        return
+
+    with open(config_file, "w", encoding="utf-8") as file:
+        json.dump(config, file, indent=2)
+
+
+def run_trial(job, data_file, output_folder, imgsz, batch, device, frame_cache=False):
+    # Imported here so that every worker process initializes its own CUDA context
+    from ultralytics import YOLO
+    from frame_cache import FrameCacheTrainer
+
+    start_time = time.time()
+    model = YOLO(job["weights"])
+    model.train(
+        trainer=FrameCacheTrainer if frame_cache else None,
+        data=data_file,
+        project=os.path.join(output_folder, "trials"),
+        name=f"trial{job['trial']:03}_rung{job['rung']}",
+        exist_ok=True,
+        epochs=job["epochs"],
+        imgsz=imgsz,
+        batch=batch,
+        device=device,
+        plots=False,
+        verbose=False,
+        **job["hyperparameters"])
+
+    metrics = model.trainer.metrics
+    map50 = float(metrics.get("metrics/mAP50(B)", 0.0))
+    map50_95 = float(metrics.get("metrics/mAP50-95(B)", 0.0))
+
+    return dict(job,
+                fitness=0.1 * map50 + 0.9 * map50_95,
+                map50=map50,
+                map50_95=map50_95,
+                last_weights=str(model.trainer.last),
+                seconds=time.time() - start_time)
+
+
+def load_results(results_file):
+    results = {}
+    if os.path.exists(results_file):
+        with open(results_file, "r", encoding="utf-8") as file:
+            for line in file:
+                if line.strip():
+                    result = json.loads(line)
+                    results[(result["trial"], result["rung"])] = result
+    return results
+
+
+def next_job(results, running, args, epochs):
+    """
+    Asynchronous successive halving: promote the best unpromoted trial of the highest rung
+    possible, a trial being promotable once it ranks in the top 1/eta of its rung. Otherwise
+    start a new trial at the lowest rung.
+    """
+    for rung in reversed(range(len(epochs) - 1)):
+        finished = [result for (_, result_rung), result in results.items()
+                    if result_rung == rung and result["fitness"] is not None]
+        finished.sort(key=lambda result: result["fitness"], reverse=True)
+
+        for result in finished[:len(finished) // args.eta]:
+            key = (result["trial"], rung + 1)
+            if key not in results and key not in running:
+                # Warm start from the weights of the previous rung, only the extra epochs are trained
+                return {"trial": result["trial"], "rung": rung + 1,
+                        "epochs": epochs[rung + 1] - epochs[rung],
+                        "weights": result["last_weights"],
+                        "hyperparameters": result["hyperparameters"]}
+
+    started = {trial for trial, rung in list(results) + list(running) if rung == 0}
+    if len(started) < args.trials:
+        trial = len(started)
+        return {"trial": trial, "rung": 0, "epochs": epochs[0], "weights": args.m,
+                "hyperparameters": sample_hyperparameters(args.seed, trial)}
+
+    return None
+
+
+def write_report(results, output_folder, epochs):
+    finished = sorted((result for result in results.values() if result["fitness"] is not None),
+                      key=lambda result: result["finished_at"])
+
+    # Best fitness reached as a function of the epochs trained so far, over all trials
+    lines = ["Compute spent (epochs)\tBest fitness\tTrial\tRung"]
+    compute = 0
+    best = None
+    for result in finished:
+        compute += result["epochs"]
+        if best is None or result["fitness"] > best["fitness"]:
+            best = result
+            lines.append(
+                f"{compute}\t{best['fitness']:.5f}\t{best['trial']}\t{best['rung']}")
+
+    lines.append("")
+    lines.append(f"Rungs (total epochs): {epochs}")
+    lines.append("Trial\tHighest rung\tFitness\tmAP50\tmAP50-95\tEpochs\tSeconds")
+
+    # One line per trial with the result of the highest rung it reached
+    per_trial = {}
+    for result in finished:
+        previous = per_trial.get(result["trial"])
+        per_trial[result["trial"]] = {
+            "result": result if previous is None or result["rung"] > previous["result"]["rung"] else previous["result"],
+            "epochs": result["epochs"] + (previous["epochs"] if previous else 0),
+            "seconds": result["seconds"] + (previous["seconds"] if previous else 0)}
+    ranking = sorted(per_trial.values(), key=lambda entry: (
+        entry["result"]["rung"], entry["result"]["fitness"]), reverse=True)
+    for entry in ranking:
+        result = entry["result"]
+        lines.append(f"{result['trial']}\t{result['rung']}\t{result['fitness']:.5f}\t{result['map50']:.5f}\t"
+                     f"{result['map50_95']:.5f}\t{entry['epochs']}\t{entry['seconds']:.0f}")
+
+    report = "\n".join(lines) + "\n"
+    print(report)
+    with open(os.path.join(output_folder, "report.txt"), "w", encoding="utf-8") as file:
+        file.write(report)
+
+    if ranking:
+        with open(os.path.join(output_folder, "best_hyperparameters.yaml"), "w", encoding="utf-8") as file:
+            yaml.safe_dump(ranking[0]["result"]["hyperparameters"], file)
 
 
 def main():
+    """
+    Tunes the training hyperparameters with asynchronous successive halving (ASHA).
+
+    Trials run concurrently in a process pool on a subsample of the dataset. Every trial starts with
+    a small budget of epochs and only the best 1/eta of each rung are trained further, so poor
+    configurations are stopped early. Results are appended to results.jsonl in the output folder and an
+    interrupted run resumes from it.
 
-    # Parse command line arguments
-    parser = argparse.ArgumentParser()
+    Args:
+        -m (str): Model to start every trial from (default: best_weights/best.pt).
+        -data (str): Data configuration file (default: birds.yaml).
+        -output (str): Folder of the tuning results (default: tune_results).
+        -trials (int): Number of configurations to try (default: 27).
+        -workers (int): Trials running at the same time (default: 2).
+        -devices (str): Comma separated devices, assigned to the workers in turn (default: 0).
+        -min-epochs (int): Epochs of the first rung (default: 1).
+        -max-epochs (int): Maximum epochs of a trial (default: 9).
+        -eta (int): Reduction factor between rungs (default: 3).
+        -fraction (float): Fraction of the train and val images used by the trials (default: 0.2).
+        -imgsz (int): Input image size (default: 640).
+        -batch (int): Batch size (default: 12).
+        -seed (int): Seed of the sampled configurations and of the subsample (default: 0).
+        -frame-cache (bool): Read the frames from the frame cache of the dataset for imgsz, always the
+            case for a dataset created with --no-jpeg (default: False).
+    """
+    parser = argparse.ArgumentParser(
+        description="Tune the training hyperparameters with parallel successive halving")
     parser.add_argument("-m", type=str, default="best_weights/best.pt",
                         help="Model to use")
+    parser.add_argument("-data", type=str, default="birds.yaml",
+                        help="Path to the data configuration file")
+    parser.add_argument("-output", type=str, default="tune_results",
+                        help="Folder of the tuning results, an existing one is resumed")
+    parser.add_argument("-trials", type=int, default=27,
+                        help="Number of configurations to try")
+    parser.add_argument("-workers", type=int, default=2,
+                        help="Trials running at the same time")
+    parser.add_argument("-devices", type=str, default="0",
+                        help="Comma separated devices, assigned to the workers in turn")
+    parser.add_argument("-min-epochs", type=int, default=1,
+                        help="Epochs of the first rung")
+    parser.add_argument("-max-epochs", type=int, default=9,
+                        help="Maximum epochs of a trial")
+    parser.add_argument("-eta", type=int, default=3,
+                        help="Reduction factor between rungs")
+    parser.add_argument("-fraction", type=float, default=0.2,
+                        help="Fraction of the train and val images used by the trials")
+    parser.add_argument("-imgsz", type=int, default=640,
+                        help="Input image size")
+    parser.add_argument("-batch", type=int, default=12,
+                        help="Batch size")
+    parser.add_argument("-seed", type=int, default=0,
+                        help="Seed of the sampled configurations and of the subsample")
+    parser.add_argument("-frame-cache", action="store_true", default=False,
+                        help="Read the frames from the frame cache of the dataset")
     args = parser.parse_args()
 
-    # Load the model
-    model = YOLO(args.m)
+    os.makedirs(args.output, exist_ok=True)
+    epochs = rung_epochs(args.min_epochs, args.max_epochs, args.eta)
+    devices = args.devices.split(",")
+
+    # Results of runs with other settings can't be mixed, -trials and -workers may change
+    check_config(os.path.join(args.output, "config.json"), {
+        "m": args.m, "data": args.data, "seed": args.seed, "fraction": args.fraction, "eta": args.eta,
+        "min_epochs": args.min_epochs, "max_epochs": args.max_epochs, "imgsz": args.imgsz})
+
+    subset_data_file, from_frame_cache = create_subset_data(
+        args.data, args.output, args.fraction, args.seed, args.imgsz)
+    frame_cache = args.frame_cache or from_frame_cache
+
+    results_file = os.path.join(args.output, "results.jsonl")
+    results = load_results(results_file)
+    if results:
+        print(f"Resuming from {len(results)} finished jobs in {results_file}")
+
+    # One device per worker slot
+    free_devices = [devices[slot % len(devices)]
+                    for slot in range(args.workers)]
+    running = {}
+
+    # Spawn so that CUDA is never initialized in a forked process
+    with ProcessPoolExecutor(max_workers=args.workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+        futures = {}
+        while True:
+            while free_devices:
+                job = next_job(results, running, args, epochs)
+                if job is None:
+                    break
+                device = free_devices.pop()
+                key = (job["trial"], job["rung"])
+                running[key] = job
+                future = executor.submit(
+                    run_trial, job, subset_data_file, args.output, args.imgsz, args.batch, device, frame_cache)
+                futures[future] = (key, device)
+                print(
+                    f"Trial {job['trial']} rung {job['rung']}: {job['epochs']} epochs on device {device}")
+
+            if not futures:
+                break
+
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                key, device = futures.pop(future)
+                job = running.pop(key)
+                free_devices.append(device)
+
+                try:
+                    result = future.result()
+                except Exception as e:
+                    # Failed trials are kept so that they are neither promoted nor retried
+                    print(f"Trial {key[0]} rung {key[1]} failed: {str(e)}")
+                    result = dict(job, fitness=None, seconds=0)
+                result["finished_at"] = time.time()
+
+                results[key] = result
+                with open(results_file, "a", encoding="utf-8") as file:
+                    file.write(json.dumps(result) + "\n")
 
-    # Start tuning hyperparameters for model training on the birds dataset
-    result_grid = model.tune(data='birds.yaml', epochs=1, iterations=10)
+    write_report(results, args.output, epochs)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,211 @@
+import argparse
+import hashlib
+import os
+import sqlite3
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+DEFAULT_HASH_CACHE_PATH = "video_hashes.sqlite"
+
+# Bytes read at the start, middle and end of a file for the partial hash
+PARTIAL_BLOCK_SIZE = 1 << 16
+
+
+class HashCache:
+    """
+    Content hashes of the videos, reused as long as the size and modification time of the
+    file don't change.
+    """
+
+    def __init__(self, path=DEFAULT_HASH_CACHE_PATH):
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS hashes (
+                path TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                partial TEXT,
+                full TEXT
+            )
+        """)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self.connection.commit()
+        self.connection.close()
+
+    def get(self, path, kind, size, mtime_ns):
+        row = self.connection.execute(
+            f"SELECT {kind} FROM hashes WHERE path = ? AND size = ? AND mtime_ns = ?",
+            (path, size, mtime_ns)).fetchone()
+        return None if row is None else row[0]
+
+    def put(self, path, kind, value, size, mtime_ns):
+        # A changed file loses both of its hashes
+        self.connection.execute(
+            "DELETE FROM hashes WHERE path = ? AND NOT (size = ? AND mtime_ns = ?)", (path, size, mtime_ns))
+        self.connection.execute(
+            "INSERT OR IGNORE INTO hashes (path, size, mtime_ns) VALUES (?, ?, ?)", (path, size, mtime_ns))
+        self.connection.execute(
+            f"UPDATE hashes SET {kind} = ? WHERE path = ?", (value, path))
+
+
+def partial_hash(path, size):
+    """
+    Hash of the size and of three blocks of the file, enough to tell most different videos
+    of the same size apart without reading them.
+    """
+    digest = hashlib.blake2b(str(size).encode(), digest_size=16)
+    with open(path, "rb") as file:
+        for offset in sorted({0, max(size // 2 - PARTIAL_BLOCK_SIZE // 2, 0), max(size - PARTIAL_BLOCK_SIZE, 0)}):
+            file.seek(offset)
+            digest.update(file.read(PARTIAL_BLOCK_SIZE))
+    return digest.hexdigest()
+
+
+def full_hash(path, chunk_size=1 << 20):
+    digest = hashlib.blake2b(digest_size=32)
+    with open(path, "rb") as file:
+        while True:
+            chunk = file.read(chunk_size)
+            if not chunk:
+                break
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def compute_hashes(paths, kind, stats, cache, workers):
+    """
+    Hashes (kind "partial" or "full") of the files, from the cache when the file didn't change.
+    Returns a dictionary path -> hash.
+    """
+    hashes = {}
+    missing = []
+    for path in paths:
+        size, mtime_ns = stats[path]
+        cached = cache.get(path, kind, size, mtime_ns) if cache is not None else None
+        if cached is None:
+            missing.append(path)
+        else:
+            hashes[path] = cached
+
+    def compute(path):
+        if kind == "partial":
+            return partial_hash(path, stats[path][0])
+        return full_hash(path)
+
+    # hashlib releases the GIL on large buffers, threads are enough
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for path, value in zip(missing, executor.map(compute, missing)):
+            hashes[path] = value
+            if cache is not None:
+                cache.put(path, kind, value, *stats[path])
+
+    if cache is not None:
+        cache.connection.commit()
+    return hashes
+
+
+def group_by(paths, key):
+    groups = defaultdict(list)
+    for path in paths:
+        groups[key(path)].append(path)
+    return [group for group in groups.values() if len(group) > 1]
+
+
+def find_duplicates(paths, cache=None, workers=16):
+    """
+    Groups of files with identical content, in the order of `paths` inside a group.
+
+    Only files of the same size are hashed, first partially, and only the files whose partial
+    hashes collide are read entirely.
+    """
+    def stat(path):
+        try:
+            stat_result = os.stat(path)
+        except FileNotFoundError:
+            return None
+        return stat_result.st_size, stat_result.st_mtime_ns
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        stats = {path: result for path, result in zip(
+            paths, executor.map(stat, paths)) if result is not None}
+
+    existing = [path for path in dict.fromkeys(paths) if path in stats]
+    candidates = [path for group in group_by(existing, lambda path: stats[path][0])
+                  for path in group]
+
+    partial = compute_hashes(candidates, "partial", stats, cache, workers)
+    candidates = [path for group in group_by(candidates, lambda path: partial[path])
+                  for path in group]
+
+    full = compute_hashes(candidates, "full", stats, cache, workers)
+    order = {path: index for index, path in enumerate(existing)}
+    groups = group_by(candidates, lambda path: full[path])
+    return sorted((sorted(group, key=order.get) for group in groups), key=lambda group: order[group[0]])
+
+
+def write_report(groups, report_path, names=None):
+    """
+    Writes the kept and removed file of every group of duplicates. Returns the number of
+    files removed and their total size.
+    """
+    names = names or {}
+    removed = sum(len(group) - 1 for group in groups)
+    removed_bytes = sum(os.path.getsize(path) * (len(group) - 1)
+                        for group in groups for path in group[:1])
+
+    with open(report_path, "w", encoding="utf-8") as report:
+        report.write(f"{len(groups)} groups of duplicates, {removed} files removed "
+                     f"({removed_bytes / 1e9:.2f} GB)\n")
+        for group in groups:
+            report.write(f"kept    {names.get(group[0], group[0])}\n")
+            for path in group[1:]:
+                report.write(f"removed {names.get(path, path)}\n")
+
+    return removed, removed_bytes
+
+
+def main():
+    """
+    Finds the videos with identical content in a folder.
+
+    Args:
+        -i (str): Folder of the videos (default: videos).
+        -cache (str): Hash cache (default: video_hashes.sqlite).
+        -workers (int): Threads hashing the files (default: 16).
+        -o (str): Report of the duplicates (default: duplicate_videos.txt).
+    """
+    parser = argparse.ArgumentParser(
+        description="Find the videos with identical content")
+    parser.add_argument("-i", type=str, default="videos",
+                        help="Folder of the videos")
+    parser.add_argument("-cache", type=str, default=DEFAULT_HASH_CACHE_PATH,
+                        help="Hash cache, reused while the size and modification time of a file don't change")
+    parser.add_argument("-workers", type=int, default=16,
+                        help="Threads hashing the files")
+    parser.add_argument("-o", type=str, default="duplicate_videos.txt",
+                        help="Report of the duplicates")
+    args = parser.parse_args()
+
+    paths = sorted(os.path.join(root, filename)
+                   for root, _, files in os.walk(args.i)
+                   for filename in files if filename.endswith(".mp4"))
+
+    with HashCache(args.cache) as cache:
+        groups = find_duplicates(paths, cache, args.workers)
+
+    removed, removed_bytes = write_report(groups, args.o)
+    print(f"{len(paths)} videos, {removed} duplicates ({removed_bytes / 1e9:.2f} GB) in {len(groups)} groups, "
+          f"report written to {args.o}")
+
+
+if __name__ == "__main__":
+    main()
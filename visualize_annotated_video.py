@@ -1,90 +1,237 @@
 import cv2
 import argparse
 import os
+import threading
 import numpy as np
 
-from PIL import Image, ImageDraw, ImageFont
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from annotation_drawing import draw_box
+from label_index import load_label_index
 from utils import SPECIES_LIST
 
+WINDOW_NAME = "Image with Bounding Boxes"
+
+# Keys of the browser
+KEY_ESCAPE = 27
+KEYS_NEXT = [ord("d"), ord(" "), 83]  # 83: right arrow on most platforms
+KEYS_PREVIOUS = [ord("a"), 81]  # 81: left arrow
+KEY_GRID = ord("g")
+KEY_QUIT = ord("q")
+
+
+def read_labels(label_path):
+    labels = []
+    if not os.path.exists(label_path):
+        return labels
+
+    with open(label_path, "r", encoding="utf-8") as f:
+        for line in f:
+            parts = line.strip().split(" ")
+            if len(parts) < 5:
+                continue
+            labels.append((int(parts[0]), *map(float, parts[1:5])))
+    return labels
+
+
+class DatasetBrowser:
+    """
+    Renders the images of a split with their boxes. The next images (or the next page of the
+    contact sheet) are rendered in the background while the current one is displayed, and the
+    rendered images and thumbnails are kept in LRU caches.
+    """
+
+    def __init__(self, images_folder, labels_folder, image_files, prefetch=8, cache_size=64,
+                 thumbnail_size=240, grid=(4, 4), workers=2):
+        self.images_folder = images_folder
+        self.labels_folder = labels_folder
+        self.image_files = image_files
+        self.prefetch = prefetch
+        self.cache_size = cache_size
+        self.thumbnail_size = thumbnail_size
+        self.columns, self.rows = grid
+
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.lock = threading.Lock()
+        self.rendered = OrderedDict()  # (kind, index) -> Future of the rendered image
+        self.thumbnails = OrderedDict()  # image index -> thumbnail
+
+    def page_size(self):
+        return self.columns * self.rows
+
+    def number_pages(self):
+        return (len(self.image_files) + self.page_size() - 1) // self.page_size()
+
+    def render(self, index):
+        image_file = self.image_files[index]
+        image = cv2.imread(os.path.join(self.images_folder, image_file))
+        height, width = image.shape[:2]  # Get image dimensions
+
+        label_path = os.path.join(
+            self.labels_folder, image_file.replace(".jpg", ".txt"))
+        for class_id, center_x, center_y, width_normalized, height_normalized in read_labels(label_path):
+            # Calculate bounding box coordinates
+            half_width = width_normalized * width / 2
+            half_height = height_normalized * height / 2
+
+            # Drawn directly on the BGR image, labels are cached sprites
+            draw_box(image,
+                     (center_x * width) - half_width, (center_y * height) - half_height,
+                     (center_x * width) + half_width, (center_y * height) + half_height,
+                     SPECIES_LIST[class_id], font_size=30)
+
+        return image
+
+    def thumbnail(self, index):
+        with self.lock:
+            if index in self.thumbnails:
+                self.thumbnails.move_to_end(index)
+                return self.thumbnails[index]
+
+        image = self.render(index)
+        height, width = image.shape[:2]
+        ratio = self.thumbnail_size / max(height, width)
+        thumbnail = np.zeros(
+            (self.thumbnail_size, self.thumbnail_size, 3), dtype=np.uint8)
+        resized = cv2.resize(image, (int(width * ratio), int(height * ratio)),
+                             interpolation=cv2.INTER_AREA)
+        thumbnail[:resized.shape[0], :resized.shape[1]] = resized
+
+        with self.lock:
+            self.thumbnails[index] = thumbnail
+            # Enough thumbnails for a few pages
+            while len(self.thumbnails) > self.cache_size * self.page_size():
+                self.thumbnails.popitem(last=False)
+        return thumbnail
+
+    def contact_sheet(self, page):
+        size = self.thumbnail_size
+        sheet = np.zeros((self.rows * size, self.columns * size, 3), dtype=np.uint8)
+        first = page * self.page_size()
+        for position, index in enumerate(range(first, min(first + self.page_size(), len(self.image_files)))):
+            row, column = divmod(position, self.columns)
+            sheet[row * size:(row + 1) * size, column *
+                  size:(column + 1) * size] = self.thumbnail(index)
+        return sheet
+
+    def _submit(self, key):
+        with self.lock:
+            if key in self.rendered:
+                self.rendered.move_to_end(key)
+                return self.rendered[key]
+
+            kind, index = key
+            function = self.render if kind == "image" else self.contact_sheet
+            future = self.executor.submit(function, index)
+            self.rendered[key] = future
+            while len(self.rendered) > self.cache_size:
+                self.rendered.popitem(last=False)
+            return future
+
+    def get(self, kind, index):
+        """
+        Returns the rendered image (kind "image") or contact sheet (kind "page") and starts
+        rendering the following ones in the background.
+        """
+        future = self._submit((kind, index))
+
+        last = len(self.image_files) if kind == "image" else self.number_pages()
+        ahead = self.prefetch if kind == "image" else max(self.prefetch // self.page_size(), 1)
+        for offset in range(1, ahead + 1):
+            if index + offset < last:
+                self._submit((kind, index + offset))
+        if index > 0:
+            self._submit((kind, index - 1))
+
+        return future.result()
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
 
 def main():
+    """
+    Browses the images of the created dataset with their bounding boxes.
+
+    Keys: d / space / right arrow next, a / left arrow previous, g toggle the contact sheet, q / Escape quit.
+
+    Args:
+        -d (str): Dataset folder (default: created_dataset).
+        -split (str): Split to browse (default: train).
+        -i (str): Directory containing the images, overrides -d and -split.
+        -l (str): Directory containing the label files, overrides -d and -split.
+        -c (int): Only show images containing these class ids, looked up in the label index of -d (default: all).
+        -grid (str): Columns x rows of the contact sheet (default: 4x4).
+        -prefetch (int): Images rendered ahead in the background (default: 8).
+    """
     parser = argparse.ArgumentParser()
-    parser.add_argument("-i", type=str, default="created_dataset/images/train",
-                        help="Path to the directory containing images")
-    parser.add_argument("-l", type=str, default="created_dataset/labels/train",
-                        help="Path to the directory containing label files")
+    parser.add_argument("-d", type=str, default="created_dataset",
+                        help="Dataset folder")
+    parser.add_argument("-split", type=str, default="train", choices=["train", "val", "test"],
+                        help="Split to browse")
+    parser.add_argument("-i", type=str, default=None,
+                        help="Path to the directory containing images, overrides -d and -split")
+    parser.add_argument("-l", type=str, default=None,
+                        help="Path to the directory containing label files, overrides -d and -split")
+    parser.add_argument("-c", type=int, nargs="+", default=None,
+                        help="Only show images containing these class ids")
+    parser.add_argument("-grid", type=str, default="4x4",
+                        help="Columns x rows of the contact sheet")
+    parser.add_argument("-prefetch", type=int, default=8,
+                        help="Images rendered ahead in the background")
+    parser.add_argument("-start-grid", action="store_true", default=False,
+                        help="Start with the contact sheet")
     args = parser.parse_args()
 
-    image_files = os.listdir(args.i)
-    label_files = os.listdir(args.l)
-
-    for image_file in image_files:
-        image_path = os.path.join(args.i, image_file)
-        label_file = os.path.join(args.l, image_file.replace(".jpg", ".txt"))
-
-        if os.path.exists(label_file):
-            image = cv2.imread(image_path)
-            height, width, _ = image.shape  # Get image dimensions
-
-            with open(label_file, "r", encoding="utf-8") as f:
-                lines = f.readlines()
-
-            pil_image = Image.fromarray(cv2.cvtColor(image, cv2.COLOR_BGR2RGB))
-            draw = ImageDraw.Draw(pil_image)
-            font = ImageFont.truetype("arial.ttf", 30)
-
-            for line in lines:
-                parts = line.strip().split(" ")
-                class_id = int(parts[0])
-                center_x, center_y, width_normalized, height_normalized = map(
-                    float, parts[1:5])
-
-                # Calculate bounding box coordinates
-                half_width = width_normalized * width / 2
-                half_height = height_normalized * height / 2
-
-                x1 = int((center_x * width) - half_width)
-                y1 = int((center_y * height) - half_height)
-                x2 = int((center_x * width) + half_width)
-                y2 = int((center_y * height) + half_height)
-
-                # Convert class_id to class name using SPECIES_LIST
-                class_name = SPECIES_LIST[class_id]
-
-                # Calculate the text size and position
-                text = f"{class_name}"
-                text_size = draw.textbbox(
-                    (x1, y1), text, font=font, anchor="lb")
-
-                text_x = text_size[0]
-                text_y = text_size[1] - 2
-
-                # Draw the rectangle with background color
-                rect_color = (170, 0, 0)  # Green color for the rectangle
-                draw.rectangle(text_size, fill=rect_color)
-
-                # Draw a bounding box on the image
-                box_color = (170, 0, 0)  # Green color for the bounding box
-                thickness = 4
-                draw.rectangle([x1, y1, x2, y2],
-                               outline=box_color, width=thickness)
-
-                # Add class name as text with UTF-8 encoding
-                text_color = (0, 0, 0)  # White color for text
-                draw.text((text_x, text_y), text, font=font, fill=text_color)
-
-            # Convert the Pillow image back to OpenCV format for display
-            image_with_text = cv2.cvtColor(
-                np.array(pil_image), cv2.COLOR_RGB2BGR)
-
-            # Display the image with bounding boxes and handle key events
-            cv2.imshow("Image with Bounding Boxes", image_with_text)
-
-            # Wait for a key press for a specified duration (in milliseconds)
-            # If the 'Escape' key (27) is pressed, break the loop and close the window
-            key = cv2.waitKey(0) & 0xFF
-            if key == 27:
-                break
+    images_folder = args.i or os.path.join(args.d, "images", args.split)
+    labels_folder = args.l or os.path.join(args.d, "labels", args.split)
+
+    image_files = sorted(filename for filename in os.listdir(images_folder)
+                         if filename.endswith(".jpg")
+                         and os.path.exists(os.path.join(labels_folder, filename.replace(".jpg", ".txt"))))
+
+    if args.c is not None:
+        if args.i is not None or args.l is not None:
+            parser.error("-c uses the label index of -d, it can't be combined with -i or -l")
+        label_index = load_label_index(args.d)
+        wanted = {label_index.image_file(index)
+                  for index in label_index.images_with_classes(args.c, args.split)}
+        image_files = [image_file for image_file in image_files
+                       if image_file in wanted]
+
+    print(f"{len(image_files)} images to browse")
+    if not image_files:
+        return
+
+    columns, rows = map(int, args.grid.lower().split("x"))
+    browser = DatasetBrowser(images_folder, labels_folder, image_files,
+                             prefetch=args.prefetch, grid=(columns, rows))
+
+    grid_mode = args.start_grid
+    index = 0
+    while True:
+        if grid_mode:
+            page = index // browser.page_size()
+            cv2.imshow(WINDOW_NAME, browser.get("page", page))
+            title = f"Page {page + 1}/{browser.number_pages()}"
+        else:
+            cv2.imshow(WINDOW_NAME, browser.get("image", index))
+            title = f"{index + 1}/{len(image_files)} {image_files[index]}"
+        cv2.setWindowTitle(WINDOW_NAME, title)
+
+        # Wait for a key press
+        key = cv2.waitKey(0) & 0xFF
+        step = browser.page_size() if grid_mode else 1
+        if key in (KEY_ESCAPE, KEY_QUIT):
+            break
+        elif key in KEYS_NEXT:
+            index = min(index + step, len(image_files) - 1)
+        elif key in KEYS_PREVIOUS:
+            index = max(index - step, 0)
+        elif key == KEY_GRID:
+            grid_mode = not grid_mode
+
+    browser.close()
 
     # Close all OpenCV windows when done
     cv2.destroyAllWindows()
@@ -0,0 +1,375 @@
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import shutil
+import socket
+import tempfile
+import threading
+import time
+import uuid
+import zlib
+
+
+def default_worker_id():
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+class Lease:
+    def __init__(self, task, path, token, takeover=False):
+        self.task = task
+        self.path = path
+        self.token = token
+        self.takeover = takeover
+        # Set by the heartbeat when another worker took the task over
+        self.lost = False
+
+
+class WorkQueue:
+    """
+    Coordinator free work queue on a shared filesystem (NFS, Lustre, ...).
+
+    Workers claim a task by creating its lease file with O_EXCL, so only one of them succeeds.
+    Held leases are kept alive by touching them, a lease not touched for `lease_ttl` seconds
+    belongs to a crashed worker and is taken over. A task is finished once its done marker
+    exists, markers are written last so that a task interrupted before is simply done again.
+
+    Layout: <folder>/leases/<task>.lease, <folder>/done/<task>.done
+    """
+
+    def __init__(self, folder, worker_id=None, lease_ttl=120.0):
+        self.folder = folder
+        self.worker_id = worker_id or default_worker_id()
+        self.lease_ttl = lease_ttl
+        self.leases_folder = os.path.join(folder, "leases")
+        self.done_folder = os.path.join(folder, "done")
+        os.makedirs(self.leases_folder, exist_ok=True)
+        os.makedirs(self.done_folder, exist_ok=True)
+
+        self.held = {}  # task -> Lease
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def lease_path(self, task):
+        return os.path.join(self.leases_folder, f"{task}.lease")
+
+    def done_path(self, task):
+        return os.path.join(self.done_folder, f"{task}.done")
+
+    def is_done(self, task):
+        return os.path.exists(self.done_path(task))
+
+    def done_tasks(self):
+        # One directory listing instead of one stat per task
+        return {name[:-len(".done")] for name in os.listdir(self.done_folder) if name.endswith(".done")}
+
+    def _create_lease(self, task, takeover=False):
+        path = self.lease_path(task)
+        token = uuid.uuid4().hex
+        try:
+            fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+        except FileExistsError:
+            return None
+
+        with os.fdopen(fd, "w", encoding="utf-8") as file:
+            json.dump({"worker": self.worker_id, "token": token,
+                       "time": time.time()}, file)
+
+        lease = Lease(task, path, token, takeover)
+        with self.lock:
+            self.held[task] = lease
+        return lease
+
+    def _read_token(self, path):
+        try:
+            with open(path, "r", encoding="utf-8") as file:
+                return json.load(file)["token"]
+        except (FileNotFoundError, ValueError, KeyError):
+            # Missing, or being written by its owner
+            return None
+
+    def _take_over(self, task):
+        """
+        Removes the lease of the task if it expired. The expired lease is renamed to a name of its
+        own first: only one worker can rename it, the others get FileNotFoundError.
+        """
+        path = self.lease_path(task)
+        try:
+            if time.time() - os.stat(path).st_mtime < self.lease_ttl:
+                return False
+        except FileNotFoundError:
+            return True
+
+        expired_path = f"{path}.expired.{uuid.uuid4().hex}"
+        try:
+            os.rename(path, expired_path)
+        except FileNotFoundError:
+            return False
+
+        # The lease may have been renewed or replaced between the stat and the rename, in that
+        # case it is put back (link fails if a new lease was created in the meantime)
+        if time.time() - os.stat(expired_path).st_mtime < self.lease_ttl:
+            try:
+                os.link(expired_path, path)
+            except FileExistsError:
+                pass
+            os.remove(expired_path)
+            return False
+
+        os.remove(expired_path)
+        return True
+
+    def claim(self, task):
+        """
+        Returns the lease of the task, or None if it is done or held by another worker.
+        """
+        if self.is_done(task):
+            return None
+
+        lease = self._create_lease(task)
+        if lease is None and self._take_over(task):
+            lease = self._create_lease(task, takeover=True)
+        if lease is None:
+            return None
+
+        # Finished by another worker between the check and the claim
+        if self.is_done(task):
+            self.abandon(lease)
+            return None
+        return lease
+
+    def owns(self, lease):
+        return not lease.lost and self._read_token(lease.path) == lease.token
+
+    def complete(self, lease, status="done", **info):
+        """
+        Writes the done marker of the task and removes its lease. Returns False (and doesn't
+        mark the task) if the lease was lost to another worker.
+        """
+        if not self.owns(lease):
+            self._forget(lease)
+            return False
+
+        marker = {"worker": self.worker_id, "status": status,
+                  "takeover": lease.takeover, "time": time.time(), **info}
+        tmp_path = f"{self.done_path(lease.task)}.tmp.{lease.token}"
+        with open(tmp_path, "w", encoding="utf-8") as file:
+            json.dump(marker, file)
+        os.replace(tmp_path, self.done_path(lease.task))
+
+        self.abandon(lease)
+        return True
+
+    def abandon(self, lease):
+        """
+        Gives the task back without finishing it.
+        """
+        self._forget(lease)
+        if self._read_token(lease.path) == lease.token:
+            try:
+                os.remove(lease.path)
+            except FileNotFoundError:
+                pass
+
+    def _forget(self, lease):
+        with self.lock:
+            self.held.pop(lease.task, None)
+
+    def _heartbeat_loop(self):
+        while not self.stop_event.wait(self.lease_ttl / 4):
+            with self.lock:
+                leases = list(self.held.values())
+            for lease in leases:
+                if self._read_token(lease.path) != lease.token:
+                    lease.lost = True
+                    continue
+                try:
+                    os.utime(lease.path)
+                except FileNotFoundError:
+                    lease.lost = True
+
+    def start(self):
+        self.thread = threading.Thread(
+            target=self._heartbeat_loop, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+        with self.lock:
+            leases = list(self.held.values())
+        for lease in leases:
+            self.abandon(lease)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+def commit_staged(staging_folder, destination_folder):
+    """
+    Moves every file written in the staging folder to the same relative path in the destination,
+    each with an atomic rename. Both folders must be on the same filesystem.
+    """
+    for root, _, files in os.walk(staging_folder):
+        relative = os.path.relpath(root, staging_folder)
+        target = os.path.normpath(os.path.join(destination_folder, relative))
+        os.makedirs(target, exist_ok=True)
+        for filename in files:
+            os.replace(os.path.join(root, filename),
+                       os.path.join(target, filename))
+    shutil.rmtree(staging_folder, ignore_errors=True)
+
+
+def run_worker(queue, tasks, process, poll_interval=None):
+    """
+    Claims and processes tasks until every task is done, waiting for the leases of the other workers
+    to finish or expire. `tasks` maps task names to payloads, `process(task, payload, lease)` returns
+    the status written in the done marker, or None if the work was abandoned.
+
+    Returns the number of tasks processed by this worker.
+    """
+    poll_interval = poll_interval or max(queue.lease_ttl / 4, 0.1)
+    processed = 0
+
+    while True:
+        done = queue.done_tasks()
+        remaining = [task for task in tasks if task not in done]
+        if not remaining:
+            return processed
+
+        # Workers start at different places to avoid all contending for the same tasks
+        start = zlib.crc32(queue.worker_id.encode()) % len(remaining)
+        remaining = remaining[start:] + remaining[:start]
+
+        claimed = False
+        for task in remaining:
+            lease = queue.claim(task)
+            if lease is None:
+                continue
+
+            claimed = True
+            status = process(task, tasks[task], lease)
+            if status is None:
+                queue.abandon(lease)
+            elif queue.complete(lease, status):
+                processed += 1
+
+        if not claimed:
+            # Every remaining task is held by another worker
+            time.sleep(poll_interval)
+
+
+def simulate_worker(folder, worker_id, tasks, lease_ttl, crash_after):
+    """
+    Worker of the simulation: every task writes a file to the staging folder and commits it.
+    With `crash_after`, the worker dies in the middle of that task, leaving its lease behind.
+    """
+    output_folder = os.path.join(folder, "output")
+    number_processed = [0]
+
+    def process(task, payload, lease):
+        staging_folder = os.path.join(
+            folder, "staging", f"{worker_id}-{task}")
+        os.makedirs(staging_folder, exist_ok=True)
+        time.sleep(random.uniform(0.02, 0.1))
+
+        if crash_after is not None and number_processed[0] == crash_after:
+            os._exit(1)
+
+        with open(os.path.join(staging_folder, f"{task}.txt"), "w", encoding="utf-8") as file:
+            file.write(payload)
+        if not queue.owns(lease):
+            shutil.rmtree(staging_folder, ignore_errors=True)
+            return None
+        commit_staged(staging_folder, output_folder)
+        number_processed[0] += 1
+        return "done"
+
+    with WorkQueue(os.path.join(folder, "queue"), worker_id, lease_ttl) as queue:
+        run_worker(queue, tasks, process)
+
+
+def simulate(number_workers, number_tasks, lease_ttl, number_crashes):
+    """
+    Runs local worker processes against a temporary folder, some of them crashing while holding a
+    lease, and checks that every task ends done exactly once with its output.
+    """
+    folder = tempfile.mkdtemp(prefix="work_queue_")
+    tasks = {f"{number:08}": f"output of task {number}" for number in range(number_tasks)}
+
+    context = multiprocessing.get_context("spawn")
+    start_time = time.time()
+    processes = []
+    for number in range(number_workers):
+        crash_after = 1 if number < number_crashes else None
+        process = context.Process(target=simulate_worker,
+                                  args=(folder, f"worker-{number}", tasks, lease_ttl, crash_after))
+        process.start()
+        processes.append(process)
+    for process in processes:
+        process.join()
+    elapsed_time = time.time() - start_time
+
+    queue = WorkQueue(os.path.join(folder, "queue"), "checker", lease_ttl)
+    markers = {}
+    for task in tasks:
+        if queue.is_done(task):
+            with open(queue.done_path(task), "r", encoding="utf-8") as file:
+                markers[task] = json.load(file)
+
+    missing_outputs = [task for task, payload in tasks.items()
+                       if not os.path.exists(os.path.join(folder, "output", f"{task}.txt"))]
+    crashed = sum(process.exitcode != 0 for process in processes)
+    takeovers = sum(marker["takeover"] for marker in markers.values())
+    per_worker = {}
+    for marker in markers.values():
+        per_worker[marker["worker"]] = per_worker.get(marker["worker"], 0) + 1
+
+    print(f"{len(markers)}/{len(tasks)} tasks done in {elapsed_time:.1f}s by {number_workers} workers "
+          f"({crashed} crashed), {takeovers} taken over after a crash")
+    print("Tasks per worker: " + ", ".join(f"{worker}: {count}" for worker, count in sorted(per_worker.items())))
+    print(f"Missing outputs: {len(missing_outputs)}, leftover leases: {len(os.listdir(queue.leases_folder))}")
+
+    success = len(markers) == len(tasks) and not missing_outputs
+    print("OK" if success else "FAILED", f"(files kept in {folder})")
+    if success:
+        shutil.rmtree(folder)
+    return success
+
+
+def main():
+    """
+    Simulates a distributed build on this machine: several worker processes share a temporary
+    folder, some crash while holding a lease, and every task must end done with its output.
+
+    Args:
+        -workers (int): Number of worker processes (default: 4).
+        -tasks (int): Number of tasks (default: 100).
+        -lease-ttl (float): Seconds after which the lease of a crashed worker is taken over (default: 2).
+        -crashes (int): Number of workers crashing during their second task (default: 1).
+    """
+    parser = argparse.ArgumentParser(
+        description="Simulate the distributed dataset build with local worker processes")
+    parser.add_argument("-workers", type=int, default=4,
+                        help="Number of worker processes")
+    parser.add_argument("-tasks", type=int, default=100,
+                        help="Number of tasks")
+    parser.add_argument("-lease-ttl", type=float, default=2.0,
+                        help="Seconds after which the lease of a crashed worker is taken over")
+    parser.add_argument("-crashes", type=int, default=1,
+                        help="Number of workers crashing during their second task")
+    args = parser.parse_args()
+
+    if not simulate(args.workers, args.tasks, args.lease_ttl, args.crashes):
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()